@@ -550,7 +550,7 @@ services:
     networks:
       - app-network
     healthcheck:
-      test: ["CMD", "curl", "-f", "http://localhost:5000/"]
+      test: ["CMD", "curl", "-f", "http://localhost:5000/readyz"]
       interval: 30s
       timeout: 10s
       retries: 3
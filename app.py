@@ -3,16 +3,25 @@
 Flask Web应用主文件
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_file, Response, g
+from functools import wraps
 import os
 import sys
+import json
+import time
+import threading
 from datetime import datetime
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # 导入数据库管理模块
-from database.db_manager import DatabaseManager
+from database.db_manager import DatabaseManager, reset_query_count, get_query_count, CACHE_USER_EMAILS, LEDGER_INSUFFICIENT, LEDGER_DUPLICATE
+from database.cache import query_cache
+from database.query_stats import query_stats
+from metrics import registry, render_text, HTTP_REQUEST_SECONDS, METRICS_TOKEN
+from request_profiler import SamplingProfiler, profile_store, profiling_requested
+from health import readiness_checker
 
 # 导入系统配置
 from config import Config
@@ -21,14 +30,142 @@ from config import Config
 from yipay_utils import YiPayUtil
 from yipay_config import PAYMENT_TYPES, YIPAY_PID, YIPAY_KEY
 
+# 导入邮件接收死信队列
+from dead_letter_queue import DeadLetterStore
+
+# 导入发件箱后台投递
+from outbox_worker import outbox_worker
+from settlement_worker import settlement_worker
+from verification_store import verification_store
+from password_hasher import password_hasher, PasswordHasherBusy
+from job_scheduler import job_scheduler
+from maintenance_jobs import register_maintenance_jobs
+from code_issuer import issue_codes, stream_batch_csv, CODE_KINDS, MAX_CODES_PER_BATCH
+from mail_events import mail_event_broker
+from email_config import SSE_HEARTBEAT_SECONDS, SSE_MAX_LIFETIME
+from email_config import SYSTEM_FROM_EMAIL
+from email_config import (
+    VERIFY_CODE_DAILY_LIMIT, VERIFY_CODE_USER_LIMIT, VERIFY_CODE_IP_LIMIT, LOGIN_IP_LIMIT, LOGIN_ACCOUNT_LIMIT
+)
+from rate_limiter import rate_limit
+
+# 验证码按邮箱限流的提示（绑定邮箱和登录验证码共用同一个计数）
+VERIFY_CODE_LIMIT_MESSAGE = '该邮箱24小时内验证码发送次数已达上限（{limit}次），请{wait}后再试。这是为了保护有限的邮件发送资源。'
+
 # 创建Flask应用
 app = Flask(__name__, template_folder='frontend/templates', static_folder='frontend/static')
 app.secret_key = os.getenv('SECRET_KEY', 'cloudfare_qq_mail_secret_key_2025')  # 生产环境请使用环境变量
 
+# 限制请求体大小（附件总上限 + 表单字段余量），超出时Werkzeug直接返回413，不会读入整个请求
+from email_config import ATTACHMENT_MAX_TOTAL_SIZE
+app.config['MAX_CONTENT_LENGTH'] = ATTACHMENT_MAX_TOTAL_SIZE + 1024 * 1024
+
 # 创建数据库管理器实例
 # 注意：DatabaseManager内部使用连接池，支持多线程
 db_manager = DatabaseManager()
 
+# 请求耗时指标：最先注册，计时包含加载当前用户
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                     endpoint=request.endpoint or 'unmatched',
+                                     method=request.method, status=response.status_code)
+    return response
+
+registry.register_callback(lambda: [
+    ('qqmail_sse_connections', '新邮件推送连接数', {}, mail_event_broker.connection_count()),
+])
+registry.start_exporter('web')
+
+# 当前用户加载：每个请求最多查询一次用户表，视图函数直接使用 g.user
+@app.before_request
+def load_current_user():
+    """根据会话加载当前用户到 g.user（未登录或用户已被删除时为None）"""
+    reset_query_count()
+    g.user = None
+    if 'user_id' in session and request.endpoint != 'static':
+        if db_manager.connect():
+            g.user = db_manager.get_user_by_id(session['user_id'])
+            db_manager.disconnect()
+
+@app.after_request
+def add_query_count_header(response):
+    """管理员请求在响应头中返回本次请求执行的SQL条数（不对匿名和普通用户暴露）"""
+    user = g.get('user')
+    if user and user.get('is_admin', False):
+        response.headers['X-DB-Query-Count'] = str(get_query_count())
+    return response
+
+# 按需采样分析：管理员请求带 X-Profile: 1 或 ?__profile=1 时启用（在加载用户之后判断权限）
+@app.before_request
+def start_request_profiler():
+    if g.user and g.user.get('is_admin', False) and profiling_requested(request):
+        g.profiler = SamplingProfiler(threading.get_ident())
+        g.profiler.start()
+
+@app.after_request
+def save_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        try:
+            profile_id = profile_store.save(profiler, {
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'status': response.status_code,
+                'username': g.user.get('username'),
+                'db_queries': get_query_count(),
+            })
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception as e:
+            print(f"⚠️ 保存请求分析结果失败: {e}")
+    return response
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    """请求异常结束时停止采样线程（不保存结果）"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
+def _is_api_request():
+    return request.path.startswith('/api/')
+
+def login_required(view):
+    """要求登录：页面跳转到登录页，API返回401"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.user is None:
+            if _is_api_request():
+                return jsonify({'success': False, 'message': '请先登录'}), 401
+            return redirect(url_for('login'))
+        return view(*args, **kwargs)
+    return wrapper
+
+def admin_required(view):
+    """要求管理员：页面跳转到首页，API返回403"""
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not g.user.get('is_admin', False):
+            if _is_api_request():
+                return jsonify({'success': False, 'message': '权限不足'}), 403
+            return redirect(url_for('index'))
+        return view(*args, **kwargs)
+    return wrapper
+
+def refresh_current_user():
+    """余额、会员状态等被修改后重新加载 g.user（调用方负责数据库连接）"""
+    g.user = db_manager.get_user_by_id(g.user['id'])
+    return g.user
+
 # 统一密码验证函数
 def verify_password(plain_password, hashed_password, user_id=None):
     """
@@ -39,36 +176,24 @@ def verify_password(plain_password, hashed_password, user_id=None):
         user_id: 用户ID（用于自动升级密码）
     Returns:
         bool: 密码是否正确
+    Raises:
+        PasswordHasherBusy: 密码哈希线程池已满
     """
-    import bcrypt
-    import hashlib
-
     try:
-        # 优先尝试bcrypt验证
-        if hashed_password.startswith('$2b$'):
-            return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
-        else:
-            # 兼容旧的SHA256密码
-            password_hash = hashlib.sha256(plain_password.encode()).hexdigest()
-            is_valid = (hashed_password == password_hash)
-
-            # 如果SHA256验证成功且提供了user_id，自动升级到bcrypt
-            if is_valid and user_id and db_manager.connect():
-                try:
-                    new_hash = bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-                    db_manager.update_user_password(user_id, new_hash, plain_password)
-                    print(f"用户ID {user_id} 的密码已自动升级到bcrypt")
-                except Exception as e:
-                    print(f"密码升级失败: {str(e)}")
-                finally:
-                    db_manager.disconnect()
-
-            return is_valid
-
+        # bcrypt 在 password_hasher 线程池中校验；兼容旧的SHA256密码
+        is_valid, needs_rehash = password_hasher.verify(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         print(f"密码验证异常: {str(e)}")
         return False
 
+    # SHA256密码或成本因子已调整的bcrypt密码，在后台升级（不阻塞本次请求）
+    if needs_rehash and user_id:
+        password_hasher.rehash_in_background(user_id, plain_password)
+
+    return is_valid
+
 def hash_password(plain_password):
     """
     统一的密码哈希函数
@@ -76,9 +201,19 @@ def hash_password(plain_password):
         plain_password: 明文密码
     Returns:
         str: bcrypt哈希密码
+    Raises:
+        PasswordHasherBusy: 密码哈希线程池已满
     """
-    import bcrypt
-    return bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return password_hasher.hash(plain_password)
+
+@app.errorhandler(PasswordHasherBusy)
+def handle_password_hasher_busy(error):
+    """密码哈希线程池已满：快速返回503，不在请求线程里排队"""
+    db_manager.disconnect()
+    headers = {'Retry-After': '1'}
+    if request.endpoint in ('login', 'register'):
+        return render_template(f'{request.endpoint}.html', error=str(error)), 503, headers
+    return jsonify({'success': False, 'message': str(error)}), 503, headers
 
 # 首页路由
 @app.route('/')
@@ -86,22 +221,18 @@ def index():
     """
     首页视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' in session:
-        # 用户已登录，获取用户信息
-        user = None
-        if db_manager.connect():
-            user = db_manager.get_user_by_username(session['username'])
-            db_manager.disconnect()
-        
-        # 渲染首页模板，传递用户信息
-        return render_template('index.html', user=user)
-    else:
-        # 用户未登录，渲染首页模板，不传递用户信息
-        return render_template('index.html', user=None)
+    # 未登录时 g.user 为None
+    return render_template('index.html', user=g.user)
 
 # 登录页面路由
+def _render_login_limited(message, retry_after):
+    return render_template('login.html', error=message), 429, {'Retry-After': str(retry_after)}
+
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit('login:ip', LOGIN_IP_LIMIT, 300, key='ip', message='登录尝试过于频繁，请{wait}后再试',
+            on_limited=_render_login_limited)
+@rate_limit('login:account', LOGIN_ACCOUNT_LIMIT, 300, key='username', message='该账户登录尝试过于频繁，请{wait}后再试',
+            on_limited=_render_login_limited)
 def login():
     """
     登录页面视图函数
@@ -194,36 +325,30 @@ def logout():
 
 # 邮件列表页面路由
 @app.route('/mails')
+@login_required
 def mails():
     """
     邮件列表页面视图函数 - 支持邮箱过滤和翻页
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 获取过滤参数和翻页参数
     email_filter = request.args.get('email', '')
     page = int(request.args.get('page', 1))
     per_page = 20  # 每页显示20封邮件
     offset = (page - 1) * per_page
     
-    # 获取当前用户信息
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     # 获取邮件列表和总数 - 根据用户权限决定
     mail_list = []
     total_count = 0
+    total_count_exact = True  # 全部邮件的大表视图显示估算值（"约 N 条"）
     if db_manager.connect():
         if user and user.get('is_admin', False):
             # 管理员可以看到所有邮件
             if email_filter == '__ALL__':
                 # 管理员选择"全部"，显示所有用户的邮件
                 mail_list = db_manager.get_all_emails_for_admin(per_page, offset)
-                total_count = db_manager.get_all_emails_count_for_admin()
+                total_count, total_count_exact = db_manager.get_emails_count_estimate()
             elif email_filter:
                 # 按特定邮箱过滤
                 mail_list = db_manager.get_emails_by_email_filter(email_filter, per_page, offset)
@@ -239,7 +364,7 @@ def mails():
                 total_count = db_manager.get_emails_count_by_email_filter(email_filter)
             else:
                 mail_list = db_manager.get_emails(per_page, offset)
-                total_count = db_manager.get_emails_count()
+                total_count, total_count_exact = db_manager.get_emails_count_estimate()
         else:
             # 普通用户只能看到与自己相关的邮件
             if email_filter:
@@ -248,12 +373,21 @@ def mails():
             else:
                 mail_list = db_manager.get_user_emails_with_isolation(session['user_id'], per_page, offset)
                 total_count = db_manager.get_user_emails_count_with_isolation(session['user_id'])
+        
+        # 附加发件箱投递状态（排队中/发送中/失败）
+        if mail_list:
+            outbox_status = db_manager.get_outbox_status_by_email_ids([mail['id'] for mail in mail_list])
+            for mail in mail_list:
+                mail['outbox'] = outbox_status.get(mail['id'])
         db_manager.disconnect()
     
     # 计算翻页信息
     total_pages = (total_count + per_page - 1) // per_page
     has_prev = page > 1
     has_next = page < total_pages
+    if not total_count_exact:
+        # 估算值可能偏小，本页取满时仍允许翻到下一页
+        has_next = has_next or len(mail_list) == per_page
     prev_page = page - 1 if has_prev else None
     next_page = page + 1 if has_next else None
     
@@ -280,23 +414,18 @@ def mails():
                          has_next=has_next,
                          prev_page=prev_page,
                          next_page=next_page,
-                         total_count=total_count)
+                         total_count=total_count,
+                         total_count_exact=total_count_exact)
 
 # 邮件详情页面路由
 @app.route('/mail/<int:mail_id>')
+@login_required
 def mail_detail(mail_id):
     """
     邮件详情页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 获取当前用户信息
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     # 获取邮件详情 - 根据用户权限决定
     mail = {}
@@ -323,7 +452,7 @@ def mail_pure_content(mail_id):
     显示纯净的原始邮件HTML内容 - 直接从EML提取，不经过任何处理
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return "未授权访问", 401
     
     try:
@@ -373,7 +502,7 @@ def mail_eml_view(mail_id):
     查看原始EML文件内容
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return "未授权访问", 401
     
     # 权限检查（简化版）
@@ -401,14 +530,11 @@ def mail_raw_content(mail_id):
     显示邮件原始HTML内容
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return "未授权访问", 401
     
     # 获取当前用户信息
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     # 获取邮件详情 - 根据用户权限决定
     mail = {}
@@ -593,21 +719,12 @@ def mail_raw_content(mail_id):
 
 # 用户管理页面路由（仅管理员可见）
 @app.route('/admin/users')
+@admin_required
 def admin_users():
     """
     用户管理页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    # 检查用户是否为管理员
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
-        if not user or not user.get('is_admin', False):
-            return redirect(url_for('index'))
+    user = g.user
     
     # 获取用户列表
     user_list = []
@@ -622,14 +739,11 @@ def admin_users():
 
 # 域名管理页面路由（仅管理员可见）
 @app.route('/admin/domains')
+@login_required
 def admin_domains():
     """
     域名管理页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查用户是否为管理员
     # 这里需要根据实际需求实现管理员权限检查逻辑
     # 暂时假设所有登录用户都是管理员
@@ -640,32 +754,21 @@ def admin_domains():
         domain_list = db_manager.get_all_domains()
         db_manager.disconnect()
     
-    # 获取当前用户信息
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     # 渲染域名管理页面模板
     return render_template('admin_domains.html', domains=domain_list, user=user)
 
 # 注册码管理页面路由（仅管理员可见）
 @app.route('/admin/codes')
+@login_required
 def admin_codes():
     """
     注册码管理页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    # 检查用户是否为管理员
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
-    
-    if not user or not user.get('is_vip', False):
+    # 检查用户是否为VIP
+    user = g.user
+    if not user.get('is_vip', False):
         return "权限不足", 403
     
     # 获取翻页参数
@@ -702,19 +805,13 @@ def admin_codes():
 
 # 生成注册码路由
 @app.route('/admin/codes/generate', methods=['POST'])
+@login_required
 def generate_code():
     """
     生成注册码
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查用户是否为管理员
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
 
     if not user or not user.get('is_admin', False):
         return "权限不足", 403
@@ -724,50 +821,29 @@ def generate_code():
     count = int(request.form.get('count', 1))
 
     # 检查数量限制
-    if count > 500:
+    if count > MAX_CODES_PER_BATCH:
         return redirect(url_for('admin_codes') + '?error=count_limit_exceeded')
     
-    # 生成注册码
-    import random
-    import string
-    from datetime import datetime
-    
-    generated_codes = []
+    # 批量生成注册码（同一事务内多行插入，冲突的码重新生成）
+    success = False
     if db_manager.connect():
-        for i in range(count):
-            # 生成8位随机注册码
-            code = 'REG' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-            
-            # 确保注册码唯一
-            while db_manager.get_registration_code_by_code(code):
-                code = 'REG' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-            
-            # 创建注册码
-            if db_manager.create_registration_code(code, description, user['id']):
-                generated_codes.append(code)
-        
+        success, message, batch_no, codes = issue_codes(db_manager, 'registration', count, description, user['id'])
         db_manager.disconnect()
     
-    if generated_codes:
-        return redirect(url_for('admin_codes') + f'?success=generated_{len(generated_codes)}_codes')
+    if success:
+        return redirect(url_for('admin_codes') + f'?success=generated_{len(codes)}_codes&batch={batch_no}')
     else:
         return redirect(url_for('admin_codes') + '?error=generation_failed')
 
 # 删除注册码路由
 @app.route('/admin/codes/delete/<code>', methods=['POST'])
+@login_required
 def delete_code(code):
     """
     删除注册码
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查用户是否为管理员
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     if not user or not user.get('is_admin', False):
         return "权限不足", 403
@@ -781,19 +857,13 @@ def delete_code(code):
 
 # 批量删除已使用注册码路由
 @app.route('/admin/codes/delete_used', methods=['POST'])
+@login_required
 def delete_used_codes():
     """
     批量删除所有已使用的注册码
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-
     # 检查用户是否为管理员
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
 
     if not user or not user.get('is_admin', False):
         return "权限不足", 403
@@ -811,18 +881,9 @@ def delete_used_codes():
 
 # 管理员用户操作API
 @app.route('/api/admin/users', methods=['POST'])
+@admin_required
 def api_add_user():
     """添加用户API"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
-        if not user or not user.get('is_admin', False):
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
     try:
         data = request.get_json()
         username = data.get('username', '').strip()
@@ -844,9 +905,12 @@ def api_add_user():
 
             # 创建用户
             hashed_password = hash_password(password)
-            user_id = db_manager.create_user(username, hashed_password, email, is_vip, is_admin, balance)
+            user_id = db_manager.create_user(username, hashed_password, email, is_vip, is_admin, 0)
 
             if user_id and user_id > 0:
+                # 初始余额作为一笔管理员调整入账（余额流水从0开始可对账）
+                if balance > 0:
+                    db_manager.set_balance_by_admin(user_id, balance, session.get('user_id'))
                 # 保存密码历史记录
                 db_manager.save_password_history(user_id, password, hashed_password)
                 db_manager.disconnect()
@@ -862,18 +926,10 @@ def api_add_user():
 
 # API端点：更新用户信息
 @app.route('/api/admin/users/<int:user_id>', methods=['PUT'])
+@admin_required
 def api_update_user(user_id):
     """更新用户信息API"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             data = request.get_json()
             username = data.get('username', '').strip()
@@ -886,14 +942,27 @@ def api_update_user(user_id):
             if not username:
                 db_manager.disconnect()
                 return jsonify({'success': False, 'message': '用户名不能为空'})
+            if balance < 0:
+                db_manager.disconnect()
+                return jsonify({'success': False, 'message': '余额不能为负数'})
 
             # 更新用户基本信息
             update_query = """
-            UPDATE users SET username = %s, email = %s, is_vip = %s, is_admin = %s, balance = %s
+            UPDATE users SET username = %s, email = %s, is_vip = %s, is_admin = %s
             WHERE id = %s
             """
-            params = (username, email, is_vip, is_admin, balance, user_id)
+            params = (username, email, is_vip, is_admin, user_id)
             result = db_manager.execute_update(update_query, params)
+            if result > 0:
+                # 邮箱列表缓存中包含用户名
+                db_manager.invalidate_cache(CACHE_USER_EMAILS)
+
+            # 余额按差额记一条管理员调整流水（余额未变时不记录）
+            if result >= 0:
+                balance_ok, balance_msg = db_manager.set_balance_by_admin(user_id, balance, session.get('user_id'))
+                if not balance_ok:
+                    db_manager.disconnect()
+                    return jsonify({'success': False, 'message': f'余额更新失败：{balance_msg}'})
 
             # 如果提供了新密码，更新密码
             if new_password:
@@ -919,21 +988,13 @@ def api_update_user(user_id):
 
 # API端点：删除用户
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
+@admin_required
 def api_delete_user(user_id):
     """
     删除用户的API端点
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
+    current_user = g.user
     if db_manager.connect():
-        current_user = db_manager.get_user_by_username(session['username'])
-        if not current_user or not current_user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 不能删除自己
         if current_user['id'] == user_id:
             db_manager.disconnect()
@@ -954,18 +1015,10 @@ def api_delete_user(user_id):
 
 # API端点：获取所有域名
 @app.route('/api/admin/domains', methods=['GET'])
+@admin_required
 def api_get_domains():
     """获取所有域名列表"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             domains = db_manager.get_all_domains()
             db_manager.disconnect()
@@ -978,18 +1031,10 @@ def api_get_domains():
 
 # API端点：创建域名
 @app.route('/api/admin/domains', methods=['POST'])
+@admin_required
 def api_create_domain():
     """创建新域名"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             data = request.get_json()
             domain_name = data.get('domain_name', '').strip()
@@ -1021,18 +1066,10 @@ def api_create_domain():
 
 # API端点：更新域名
 @app.route('/api/admin/domains/<int:domain_id>', methods=['PUT'])
+@admin_required
 def api_update_domain(domain_id):
     """更新域名"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             data = request.get_json()
             domain_name = data.get('domain_name', '').strip()
@@ -1064,18 +1101,10 @@ def api_update_domain(domain_id):
 
 # API端点：删除域名
 @app.route('/api/admin/domains/<int:domain_id>', methods=['DELETE'])
+@admin_required
 def api_delete_domain(domain_id):
     """删除域名"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             # 检查域名下是否有邮箱
             emails = db_manager.get_emails_by_domain_id(domain_id)
@@ -1102,7 +1131,7 @@ def api_delete_domain(domain_id):
 @app.route('/delete_mail/<int:mail_id>', methods=['POST'])
 def delete_mail(mail_id):
     """删除单个邮件"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '请先登录'})
 
     if not db_manager.connect():
@@ -1140,7 +1169,7 @@ def delete_mail(mail_id):
 @app.route('/delete_email/<int:email_id>', methods=['POST'])
 def delete_email(email_id):
     """删除邮箱"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '请先登录'})
 
     if not db_manager.connect():
@@ -1169,15 +1198,22 @@ def delete_email(email_id):
         db_manager.disconnect()
         return jsonify({'success': False, 'message': f'删除失败：{str(e)}'})
 
+def _render_register_email(error=None):
+    """渲染邮箱注册页面（可用域名、当前用户的已有邮箱）"""
+    domains = []
+    user_emails = []
+    if db_manager.connect():
+        domains = db_manager.get_all_domains()
+        user_emails = db_manager.get_user_emails(session['user_id'])
+        db_manager.disconnect()
+    return render_template('register_email.html', domains=domains, user_emails=user_emails, user=g.user, error=error)
+
 @app.route('/register_email', methods=['GET', 'POST'])
+@login_required
 def register_email():
     """
     邮箱注册页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     if request.method == 'POST':
         # 处理邮箱注册表单提交
         email_prefix = request.form['email_prefix']
@@ -1194,32 +1230,12 @@ def register_email():
             db_manager.disconnect()
         
         if not domain_name:
-            domains = []
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                domains = db_manager.get_all_domains()
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                user = db_manager.get_user_by_username(session['username'])
-                db_manager.disconnect()
-            return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error='无效的域名选择')
+            return _render_register_email('无效的域名选择')
         
         email_address = f"{email_prefix}@{domain_name}"
 
-        # 获取用户信息并检查邮箱注册限制
-        user = None
-        if db_manager.connect():
-            user = db_manager.get_user_by_username(session['username'])
-            db_manager.disconnect()
-
-        if not user:
-            domains = []
-            user_emails = []
-            if db_manager.connect():
-                domains = db_manager.get_all_domains()
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('register_email.html', domains=domains, user_emails=user_emails, user=None, error='用户信息获取失败')
+        # 检查邮箱注册限制
+        user = g.user
 
         # 获取当前邮箱数量
         current_email_count = 0
@@ -1231,108 +1247,38 @@ def register_email():
         # 检查邮箱数量限制和余额
         can_register, error_msg, registration_cost = Config.can_register_email(user, current_email_count)
         if not can_register:
-            domains = []
-            user_emails = []
-            if db_manager.connect():
-                domains = db_manager.get_all_domains()
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error=error_msg)
+            return _render_register_email(error_msg)
 
         # 检查邮箱是否已存在（全局检查，不仅仅是当前用户）
         if db_manager.connect():
             # 检查该邮箱是否已被任何用户创建
             if db_manager.check_email_exists(email_address, int(domain_id)):
                 db_manager.disconnect()
-                domains = []
-                user_emails = []
-                user = None
-                if db_manager.connect():
-                    domains = db_manager.get_all_domains()
-                    user_emails = db_manager.get_user_emails(session['user_id'])
-                    user = db_manager.get_user_by_username(session['username'])
-                    db_manager.disconnect()
-                return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error='该邮箱已被其他用户创建，请选择其他邮箱名')
+                return _render_register_email('该邮箱已被其他用户创建，请选择其他邮箱名')
             db_manager.disconnect()
         
-        # 创建新邮箱
+        # 创建新邮箱：扣费（条件扣款，并发注册不会扣成负数）、创建邮箱、记录消费在同一事务内完成
         if db_manager.connect():
-            # 创建邮箱
-            result = db_manager.create_user_email(session['user_id'], email_address, domain_id)
-            
-            if result > 0:
-                # 邮箱创建成功，扣除注册费用（如果需要）
-                if registration_cost > 0:
-                    current_balance = float(user.get('balance', 0))
-                    new_balance = current_balance - registration_cost
-                    db_manager.set_user_balance(session['user_id'], new_balance)
-
-                    # 记录消费记录
-                    db_manager.add_billing_record(
-                        user_id=session['user_id'],
-                        amount=registration_cost,
-                        type='email_registration',
-                        description=f'注册邮箱：{email_address}（第{current_email_count + 1}个）'
-                    )
+            success, message = db_manager.create_user_email_with_charge(
+                session['user_id'], email_address, int(domain_id), registration_cost,
+                f'注册邮箱：{email_address}（第{current_email_count + 1}个）')
+            db_manager.disconnect()
 
+            if success:
+                if registration_cost > 0:
                     print(f"✅ 用户 {user['username']} 注册邮箱 {email_address}，扣费 ¥{registration_cost:.2f}")
                 else:
                     print(f"✅ 用户 {user['username']} 免费注册邮箱 {email_address}（第{current_email_count + 1}个）")
-
-                db_manager.disconnect()
                 # 注册成功，重定向到邮件列表页面
                 return redirect(url_for('mails'))
-            elif result == -1:
-                db_manager.disconnect()
-                # 邮箱已存在
-                domains = []
-                user_emails = []
-                user = None
-                if db_manager.connect():
-                    domains = db_manager.get_all_domains()
-                    user_emails = db_manager.get_user_emails(session['user_id'])
-                    user = db_manager.get_user_by_username(session['username'])
-                    db_manager.disconnect()
-                return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error='该邮箱已被其他用户创建，请选择其他邮箱名')
-            else:
-                db_manager.disconnect()
-                # 注册失败，返回错误信息
-                domains = []
-                user_emails = []
-                user = None
-                if db_manager.connect():
-                    domains = db_manager.get_all_domains()
-                    user_emails = db_manager.get_user_emails(session['user_id'])
-                    user = db_manager.get_user_by_username(session['username'])
-                    db_manager.disconnect()
-                return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error='邮箱注册失败')
+            if message == LEDGER_INSUFFICIENT:
+                return _render_register_email(f'{message}，注册邮箱需要 ¥{registration_cost:.2f}')
+            return _render_register_email(message)
         else:
-            domains = []
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                domains = db_manager.get_all_domains()
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                user = db_manager.get_user_by_username(session['username'])
-                db_manager.disconnect()
-            return render_template('register_email.html', domains=domains, user_emails=user_emails, user=user, error='数据库连接失败')
+            return _render_register_email('数据库连接失败')
     
-    # GET请求，获取可用域名列表
-    domains = []
-    if db_manager.connect():
-        domains = db_manager.get_all_domains()
-        db_manager.disconnect()
-    
-    # 获取用户信息和已有邮箱
-    user = None
-    user_emails = []
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        user_emails = db_manager.get_user_emails(session['user_id'])
-        db_manager.disconnect()
-    
-    # 渲染邮箱注册页面
-    return render_template('register_email.html', domains=domains, user=user, user_emails=user_emails)
+    # GET请求，获取可用域名列表和已有邮箱
+    return _render_register_email()
 
 # 邮件费用检查函数
 def send_email_via_api(from_email, to_email, subject, content):
@@ -1404,37 +1350,30 @@ def send_real_email(from_email, to_email, subject, content):
         traceback.print_exc()
         return False
 
-def check_email_cost_and_deduct(user_id, email_id=None):
+def check_email_cost_and_deduct(user, email_id=None):
     """
     检查邮件费用并扣款（新的VIP计费逻辑）
+    user 为本次请求已加载的用户（g.user），扣款是条件更新，不需要重新读取余额
     返回 (success, message, cost)
     """
+    if not user:
+        return False, "用户信息获取失败", 0
+    user_id = user['id']
+
     if not db_manager.connect():
         return False, "数据库连接失败", 0
 
     try:
-        # 获取用户信息
-        user = db_manager.get_user_by_id(user_id)
-        if not user:
-            return False, "用户信息获取失败", 0
-
         # 计算邮件费用
         email_cost, is_vip_free = Config.get_email_send_cost(user)
-        current_balance = float(user.get('balance', 0))
 
-        # 检查余额是否足够（免费的不需要检查余额）
-        if email_cost > 0 and current_balance < email_cost:
-            return False, f'余额不足！当前余额：¥{current_balance:.2f}，需要：¥{email_cost:.2f}', email_cost
-
-        # 扣除费用和更新计数
-        if email_cost > 0:
-            # 扣除余额
-            new_balance = current_balance - email_cost
-            db_manager.set_user_balance(user_id, new_balance)
-
-        # 如果是VIP用户，更新VIP邮件计数
-        if user.get('is_vip', False):
-            db_manager.increment_vip_email_count(user_id)
+        # 条件扣款 + VIP邮件计数在一个事务内完成（余额不足时不扣款也不计数）
+        charged, charge_msg = db_manager.charge_send(user_id, email_cost, Config.is_vip_active(user))
+        if not charged:
+            if charge_msg == LEDGER_INSUFFICIENT:
+                current_balance = float(user.get('balance', 0))
+                return False, f'余额不足！当前余额：¥{current_balance:.2f}，需要：¥{email_cost:.2f}', email_cost
+            return False, f"费用扣除失败：{charge_msg}", 0
 
         # 记录邮件发送记录
         if email_id:
@@ -1448,183 +1387,128 @@ def check_email_cost_and_deduct(user_id, email_id=None):
     finally:
         db_manager.disconnect()
 
+def refund_unqueued_send(user_id, amount, vip_counted, attempts=3):
+    """邮件未能入队时退还费用：出错（包括数据库连接失败）时重试，全部失败时记录日志以便人工处理"""
+    try:
+        for attempt in range(attempts):
+            if db_manager.refund_send_charge(user_id, amount, vip_counted):
+                return True
+            time.sleep(0.5 * (attempt + 1))
+        print(f"❌ 入队失败退款未完成，需要人工处理: 用户ID={user_id}, 金额={amount}, VIP计数={vip_counted}")
+        return False
+    finally:
+        db_manager.disconnect()
+
+def queue_outgoing_email(user, from_email_id, to_email, subject, content, attachments, check_capacity=False):
+    """
+    写信/回复/转发共用：校验发件邮箱、扣费、保存邮件和附件并加入发件箱
+    实际投递由 outbox_worker 后台线程完成，请求无需等待邮件服务商
+    user 为本次请求已加载的用户（g.user）
+    返回 (success, message)
+    """
+    from attachment_spool import spool_uploads, AttachmentTooLarge
+
+    if not user:
+        return False, '用户信息获取失败'
+    user_id = user['id']
+
+    # 获取发送邮箱信息
+    from_email_address = None
+    if db_manager.connect():
+        for email in db_manager.get_user_emails(user_id) or []:
+            if str(email['id']) == str(from_email_id):
+                from_email_address = email['email_address']
+                break
+        db_manager.disconnect()
+
+    if not from_email_address:
+        return False, '无效的发件邮箱选择'
+
+    attachments = [att for att in attachments if att.filename != '']
+
+    # 超出容量限制时不允许发送附件
+    if check_capacity and attachments:
+        usage = check_user_mailbox_capacity(user_id)
+        if usage and usage['total_size_mb'] > 100:
+            return False, f'邮箱容量已超限（{usage["total_size_mb"]:.2f}MB/100MB），无法发送附件。请先清理邮箱或发送纯文本邮件。'
+
+    # 附件按块落盘到唯一命名的暂存文件（同时校验大小），在扣费之前完成
+    try:
+        spooled = spool_uploads(attachments)
+    except AttachmentTooLarge as e:
+        return False, str(e)
+
+    # 入队前先检查费用并扣款，投递最终失败时由发件箱退款
+    cost_check_result = check_email_cost_and_deduct(user)
+    if not cost_check_result[0]:
+        for attachment in spooled:
+            attachment.discard()
+        return False, cost_check_result[1]
+    charged_amount = cost_check_result[2]
+    vip_counted = Config.is_vip_active(user)
+
+    def store_attachments(email_id):
+        # 暂存文件移动到永久目录，发送线程从这里按块读取
+        permanent_attachments_dir = os.path.join('sent_attachments', str(email_id))
+        for attachment in spooled:
+            attachment.move_to(permanent_attachments_dir)
+        return [attachment.to_dict() for attachment in spooled]
+
+    try:
+        # 邮件、附件记录和发件记录在一个事务内写入，失败时不会留下没有入队的邮件
+        email_id, outbox_id, attachment_records = db_manager.queue_outgoing_email(
+            user_id, from_email_address, to_email, subject, content,
+            charged_amount, vip_counted, store_attachments
+        )
+    except Exception as e:
+        print(f"❌ 邮件入队失败: {e}")
+        for attachment in spooled:
+            attachment.discard()
+        refund_unqueued_send(user_id, charged_amount, vip_counted)
+        return False, f'邮件发送失败: {str(e)}'
+    finally:
+        db_manager.disconnect()
+
+    for attachment in spooled:
+        print(f"📎 附件已保存: {attachment.filename} ({attachment.size} 字节, sha256={attachment.sha256[:12]})")
+    outbox_worker.notify()
+    print(f"📮 邮件 {email_id} 已加入发件箱，包含 {len(attachment_records)} 个附件")
+    return True, '邮件已加入发送队列，稍后可在邮件列表查看发送状态'
+
 # 写邮件页面路由
 @app.route('/compose', methods=['GET', 'POST'])
+@login_required
 def compose():
     """
     写邮件页面视图函数 - 支持附件发送
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     if request.method == 'POST':
-        # 处理邮件发送表单提交
-        from_email_id = request.form['from_email_id']
-        to_email = request.form['to_email']
-        subject = request.form['subject']
-        content = request.form['content']
+        # 校验、扣费并加入发件箱，由后台线程投递
+        success, message = queue_outgoing_email(
+            g.user,
+            request.form['from_email_id'],
+            request.form['to_email'],
+            request.form['subject'],
+            request.form['content'],
+            request.files.getlist('attachments'),
+            check_capacity=True
+        )
         
-        # 获取发送邮箱信息
-        from_email_address = None
+        if success:
+            # 入队成功，重定向到邮件列表页面（列表中显示投递状态）
+            return redirect(url_for('mails'))
+        
+        user_emails = []
+        user = g.user
         if db_manager.connect():
             user_emails = db_manager.get_user_emails(session['user_id'])
-            for email in user_emails:
-                if email['id'] == int(from_email_id):
-                    from_email_address = email['email_address']
-                    break
             db_manager.disconnect()
-        
-        if not from_email_address:
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user, error='无效的发件邮箱选择')
-        
-        # 检查用户邮箱容量
-        usage = check_user_mailbox_capacity(session['user_id'])
-        is_over_limit = usage and usage['total_size_mb'] > 100
-
-        # 处理附件
-        attachments = request.files.getlist('attachments')
-        attachment_data = []
-
-        # 如果超出容量限制，不允许发送附件
-        if is_over_limit and any(att.filename != '' for att in attachments):
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user,
-                                 error=f'邮箱容量已超限（{usage["total_size_mb"]:.2f}MB/100MB），无法发送附件。请先清理邮箱或发送纯文本邮件。')
-
-        # 保存附件到临时目录（仅在容量允许时）
-        if not is_over_limit:
-            import os
-            from werkzeug.utils import secure_filename
-
-            temp_attachments_dir = os.path.join('temp_attachments')
-            if not os.path.exists(temp_attachments_dir):
-                os.makedirs(temp_attachments_dir)
-
-            for attachment in attachments:
-                if attachment.filename != '':
-                    filename = secure_filename(attachment.filename)
-                    temp_path = os.path.join(temp_attachments_dir, filename)
-                    attachment.save(temp_path)
-
-                    # 读取文件内容用于邮件发送
-                    with open(temp_path, 'rb') as f:
-                        file_content = f.read()
-
-                    attachment_data.append({
-                        'filename': filename,
-                        'content': file_content,
-                        'temp_path': temp_path
-                    })
-        
-        # 发送邮件前先检查费用并扣款
-        cost_check_result = check_email_cost_and_deduct(session['user_id'])
-        if not cost_check_result[0]:
-            # 费用检查失败，清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user, error=cost_check_result[1])
-
-        # 使用邮件发送模块发送邮件
-        try:
-            from email_sender import send_email
-            
-            # 准备附件数据
-            attachments_for_send = []
-            if attachment_data:
-                for att in attachment_data:
-                    attachments_for_send.append({
-                        'filename': att['filename'],
-                        'content': att['content']
-                    })
-            
-            # 发送邮件
-            email_result = send_email(
-                from_email=from_email_address,
-                to_email=to_email,
-                subject=subject,
-                content=content,
-                attachments=attachments_for_send if attachments_for_send else None
-            )
-            
-            if not email_result:
-                raise Exception("邮件发送失败，未返回邮件ID")
-            
-            # 保存到数据库
-            from datetime import datetime
-            email_id = None
-            if db_manager.connect():
-                email_id = db_manager.save_email(from_email_address, to_email, subject, content, datetime.now())
-                
-                # 保存附件信息到数据库
-                if email_id > 0 and attachment_data:
-                    # 创建永久附件目录
-                    permanent_attachments_dir = os.path.join('sent_attachments', str(email_id))
-                    if not os.path.exists(permanent_attachments_dir):
-                        os.makedirs(permanent_attachments_dir)
-                    
-                    for att in attachment_data:
-                        # 移动附件到永久目录
-                        permanent_path = os.path.join(permanent_attachments_dir, att['filename'])
-                        import shutil
-                        shutil.move(att['temp_path'], permanent_path)
-                        
-                        # 保存附件记录到数据库
-                        file_size = len(att['content'])
-                        db_manager.create_attachment(email_id, att['filename'], permanent_path, file_size)
-                        print(f"📎 附件已保存: {att['filename']} ({file_size} 字节)")
-                
-                db_manager.disconnect()
-            
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            print(f"🎉 邮件发送完成！包含 {len(attachment_data)} 个附件")
-            
-            # 发送成功，重定向到邮件列表页面
-            return redirect(url_for('mails'))
-            
-        except Exception as e:
-            print(f"❌ 邮件发送失败: {e}")
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user, error=f'邮件发送失败: {str(e)}')
+        return render_template('compose.html', user_emails=user_emails, user=user, error=message)
     
     # GET请求，获取用户的邮箱列表
     user_emails = []
-    user = None
+    user = g.user
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
         user_emails = db_manager.get_user_emails(session['user_id'])
         db_manager.disconnect()
     
@@ -1633,19 +1517,15 @@ def compose():
 
 # 回复邮件路由
 @app.route('/compose/reply/<int:mail_id>', methods=['GET', 'POST'])
+@login_required
 def compose_reply(mail_id):
     """
     回复邮件页面视图函数 - 支持GET显示和POST发送
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 获取原邮件信息
     original_mail = None
-    user = None
+    user = g.user
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
         if user and user.get('is_vip', False):
             original_mail = db_manager.get_email_by_id(mail_id)
         else:
@@ -1663,143 +1543,29 @@ def compose_reply(mail_id):
     
     if request.method == 'POST':
         # 处理回复邮件发送（复用compose的逻辑）
-        from_email_id = request.form['from_email_id']
         to_email = request.form['to_email']
         subject = request.form['subject']
         content = request.form['content']
         
-        # 获取发送邮箱信息
-        from_email_address = None
-        if db_manager.connect():
-            user_emails_temp = db_manager.get_user_emails(session['user_id'])
-            for email in user_emails_temp:
-                if email['id'] == int(from_email_id):
-                    from_email_address = email['email_address']
-                    break
-            db_manager.disconnect()
-        
-        if not from_email_address:
-            reply_data = {
-                'to_email': to_email,
-                'subject': subject,
-                'content': content
-            }
-            return render_template('compose.html', user_emails=user_emails, user=user, error='无效的发件邮箱选择', reply_data=reply_data, is_reply=True)
-        
-        # 处理附件
-        attachments = request.files.getlist('attachments')
-        attachment_data = []
-        
-        # 保存附件到临时目录
-        import os
-        from werkzeug.utils import secure_filename
-        
-        temp_attachments_dir = os.path.join('temp_attachments')
-        if not os.path.exists(temp_attachments_dir):
-            os.makedirs(temp_attachments_dir)
-        
-        for attachment in attachments:
-            if attachment.filename != '':
-                filename = secure_filename(attachment.filename)
-                temp_path = os.path.join(temp_attachments_dir, filename)
-                attachment.save(temp_path)
-                
-                # 读取文件内容用于邮件发送
-                with open(temp_path, 'rb') as f:
-                    file_content = f.read()
-                
-                attachment_data.append({
-                    'filename': filename,
-                    'content': file_content,
-                    'temp_path': temp_path
-                })
+        success, message = queue_outgoing_email(
+            g.user,
+            request.form['from_email_id'],
+            to_email,
+            subject,
+            content,
+            request.files.getlist('attachments')
+        )
         
-        # 发送邮件前先检查费用并扣款
-        cost_check_result = check_email_cost_and_deduct(session['user_id'])
-        if not cost_check_result[0]:
-            # 费用检查失败，清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user, error=cost_check_result[1])
-
-        # 使用邮件发送模块发送邮件
-        try:
-            from email_sender import send_email
-            
-            # 准备附件数据
-            attachments_for_send = []
-            if attachment_data:
-                for att in attachment_data:
-                    attachments_for_send.append({
-                        'filename': att['filename'],
-                        'content': att['content']
-                    })
-            
-            # 发送邮件
-            email_result = send_email(
-                from_email=from_email_address,
-                to_email=to_email,
-                subject=subject,
-                content=content,
-                attachments=attachments_for_send if attachments_for_send else None
-            )
-            
-            if not email_result:
-                raise Exception("邮件发送失败，未返回邮件ID")
-            
-            # 保存到数据库
-            from datetime import datetime
-            email_id = None
-            if db_manager.connect():
-                email_id = db_manager.save_email(from_email_address, to_email, subject, content, datetime.now())
-                
-                # 保存附件信息到数据库
-                if email_id > 0 and attachment_data:
-                    # 创建永久附件目录
-                    permanent_attachments_dir = os.path.join('sent_attachments', str(email_id))
-                    if not os.path.exists(permanent_attachments_dir):
-                        os.makedirs(permanent_attachments_dir)
-                    
-                    for att in attachment_data:
-                        # 移动附件到永久目录
-                        permanent_path = os.path.join(permanent_attachments_dir, att['filename'])
-                        import shutil
-                        shutil.move(att['temp_path'], permanent_path)
-                        
-                        # 保存附件记录到数据库
-                        file_size = len(att['content'])
-                        db_manager.create_attachment(email_id, att['filename'], permanent_path, file_size)
-                
-                db_manager.disconnect()
-            
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            # 回复成功，重定向到邮件列表页面
+        if success:
+            # 入队成功，重定向到邮件列表页面（列表中显示投递状态）
             return redirect(url_for('mails'))
-            
-        except Exception as e:
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            reply_data = {
-                'to_email': to_email,
-                'subject': subject,
-                'content': content
-            }
-            return render_template('compose.html', user_emails=user_emails, user=user, error=f'邮件回复失败: {str(e)}', reply_data=reply_data, is_reply=True)
+        
+        reply_data = {
+            'to_email': to_email,
+            'subject': subject,
+            'content': content
+        }
+        return render_template('compose.html', user_emails=user_emails, user=user, error=message, reply_data=reply_data, is_reply=True)
     
     # GET请求，准备回复邮件的预填信息
     reply_data = {
@@ -1812,19 +1578,15 @@ def compose_reply(mail_id):
 
 # 转发邮件路由
 @app.route('/compose/forward/<int:mail_id>', methods=['GET', 'POST'])
+@login_required
 def compose_forward(mail_id):
     """
     转发邮件页面视图函数 - 支持GET显示和POST发送
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 获取原邮件信息
     original_mail = None
-    user = None
+    user = g.user
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
         if user and user.get('is_vip', False):
             original_mail = db_manager.get_email_by_id(mail_id)
         else:
@@ -1835,150 +1597,36 @@ def compose_forward(mail_id):
         return redirect(url_for('mails'))
     
     # 获取用户的邮箱列表
-    user_emails = []
-    if db_manager.connect():
-        user_emails = db_manager.get_user_emails(session['user_id'])
-        db_manager.disconnect()
-    
-    if request.method == 'POST':
-        # 处理转发邮件发送（复用compose的逻辑）
-        from_email_id = request.form['from_email_id']
-        to_email = request.form['to_email']
-        subject = request.form['subject']
-        content = request.form['content']
-        
-        # 获取发送邮箱信息
-        from_email_address = None
-        if db_manager.connect():
-            user_emails_temp = db_manager.get_user_emails(session['user_id'])
-            for email in user_emails_temp:
-                if email['id'] == int(from_email_id):
-                    from_email_address = email['email_address']
-                    break
-            db_manager.disconnect()
-        
-        if not from_email_address:
-            forward_data = {
-                'to_email': to_email,
-                'subject': subject,
-                'content': content
-            }
-            return render_template('compose.html', user_emails=user_emails, user=user, error='无效的发件邮箱选择', reply_data=forward_data, is_forward=True)
-        
-        # 处理附件
-        attachments = request.files.getlist('attachments')
-        attachment_data = []
-        
-        # 保存附件到临时目录
-        import os
-        from werkzeug.utils import secure_filename
-        
-        temp_attachments_dir = os.path.join('temp_attachments')
-        if not os.path.exists(temp_attachments_dir):
-            os.makedirs(temp_attachments_dir)
-        
-        for attachment in attachments:
-            if attachment.filename != '':
-                filename = secure_filename(attachment.filename)
-                temp_path = os.path.join(temp_attachments_dir, filename)
-                attachment.save(temp_path)
-                
-                # 读取文件内容用于邮件发送
-                with open(temp_path, 'rb') as f:
-                    file_content = f.read()
-                
-                attachment_data.append({
-                    'filename': filename,
-                    'content': file_content,
-                    'temp_path': temp_path
-                })
-        
-        # 发送邮件前先检查费用并扣款
-        cost_check_result = check_email_cost_and_deduct(session['user_id'])
-        if not cost_check_result[0]:
-            # 费用检查失败，清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            user_emails = []
-            user = None
-            if db_manager.connect():
-                user = db_manager.get_user_by_username(session['username'])
-                user_emails = db_manager.get_user_emails(session['user_id'])
-                db_manager.disconnect()
-            return render_template('compose.html', user_emails=user_emails, user=user, error=cost_check_result[1])
-
-        # 使用邮件发送模块发送邮件
-        try:
-            from email_sender import send_email
-            
-            # 准备附件数据
-            attachments_for_send = []
-            if attachment_data:
-                for att in attachment_data:
-                    attachments_for_send.append({
-                        'filename': att['filename'],
-                        'content': att['content']
-                    })
-            
-            # 发送邮件
-            email_result = send_email(
-                from_email=from_email_address,
-                to_email=to_email,
-                subject=subject,
-                content=content,
-                attachments=attachments_for_send if attachments_for_send else None
-            )
-            
-            if not email_result:
-                raise Exception("邮件发送失败，未返回邮件ID")
-            
-            # 保存到数据库
-            from datetime import datetime
-            email_id = None
-            if db_manager.connect():
-                email_id = db_manager.save_email(from_email_address, to_email, subject, content, datetime.now())
-                
-                # 保存附件信息到数据库
-                if email_id > 0 and attachment_data:
-                    # 创建永久附件目录
-                    permanent_attachments_dir = os.path.join('sent_attachments', str(email_id))
-                    if not os.path.exists(permanent_attachments_dir):
-                        os.makedirs(permanent_attachments_dir)
-                    
-                    for att in attachment_data:
-                        # 移动附件到永久目录
-                        permanent_path = os.path.join(permanent_attachments_dir, att['filename'])
-                        import shutil
-                        shutil.move(att['temp_path'], permanent_path)
-                        
-                        # 保存附件记录到数据库
-                        file_size = len(att['content'])
-                        db_manager.create_attachment(email_id, att['filename'], permanent_path, file_size)
-                
-                db_manager.disconnect()
-            
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            # 转发成功，重定向到邮件列表页面
+    user_emails = []
+    if db_manager.connect():
+        user_emails = db_manager.get_user_emails(session['user_id'])
+        db_manager.disconnect()
+    
+    if request.method == 'POST':
+        # 处理转发邮件发送（复用compose的逻辑）
+        to_email = request.form['to_email']
+        subject = request.form['subject']
+        content = request.form['content']
+        
+        success, message = queue_outgoing_email(
+            g.user,
+            request.form['from_email_id'],
+            to_email,
+            subject,
+            content,
+            request.files.getlist('attachments')
+        )
+        
+        if success:
+            # 入队成功，重定向到邮件列表页面（列表中显示投递状态）
             return redirect(url_for('mails'))
-            
-        except Exception as e:
-            # 清理临时文件
-            for att in attachment_data:
-                if os.path.exists(att['temp_path']):
-                    os.remove(att['temp_path'])
-            
-            forward_data = {
-                'to_email': to_email,
-                'subject': subject,
-                'content': content
-            }
-            return render_template('compose.html', user_emails=user_emails, user=user, error=f'邮件转发失败: {str(e)}', reply_data=forward_data, is_forward=True)
+        
+        forward_data = {
+            'to_email': to_email,
+            'subject': subject,
+            'content': content
+        }
+        return render_template('compose.html', user_emails=user_emails, user=user, error=message, reply_data=forward_data, is_forward=True)
     
     # GET请求，准备转发邮件的预填信息
     forward_data = {
@@ -1991,19 +1639,15 @@ def compose_forward(mail_id):
 
 # 用户信息页面路由
 @app.route('/profile')
+@login_required
 def profile():
     """
     用户信息页面视图函数
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 获取用户信息和绑定邮箱
-    user = None
+    user = g.user
     bound_emails = []
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
         bound_emails = db_manager.get_bound_emails(session['user_id'])
         db_manager.disconnect()
 
@@ -2017,7 +1661,7 @@ def api_mails():
     获取邮件列表的API端点
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'error': '未登录'}), 401
     
     # 获取邮件列表
@@ -2035,7 +1679,7 @@ def api_mail_detail(mail_id):
     获取邮件详情的API端点
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'error': '未登录'}), 401
     
     # 获取邮件详情
@@ -2053,7 +1697,7 @@ def api_admin_users():
     获取所有用户的API端点
     """
     # 检查用户是否已登录
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'error': '未登录'}), 401
     
     # 检查用户是否为管理员
@@ -2070,18 +1714,10 @@ def api_admin_users():
 
 # API端点：获取单个用户信息
 @app.route('/api/admin/users/<int:user_id>', methods=['GET'])
+@admin_required
 def api_get_user(user_id):
     """获取单个用户信息API"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             # 获取用户信息
             target_user = db_manager.get_user_by_id(user_id)
@@ -2116,94 +1752,162 @@ def api_get_user(user_id):
 
 
 
+def _resolve_attachment_path(attachment):
+    """
+    把附件记录中的路径解析为绝对路径，并限制在允许下载的目录内
+    返回 (绝对路径, 相对应用根目录的路径)，文件不存在或越界返回 (None, None)
+    """
+    from email_config import ATTACHMENT_ROOTS
+
+    app_root = os.path.realpath(os.getcwd())
+    candidates = [attachment['file_path']]
+    # 兼容旧数据：文件可能被放在received_emails/attachments目录中
+    candidates.append(os.path.join('received_emails', 'attachments', os.path.basename(attachment['filename'])))
+
+    for candidate in candidates:
+        real_path = os.path.realpath(candidate if os.path.isabs(candidate) else os.path.join(app_root, candidate))
+        relative_path = os.path.relpath(real_path, app_root)
+        allowed = any(relative_path == root or relative_path.startswith(root + os.sep) for root in ATTACHMENT_ROOTS)
+        if not allowed:
+            print(f"⚠️ 拒绝下载允许目录之外的文件: {real_path}")
+            continue
+        if os.path.isfile(real_path):
+            return real_path, relative_path
+
+    return None, None
+
 # 附件下载路由
 @app.route('/download_attachment/<int:attachment_id>')
+@login_required
 def download_attachment(attachment_id):
     """
     下载附件
+    鉴权后由nginx直接发送（X-Accel-Redirect模式），或由Flask流式发送（支持Range断点续传和ETag）
     """
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    # 获取附件信息
+    # 获取附件信息，并检查当前用户是否有权访问所属邮件（权限规则与邮件详情页一致）
     attachment = None
     if db_manager.connect():
         attachment = db_manager.get_attachment_by_id(attachment_id)
+        if attachment:
+            if not g.user.get('is_vip', False) and \
+                    not db_manager.get_user_email_by_id_with_isolation(attachment['email_id'], session['user_id']):
+                attachment = None
         db_manager.disconnect()
     
     if not attachment:
         return "附件不存在", 404
     
-    # 检查文件是否存在
-    file_path = attachment['file_path']
-    
-    # 标准化路径，处理各种路径格式
-    normalized_path = os.path.normpath(file_path)
-    
-    # 如果是相对路径，转换为绝对路径
-    if not os.path.isabs(normalized_path):
-        if normalized_path.startswith('./'):
-            normalized_path = os.path.join(os.getcwd(), normalized_path[2:])
-        else:
-            normalized_path = os.path.join(os.getcwd(), normalized_path)
-    
-    print(f"🔍 附件下载路径: {normalized_path}")
+    file_path, relative_path = _resolve_attachment_path(attachment)
+    if not file_path:
+        print(f"❌ 附件文件不存在: {attachment['file_path']}")
+        return "文件不存在", 404
     
-    if not os.path.exists(normalized_path):
-        # 尝试在received_emails/attachments目录中查找
-        alternative_path = os.path.join(os.getcwd(), 'received_emails', 'attachments', attachment['filename'])
-        if os.path.exists(alternative_path):
-            normalized_path = alternative_path
-            print(f"🔍 使用备用路径: {normalized_path}")
-        else:
-            print(f"❌ 文件不存在: {normalized_path}")
-            print(f"❌ 备用路径也不存在: {alternative_path}")
-            return "文件不存在", 404
-    
-    # 发送文件
-    from flask import send_file
-    return send_file(normalized_path, as_attachment=True, download_name=attachment['filename'])
+    from email_config import ATTACHMENT_ACCEL_REDIRECT, ATTACHMENT_ACCEL_PREFIX
+    if ATTACHMENT_ACCEL_REDIRECT:
+        # nginx模式：只返回内部跳转头，文件由nginx用sendfile发送（nginx自带Range支持）
+        import mimetypes
+        from urllib.parse import quote
+        
+        filename = attachment['filename']
+        ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'attachment'
+        response = Response(status=200)
+        response.headers['X-Accel-Redirect'] = ATTACHMENT_ACCEL_PREFIX + quote(relative_path.replace(os.sep, '/'))
+        response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response.headers['Content-Disposition'] = f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    # 无nginx时：条件请求 + Range，支持断点续传和浏览器缓存校验
+    response = send_file(file_path, as_attachment=True, download_name=attachment['filename'],
+                         conditional=True, etag=True, max_age=0)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# 新邮件推送（Server-Sent Events）
+@app.route('/api/stream/mails')
+@login_required
+def stream_mails():
+    """
+    推送当前用户相关的新邮件事件，替代反复刷新邮件列表
+    事件格式：id=事件ID，event=mail，data={email_id, summary}；每 SSE_HEARTBEAT_SECONDS 秒发送一次心跳注释
+    浏览器重连时自动带上 Last-Event-ID，从断开处续传；续传不了时发送 reset 事件
+    """
+    user = g.user
+    if not user:
+        return jsonify({'success': False, 'message': '用户不存在'}), 401
+
+    # 管理员和VIP在邮件列表中能看到所有邮件，推送也不按用户过滤
+    user_id = user['id']
+    see_all = bool(user.get('is_admin') or user.get('is_vip'))
+
+    if not mail_event_broker.acquire_connection(user_id):
+        response = jsonify({'success': False, 'message': '推送连接数过多，请关闭其他页面后重试'})
+        response.headers['Retry-After'] = str(SSE_HEARTBEAT_SECONDS)
+        return response, 429
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    def generate():
+        last_id = last_event_id or mail_event_broker.latest_id()
+        deadline = time.monotonic() + SSE_MAX_LIFETIME
+        yield f"retry: {SSE_HEARTBEAT_SECONDS * 1000 // 3}\n\n"
+
+        while time.monotonic() < deadline:
+            events, reset = mail_event_broker.wait_for_events(last_id, SSE_HEARTBEAT_SECONDS)
+            if reset:
+                last_id = mail_event_broker.latest_id()
+                yield f"id: {last_id}\nevent: reset\ndata: {{}}\n\n"
+                continue
+            if not events:
+                yield ": ping\n\n"
+                continue
+
+            for event in events:
+                last_id = event['id']
+                if see_all or user_id in event.get('user_ids', []):
+                    data = json.dumps({'email_id': event['email_id'], 'summary': event['summary']},
+                                      ensure_ascii=False, default=str)
+                    yield f"id: {event['id']}\nevent: mail\ndata: {data}\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止nginx缓冲，事件立即送达
+    # 连接关闭时（包括生成器未开始迭代的情况）释放连接计数
+    response.call_on_close(lambda: mail_event_broker.release_connection(user_id))
+    return response
 
 # 余额充值页面
 @app.route('/recharge')
+@login_required
 def recharge():
     """余额充值页面"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = None
+    user = g.user
     recharge_history = []
     billing_history = []
     email_stats = {}
 
+    # 到期会员由定时任务批量取消，这里不再逐个检查
     if db_manager.connect():
-        user = db_manager.get_user_by_id(session['user_id'])
-        if user:
-            # 检查并更新会员状态
-            db_manager.check_and_update_vip_status(session['user_id'])
-            # 获取更新后的用户信息
-            user = db_manager.get_user_by_id(session['user_id'])
-            # 获取充值和消费记录
-            recharge_history = db_manager.get_user_recharge_history(session['user_id'])
-            billing_history = db_manager.get_user_billing_history(session['user_id'])
-            # 获取邮件统计数据
-            email_stats = db_manager.get_monthly_email_stats(session['user_id'])
+        # 获取充值和消费记录
+        recharge_history = db_manager.get_user_recharge_history(session['user_id'])
+        billing_history = db_manager.get_user_billing_history(session['user_id'])
+        # 获取邮件统计数据
+        email_stats = db_manager.get_monthly_email_stats(session['user_id'])
         db_manager.disconnect()
 
     return render_template('recharge.html',
                          user=user,
+                         vip_quota_used=Config.vip_quota_used(user),
                          recharge_history=recharge_history,
                          billing_history=billing_history,
                          email_stats=email_stats)
 
 # 余额充值处理 - 跳转到支付方式选择
 @app.route('/recharge_balance', methods=['POST'])
+@login_required
 def recharge_balance():
     """处理余额充值 - 跳转到支付方式选择"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     amount = 0
     recharge_type = 'balance'  # 默认是余额充值
     
@@ -2231,16 +1935,11 @@ def recharge_balance():
 
 # 会员购买处理 - 跳转到支付方式选择
 @app.route('/purchase_vip', methods=['POST'])
+@login_required
 def purchase_vip():
     """处理会员购买 - 直接从余额扣费"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-
     # 检查用户余额是否足够
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
 
     if not user:
         flash('用户信息获取失败', 'error')
@@ -2248,7 +1947,6 @@ def purchase_vip():
 
     # 转换为Decimal类型进行计算
     from decimal import Decimal
-    from datetime import datetime, timedelta
     user_balance = Decimal(str(user['balance']))
     vip_cost = Decimal(str(Config.VIP_MONTHLY_COST))
 
@@ -2259,61 +1957,18 @@ def purchase_vip():
     # 直接从余额扣费购买会员
     if db_manager.connect():
         try:
-            # 开始事务
-            db_manager.cursor.execute("START TRANSACTION")
-
-            # 1. 扣除余额
-            new_balance = user_balance - vip_cost
-            balance_result = db_manager.set_user_balance(session['user_id'], float(new_balance))
-            if not balance_result:
-                raise Exception("余额更新失败")
-
-            # 2. 设置会员到期时间（续费逻辑）
-            if user.get('is_vip', False) and user.get('vip_expire_date'):
-                # 已经是VIP，在现有到期时间基础上延长
-                current_expire = user['vip_expire_date']
-                if isinstance(current_expire, str):
-                    from datetime import datetime
-                    current_expire = datetime.strptime(current_expire, '%Y-%m-%d %H:%M:%S')
+            # 扣款记流水、开通或续费会员（有效会员在现有到期时间上延长）、记录消费在同一事务内完成
+            success, message = db_manager.purchase_vip_with_balance(
+                session['user_id'], vip_cost, Config.VIP_DURATION_DAYS,
+                description=f'购买VIP会员（{Config.VIP_DURATION_DAYS}天）')
+            if not success:
+                raise Exception(message)
 
-                # 如果当前时间已经超过到期时间，从现在开始计算
-                if current_expire < datetime.now():
-                    expire_date = datetime.now() + timedelta(days=Config.VIP_DURATION_DAYS)
-                else:
-                    # 在现有到期时间基础上延长30天
-                    expire_date = current_expire + timedelta(days=Config.VIP_DURATION_DAYS)
-            else:
-                # 新购买VIP，从现在开始计算
-                expire_date = datetime.now() + timedelta(days=Config.VIP_DURATION_DAYS)
-
-            # 判断是否为续费（已经是VIP用户）
-            is_renewal = user.get('is_vip', False)
-            vip_result = db_manager.update_user_vip_status(session['user_id'], True, expire_date, reset_count=not is_renewal)
-            if not vip_result:
-                raise Exception("VIP状态更新失败")
-
-            # 3. 记录消费记录
-            billing_result = db_manager.add_billing_record(
-                user_id=session['user_id'],
-                amount=float(vip_cost),
-                type='vip',
-                description=f'购买VIP会员（{Config.VIP_DURATION_DAYS}天）'
-            )
-            if not billing_result:
-                raise Exception("消费记录添加失败")
-
-            # 提交事务
-            db_manager.cursor.execute("COMMIT")
             db_manager.disconnect()
             flash('VIP会员购买成功！', 'success')
             return redirect(url_for('recharge'))
 
         except Exception as e:
-            # 回滚事务
-            try:
-                db_manager.cursor.execute("ROLLBACK")
-            except:
-                pass
             db_manager.disconnect()
             flash(f'购买失败：{str(e)}', 'error')
             return redirect(url_for('recharge'))
@@ -2323,9 +1978,13 @@ def purchase_vip():
 
 # 验证码发送API
 @app.route('/send_verification_code', methods=['POST'])
+@rate_limit('verify_code:ip', VERIFY_CODE_IP_LIMIT, 3600, key='ip')
+@rate_limit('verify_code:user', VERIFY_CODE_USER_LIMIT, 86400, key='user',
+            message='24小时内验证码发送次数已达上限（{limit}次），请{wait}后再试')
+@rate_limit('verify_code:email', VERIFY_CODE_DAILY_LIMIT, 86400, key='email', message=VERIFY_CODE_LIMIT_MESSAGE)
 def send_verification_code():
     """发送验证码"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '请先登录'})
 
     try:
@@ -2342,50 +2001,15 @@ def send_verification_code():
         if not re.match(email_pattern, email):
             return jsonify({'success': False, 'message': '邮箱格式不正确'})
 
-        if not db_manager.connect():
-            return jsonify({'success': False, 'message': '数据库连接失败'})
-
-        # 检查每日发送限制
-        can_send, today_count = db_manager.check_verification_code_limit(session['user_id'], email, daily_limit=2)
-        if not can_send:
-            db_manager.disconnect()
-            return jsonify({
-                'success': False,
-                'message': f'今日验证码发送次数已达上限（{today_count}/2次），请明天再试。这是为了保护有限的邮件发送资源。'
-            })
-
-        # 导入必要的模块
-        from datetime import datetime, timedelta
-        import random
-
         try:
-            # 检查每日发送限制
-            can_send, sent_count, daily_limit = db_manager.check_verification_send_limit(
-                session['user_id'], email, code_type, daily_limit=2
-            )
-
-            if not can_send:
-                return jsonify({
-                    'success': False,
-                    'message': f'今日验证码发送次数已达上限（{sent_count}/{daily_limit}），请明天再试'
-                })
-
-            # 删除该用户该邮箱的旧验证码
-            db_manager.delete_user_verification_codes(session['user_id'], email, code_type)
-
-            # 生成6位验证码
-            code = str(random.randint(100000, 999999))
-
-            # 设置过期时间（10分钟）
-            expires_at = datetime.now() + timedelta(minutes=10)
-
-            # 保存验证码
-            db_manager.create_verification_code(session['user_id'], email, code, code_type, expires_at)
+            # 发送次数限制已由 rate_limit 装饰器检查
+            # 生成6位验证码（覆盖该用户该邮箱之前的验证码）
+            code = verification_store.issue(code_type, email, session['user_id'])
 
             # 发送邮件
             try:
                 # 使用系统邮箱发送验证码
-                from_email = "longgekutta@shiep.edu.kg"
+                from_email = SYSTEM_FROM_EMAIL
                 subject = "邮箱绑定验证码"
                 content = f"""
                 <html>
@@ -2394,7 +2018,7 @@ def send_verification_code():
                     <p>您好！</p>
                     <p>您正在进行邮箱绑定操作，验证码为：</p>
                     <h3 style="color: #007bff; font-size: 24px; letter-spacing: 2px;">{code}</h3>
-                    <p>验证码有效期为10分钟，请及时使用。</p>
+                    <p>验证码有效期为{verification_store.ttl_minutes}分钟，请及时使用。</p>
                     <p>如果这不是您的操作，请忽略此邮件。</p>
                     <br>
                     <p>邮箱监控系统</p>
@@ -2408,27 +2032,20 @@ def send_verification_code():
                 if not send_success:
                     return jsonify({'success': False, 'message': '邮件发送失败，请稍后重试'})
 
-                print(f"验证码已发送到 {email}: {code}")
-
-                # 记录验证码发送日志
-                client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
-                db_manager.log_verification_code_sent(session['user_id'], email, code_type, client_ip)
+                print(f"验证码已发送到 {email}")
 
             except Exception as e:
                 print(f"邮件发送异常: {str(e)}")
                 return jsonify({'success': False, 'message': '邮件发送失败，请检查邮箱地址'})
 
-            # 获取剩余发送次数
-            stats = db_manager.get_user_verification_code_stats(session['user_id'])
-            db_manager.disconnect()
-
-            return jsonify({
-                'success': True,
-                'message': f'验证码已发送！今日剩余发送次数：{stats["remaining_count"]}/2'
-            })
+            # 关闭限流（RATE_LIMIT_ENABLED=False）时装饰器不计数，没有剩余次数
+            remaining = getattr(g, 'rate_limit_remaining', {}).get('verify_code:email')
+            message = '验证码已发送！'
+            if remaining is not None:
+                message += f'24小时内剩余发送次数：{remaining}/{VERIFY_CODE_DAILY_LIMIT}'
+            return jsonify({'success': True, 'message': message})
 
         except Exception as e:
-            db_manager.disconnect()
             return jsonify({'success': False, 'message': f'发送失败：{str(e)}'})
 
     except Exception as e:
@@ -2438,7 +2055,7 @@ def send_verification_code():
 @app.route('/verify_and_bind_email', methods=['POST'])
 def verify_and_bind_email():
     """验证并绑定邮箱"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '请先登录'})
 
     try:
@@ -2449,19 +2066,14 @@ def verify_and_bind_email():
         if not email or not code:
             return jsonify({'success': False, 'message': '邮箱地址和验证码不能为空'})
 
+        # 验证验证码（校验通过即作废）
+        if not verification_store.verify('email_binding', email, code, session['user_id']):
+            return jsonify({'success': False, 'message': '验证码无效或已过期'})
+
         if not db_manager.connect():
             return jsonify({'success': False, 'message': '数据库连接失败'})
 
         try:
-            # 验证验证码
-            code_info = db_manager.get_verification_code(session['user_id'], email, code, 'email_binding')
-
-            if not code_info:
-                return jsonify({'success': False, 'message': '验证码无效或已过期'})
-
-            # 删除验证码（绑定成功后删除）
-            db_manager.delete_verification_code(code_info['id'])
-
             # 绑定邮箱
             result = db_manager.add_bound_email(session['user_id'], email)
 
@@ -2481,6 +2093,8 @@ def verify_and_bind_email():
 
 # 发送登录验证码API
 @app.route('/send_login_verification_code', methods=['POST'])
+@rate_limit('verify_code:ip', VERIFY_CODE_IP_LIMIT, 3600, key='ip')
+@rate_limit('verify_code:email', VERIFY_CODE_DAILY_LIMIT, 86400, key='email', message=VERIFY_CODE_LIMIT_MESSAGE)
 def send_login_verification_code():
     """发送登录验证码"""
     try:
@@ -2499,53 +2113,19 @@ def send_login_verification_code():
         if not db_manager.connect():
             return jsonify({'success': False, 'message': '数据库连接失败'})
 
-        # 导入必要的模块
-        from datetime import datetime, timedelta
-        import random
-
         try:
-            # 设置验证码类型
-            code_type = 'login'
-
             # 检查邮箱是否已绑定
             user = db_manager.get_user_by_bound_email(email)
+            db_manager.disconnect()
             if not user:
                 return jsonify({'success': False, 'message': '该邮箱未绑定任何账户'})
 
-            # 检查每日发送限制
-            can_send, today_count = db_manager.check_verification_code_limit(user['id'], email, daily_limit=2)
-            if not can_send:
-                db_manager.disconnect()
-                return jsonify({
-                    'success': False,
-                    'message': f'今日验证码发送次数已达上限（{today_count}/2次），请明天再试。'
-                })
-
-                # 检查60秒间隔
-                if limit_info['last_sent_at']:
-                    time_diff = datetime.now() - limit_info['last_sent_at']
-                    if time_diff.total_seconds() < 60:
-                        remaining = 60 - int(time_diff.total_seconds())
-                        return jsonify({'success': False, 'message': f'请等待{remaining}秒后再发送'})
-
-            # 删除该邮箱的旧登录验证码
-            db_manager.delete_user_verification_codes(None, email, code_type)
-
-            # 生成6位验证码
-            code = str(random.randint(100000, 999999))
-
-            # 设置过期时间（10分钟）
-            expires_at = datetime.now() + timedelta(minutes=10)
-
-            # 保存验证码
-            db_manager.create_verification_code(user['id'], email, code, 'login', expires_at)
-
-            # 更新发送限制
-            db_manager.update_verification_limit(user['id'], email, 'login')
+            # 生成6位验证码（覆盖该邮箱之前的登录验证码）
+            code = verification_store.issue('login', email, user['id'])
 
             # 发送邮件
             try:
-                from_email = "longgekutta@shiep.edu.kg"
+                from_email = SYSTEM_FROM_EMAIL
                 subject = "登录验证码"
                 content = f"""
                 <html>
@@ -2554,7 +2134,7 @@ def send_login_verification_code():
                     <p>您好！</p>
                     <p>您正在使用邮箱验证码登录，验证码为：</p>
                     <h3 style="color: #28a745; font-size: 24px; letter-spacing: 2px;">{code}</h3>
-                    <p>验证码有效期为10分钟，请及时使用。</p>
+                    <p>验证码有效期为{verification_store.ttl_minutes}分钟，请及时使用。</p>
                     <p>如果这不是您的操作，请忽略此邮件。</p>
                     <br>
                     <p>邮箱监控系统</p>
@@ -2567,24 +2147,18 @@ def send_login_verification_code():
                 if not send_success:
                     return jsonify({'success': False, 'message': '邮件发送失败，请稍后重试'})
 
-                print(f"登录验证码已发送到 {email}: {code}")
-
-                # 记录验证码发送日志
-                client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
-                db_manager.log_verification_code_sent(user['id'], email, code_type, client_ip)
+                print(f"登录验证码已发送到 {email}")
 
             except Exception as e:
                 print(f"邮件发送异常: {str(e)}")
                 return jsonify({'success': False, 'message': '邮件发送失败，请检查邮箱地址'})
 
-            # 获取剩余发送次数
-            stats = db_manager.get_user_verification_code_stats(user['id'])
-            db_manager.disconnect()
-
-            return jsonify({
-                'success': True,
-                'message': f'验证码已发送！今日剩余发送次数：{stats["remaining_count"]}/2'
-            })
+            # 关闭限流（RATE_LIMIT_ENABLED=False）时装饰器不计数，没有剩余次数
+            remaining = getattr(g, 'rate_limit_remaining', {}).get('verify_code:email')
+            message = '验证码已发送！'
+            if remaining is not None:
+                message += f'24小时内剩余发送次数：{remaining}/{VERIFY_CODE_DAILY_LIMIT}'
+            return jsonify({'success': True, 'message': message})
 
         except Exception as e:
             db_manager.disconnect()
@@ -2595,6 +2169,8 @@ def send_login_verification_code():
 
 # 邮箱验证码登录API
 @app.route('/email_login', methods=['POST'])
+@rate_limit('login:ip', LOGIN_IP_LIMIT, 300, key='ip', message='登录尝试过于频繁，请{wait}后再试')
+@rate_limit('email_login:email', LOGIN_ACCOUNT_LIMIT, 300, key='email', message='该邮箱登录尝试过于频繁，请{wait}后再试')
 def email_login():
     """邮箱验证码登录"""
     try:
@@ -2614,15 +2190,10 @@ def email_login():
             if not user:
                 return jsonify({'success': False, 'message': '该邮箱未绑定任何账户'})
 
-            # 验证验证码
-            code_info = db_manager.get_verification_code(user['id'], email, code, 'login')
-
-            if not code_info:
+            # 验证验证码（校验通过即作废）
+            if not verification_store.verify('login', email, code, user['id']):
                 return jsonify({'success': False, 'message': '验证码无效或已过期'})
 
-            # 标记验证码为已使用
-            db_manager.use_verification_code(code_info['id'])
-
             # 设置session
             session['user_id'] = user['id']
             session['username'] = user['username']
@@ -2646,7 +2217,7 @@ def email_login():
 @app.route('/reset_password_after_email_login', methods=['GET', 'POST'])
 def reset_password_after_email_login():
     """邮箱登录后的密码重置"""
-    if 'user_id' not in session or not session.get('email_login'):
+    if g.user is None or not session.get('email_login'):
         return redirect(url_for('login'))
 
     if request.method == 'POST':
@@ -2699,7 +2270,7 @@ def reset_password_after_email_login():
 @app.route('/change_password', methods=['POST'])
 def change_password():
     """修改密码"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '请先登录'})
 
     try:
@@ -2721,10 +2292,8 @@ def change_password():
             return jsonify({'success': False, 'message': '数据库连接失败'})
 
         try:
-            # 获取用户信息验证当前密码
-            user = db_manager.get_user_by_username(session['username'])
-            if not user:
-                return jsonify({'success': False, 'message': '用户信息获取失败'})
+            # 验证当前密码
+            user = g.user
 
             # 验证当前密码（使用统一验证函数）
             if not verify_password(current_password, user['password'], user['id']):
@@ -2758,31 +2327,24 @@ def change_password():
 
 # 支付方式选择页面
 @app.route('/pay_select')
+@login_required
 def pay_select():
     """支付方式选择页面"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查是否有待支付订单
     pending_payment = session.get('pending_payment')
     if not pending_payment:
         flash('无效的支付请求', 'error')
         return redirect(url_for('recharge'))
     
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     return render_template('pay_select.html', user=user, payment=pending_payment)
 
 # 支付确认页面 - 易支付集成
 @app.route('/pay_confirm/<payment_method>')
+@login_required
 def pay_confirm(payment_method):
     """支付确认页面 - 易支付集成版本"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查是否有待支付订单
     pending_payment = session.get('pending_payment')
     if not pending_payment:
@@ -2799,13 +2361,19 @@ def pay_confirm(payment_method):
         flash('微信支付暂时不可用，已为您切换到支付宝支付', 'info')
         return redirect(url_for('pay_confirm', payment_method='alipay'))
     
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
-    # 生成订单号
+    # 生成订单号并创建支付订单（异步通知按订单号入账）
     order_id = YiPayUtil.generate_order_no()
+    if not db_manager.connect():
+        flash('数据库连接失败', 'error')
+        return redirect(url_for('pay_select'))
+    created = db_manager.create_payment_order(order_id, session['user_id'], pending_payment['type'],
+                                              pending_payment['amount'], payment_method)
+    db_manager.disconnect()
+    if created != 1:
+        flash('创建支付订单失败，请重试', 'error')
+        return redirect(url_for('pay_select'))
 
     # 保存订单号到session
     session['pending_payment']['order_id'] = order_id
@@ -2827,7 +2395,10 @@ def pay_confirm(payment_method):
 # 易支付异步通知处理
 @app.route('/payment/notify', methods=['POST', 'GET'])
 def yipay_notify():
-    """易支付异步通知处理"""
+    """
+    易支付异步通知处理：验签后把订单标记为已支付并立即返回 success
+    入账由 settlement_worker 后台线程完成，回调不等待余额更新，数据库慢时也不会让易支付超时重试
+    """
     try:
         # 获取通知参数（支持GET和POST）
         if request.method == 'POST':
@@ -2835,71 +2406,41 @@ def yipay_notify():
         else:
             params = request.args.to_dict()
         
-        print(f"💰 收到易支付通知: {params}")
-        
         # 验证必要参数
         required_params = ['pid', 'trade_no', 'out_trade_no', 'type', 'name', 'money', 'trade_status', 'sign']
         for param in required_params:
             if param not in params:
-                print(f"❌ 缺少必要参数: {param}")
+                print(f"❌ 易支付通知缺少必要参数: {param}")
                 return "fail", 400
         
+        order_no = params['out_trade_no']
+
         # 验证商户PID
         if params['pid'] != YIPAY_PID:
-            print(f"❌ 商户PID不匹配: {params['pid']} != {YIPAY_PID}")
+            print(f"❌ 订单 {order_no} 商户PID不匹配")
             return "fail", 400
         
         # 验签
         if not YiPayUtil.verify_sign(params, YIPAY_KEY):
-            print("❌ 签名验证失败")
+            print(f"❌ 订单 {order_no} 签名验证失败")
             return "fail", 400
         
         # 检查支付状态
         if params['trade_status'] != 'TRADE_SUCCESS':
-            print(f"❌ 支付未成功: {params['trade_status']}")
-            return "fail", 400
-        
-        # 处理支付成功逻辑
-        order_no = params['out_trade_no']
-        amount = float(params['money'])
-        payment_type = params['type']  # alipay, wxpay等
-        trade_no = params['trade_no']  # 易支付平台订单号
-        param = params.get('param', '')  # 业务参数
-        
-        print(f"✅ 支付成功:")
-        print(f"   订单号: {order_no}")
-        print(f"   金额: ¥{amount}")
-        print(f"   支付方式: {payment_type}")
-        print(f"   平台订单号: {trade_no}")
-        print(f"   业务参数: {param}")
-        
-        # 解析业务参数
-        user_id = None
-        charge_type = None
-        if param:
-            try:
-                param_parts = param.split(',')
-                for part in param_parts:
-                    if part.startswith('user_id:'):
-                        user_id = int(part.split(':')[1])
-                    elif part.startswith('type:'):
-                        charge_type = part.split(':')[1]
-            except:
-                print("⚠️ 解析业务参数失败")
-        
-        if not user_id or not charge_type:
-            print("❌ 无法获取用户ID或充值类型")
+            print(f"❌ 订单 {order_no} 支付未成功: {params['trade_status']}")
             return "fail", 400
         
-        # 执行充值逻辑
-        success = process_yipay_payment(user_id, order_no, amount, payment_type, charge_type, trade_no)
-        
-        if success:
-            print("✅ 充值处理成功")
+        result = enqueue_yipay_payment(order_no, params['money'], params['type'], params['trade_no'],
+                                       params.get('param', ''))
+        if result in ('queued', 'duplicate'):
+            print(f"💰 订单 {order_no} 支付通知已确认（{result}）")
             return "success"
-        else:
-            print("❌ 充值处理失败")
+        elif result == 'error':
+            print(f"❌ 订单 {order_no} 支付通知处理失败，等待易支付重试")
             return "fail", 500
+        else:
+            print(f"❌ 订单 {order_no} 支付通知处理失败: {result}")
+            return "fail", 400
             
     except Exception as e:
         print(f"❌ 处理易支付通知异常: {str(e)}")
@@ -2911,7 +2452,7 @@ def yipay_return():
     """易支付同步回调处理（页面跳转）"""
     try:
         params = request.args.to_dict()
-        print(f"🔄 收到易支付同步回调: {params}")
+        print(f"🔄 收到易支付同步回调: 订单 {params.get('out_trade_no', '未知')}")
         
         # 基本验证
         if 'out_trade_no' in params and 'trade_status' in params:
@@ -2933,60 +2474,57 @@ def yipay_return():
         flash('支付处理异常，请联系客服', 'error')
         return redirect(url_for('recharge'))
 
-def process_yipay_payment(user_id, order_no, amount, payment_type, charge_type, trade_no):
-    """处理易支付成功的支付"""
+def parse_yipay_param(param):
+    """解析下单时附带的业务参数 "user_id:1,type:balance"，返回 (user_id, charge_type)"""
+    user_id = None
+    charge_type = None
+    for part in (param or '').split(','):
+        try:
+            if part.startswith('user_id:'):
+                user_id = int(part.split(':')[1])
+            elif part.startswith('type:'):
+                charge_type = part.split(':')[1]
+        except (IndexError, ValueError):
+            print("⚠️ 解析业务参数失败")
+    return user_id, charge_type
+
+def enqueue_yipay_payment(order_no, money, payment_type, trade_no, param=''):
+    """
+    标记订单已支付（created -> paid）并唤醒结算线程
+    返回 queued（本次标记）/ duplicate（重复通知）/ not_found / error
+    """
     try:
         if not db_manager.connect():
-            return False
-        
-        # 检查订单是否已处理（防止重复处理）
-        check_query = "SELECT COUNT(*) as count FROM recharge_records WHERE description LIKE %s"
-        check_params = (f"%{order_no}%",)
-        existing = db_manager.execute_query(check_query, check_params)
-        
-        if existing and existing[0]['count'] > 0:
-            print(f"⚠️ 订单 {order_no} 已处理，跳过重复处理")
-            db_manager.disconnect()
-            return True
-        
-        # 根据充值类型处理
-        if charge_type == 'balance':
-            # 余额充值
-            success = db_manager.update_user_balance(user_id, amount)
-            if success:
-                description = f"易支付余额充值¥{amount:.2f}（{payment_type}，订单号:{order_no}，平台单号:{trade_no}）"
-                db_manager.add_recharge_record(user_id, 'balance', amount, description)
-                print(f"✅ 用户 {user_id} 余额充值成功: +¥{amount:.2f}")
-                return True
-                
-        elif charge_type == 'vip':
-            # 会员购买
-            from datetime import timedelta
-            expire_date = datetime.now() + timedelta(days=30)
-            success = db_manager.set_user_vip(user_id, expire_date)
-            
-            if success:
-                description = f"易支付会员购买¥{amount:.2f}（{payment_type}，订单号:{order_no}，平台单号:{trade_no}）"
-                db_manager.add_recharge_record(user_id, 'vip', amount, description)
-                print(f"✅ 用户 {user_id} 会员开通成功，有效期至: {expire_date}")
-                return True
-        
-        db_manager.disconnect()
-        return False
-        
+            return 'error'
+
+        marked = db_manager.mark_payment_order_paid(order_no, trade_no, money, payment_type)
+        if marked < 0:
+            return 'error'
+        if marked == 0:
+            if db_manager.get_payment_order(order_no):
+                return 'duplicate'
+            # 兼容上线前生成、没有订单记录的订单号：用已验签的业务参数补建已支付订单
+            user_id, charge_type = parse_yipay_param(param)
+            if not user_id or charge_type not in ('balance', 'vip'):
+                return 'not_found'
+            if db_manager.create_paid_payment_order(order_no, user_id, charge_type, money,
+                                                    payment_type, trade_no) < 0:
+                return 'error'
+
+        settlement_worker.notify()
+        return 'queued'
+
     except Exception as e:
         print(f"❌ 处理支付异常: {str(e)}")
-        if db_manager.connection and db_manager.connection.is_connected():
-            db_manager.disconnect()
-        return False
+        return 'error'
+    finally:
+        db_manager.disconnect()
 
 # 支付完成确认
 @app.route('/pay_complete', methods=['POST'])
+@login_required
 def pay_complete():
     """支付完成确认 - 支持混合支付方式"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查是否有待支付订单
     pending_payment = session.get('pending_payment')
     if not pending_payment:
@@ -3093,16 +2631,11 @@ def alipay_qr():
 
 # 管理员待确认支付页面
 @app.route('/admin/pending_payments')
+@login_required
 def admin_pending_payments():
     """管理员待确认支付页面"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
     # 检查管理员权限
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
     
     if not user or not user.get('is_vip', False):
         return "权限不足", 403
@@ -3144,19 +2677,17 @@ def admin_pending_payments():
 @app.route('/admin/confirm_payment/<int:payment_id>', methods=['POST'])
 def admin_confirm_payment(payment_id):
     """管理员确认支付"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '未授权'})
     
     # 检查管理员权限
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-    
+    user = g.user
     if not user or not user.get('is_vip', False):
-        if db_manager.connection and db_manager.connection.is_connected():
-            db_manager.disconnect()
         return jsonify({'success': False, 'message': '权限不足'})
     
+    if not db_manager.connect():
+        return jsonify({'success': False, 'message': '数据库连接失败'})
+    
     # 获取管理员备注
     admin_note = request.json.get('admin_note', '') if request.is_json else request.form.get('admin_note', '')
     
@@ -3172,19 +2703,17 @@ def admin_confirm_payment(payment_id):
 @app.route('/admin/cancel_payment/<int:payment_id>', methods=['POST'])
 def admin_cancel_payment(payment_id):
     """管理员取消支付"""
-    if 'user_id' not in session:
+    if g.user is None:
         return jsonify({'success': False, 'message': '未授权'})
     
     # 检查管理员权限
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-    
+    user = g.user
     if not user or not user.get('is_vip', False):
-        if db_manager.connection and db_manager.connection.is_connected():
-            db_manager.disconnect()
         return jsonify({'success': False, 'message': '权限不足'})
     
+    if not db_manager.connect():
+        return jsonify({'success': False, 'message': '数据库连接失败'})
+    
     # 获取管理员备注
     admin_note = request.json.get('admin_note', '') if request.is_json else request.form.get('admin_note', '')
     
@@ -3267,21 +2796,24 @@ def process_auto_payment(order_id, amount, payment_info):
 
             # 执行充值逻辑
             if payment_type == 'balance':
-                # 余额充值
-                success = db_manager.update_user_balance(user_id, amount)
+                # 余额充值（和管理员确认共用待支付记录ID作为流水引用，同一订单只入账一次）
+                # 入账和充值记录同一事务
+                description = f"支付宝自动充值¥{amount:.2f}（订单号:{order_id}）"
+                success, message = db_manager.credit_balance(user_id, amount, 'payment',
+                                                             f"pending:{pending_order['id']}", '支付宝自动充值',
+                                                             record=('balance', description))
+                if not success and message == LEDGER_DUPLICATE:
+                    print(f"⚠️ 订单 {order_id} 已入账，跳过重复处理")
+                    return True
                 if success:
-                    description = f"支付宝自动充值¥{amount:.2f}（订单号:{order_id}）"
-                    db_manager.add_recharge_record(user_id, 'balance', amount, description)
                     print(f"✅ 用户 {user_id} 余额充值成功: +¥{amount:.2f}")
 
             elif payment_type == 'vip':
-                # 会员购买
-                from datetime import timedelta
-                expire_date = datetime.now() + timedelta(days=30)
-                success = db_manager.set_user_vip(user_id, expire_date)
+                # 会员购买（开通和购买记录同一事务）
+                description = f"支付宝自动开通会员¥{amount:.2f}（订单号:{order_id}）"
+                expire_date = db_manager.set_user_vip(user_id, record=(amount, description))
+                success = expire_date is not None
                 if success:
-                    description = f"支付宝自动开通会员¥{amount:.2f}（订单号:{order_id}）"
-                    db_manager.add_recharge_record(user_id, 'vip', amount, description)
                     print(f"✅ 用户 {user_id} 会员开通成功，有效期至: {expire_date}")
             else:
                 print(f"❌ 未知的支付类型: {payment_type}")
@@ -3316,17 +2848,11 @@ def process_auto_payment(order_id, amount, payment_info):
 
 # 管理员邮件管理页面路由
 @app.route('/admin/emails')
+@login_required
 def admin_emails():
     """管理员邮件管理页面"""
-    # 检查用户是否已登录
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-
     # 检查管理员权限
-    user = None
-    if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        db_manager.disconnect()
+    user = g.user
 
     if not user or not user.get('is_admin', False):
         return "权限不足", 403
@@ -3374,18 +2900,10 @@ def admin_emails():
 
 # 管理员删除邮件API
 @app.route('/api/admin/emails/<int:email_id>/delete', methods=['POST'])
+@admin_required
 def api_delete_email(email_id):
     """删除邮件API"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 删除邮件
         success = db_manager.delete_email(email_id)
         db_manager.disconnect()
@@ -3401,18 +2919,10 @@ def api_delete_email(email_id):
 
 # 获取未使用的注册码API
 @app.route('/api/admin/unused_registration_codes')
+@admin_required
 def api_get_unused_registration_codes():
     """获取所有未使用的注册码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 获取未使用的注册码
         codes = db_manager.get_unused_registration_codes()
         db_manager.disconnect()
@@ -3423,18 +2933,10 @@ def api_get_unused_registration_codes():
 
 # 获取未使用的充值码API
 @app.route('/api/admin/unused_recharge_codes/<float:amount>')
+@admin_required
 def api_get_unused_recharge_codes(amount):
     """获取指定面额的未使用充值码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 获取未使用的充值码
         codes = db_manager.get_unused_recharge_codes_by_amount(amount)
         db_manager.disconnect()
@@ -3445,18 +2947,11 @@ def api_get_unused_recharge_codes(amount):
 
 # 生成充值码API
 @app.route('/api/admin/generate_recharge_codes', methods=['POST'])
+@admin_required
 def api_generate_recharge_codes():
     """生成充值码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
+    user = g.user
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             data = request.get_json()
             amount = float(data.get('amount', 0))
@@ -3466,34 +2961,22 @@ def api_generate_recharge_codes():
             if amount <= 0 or count <= 0:
                 return jsonify({'success': False, 'message': '参数无效'})
 
-            if count > 500:
-                return jsonify({'success': False, 'message': '一次最多只能生成500个充值码'})
-
-            # 生成充值码
-            import random
-            import string
-            generated_codes = []
-
-            for i in range(count):
-                # 生成唯一的充值码
-                while True:
-                    code = f'RC{amount:g}' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-                    # 检查是否已存在
-                    existing = db_manager.get_recharge_code_by_code(code)
-                    if not existing:
-                        break
-
-                # 创建充值码
-                result = db_manager.create_recharge_code(code, amount, description, user['id'])
-                if result > 0:
-                    generated_codes.append(code)
+            if count > MAX_CODES_PER_BATCH:
+                return jsonify({'success': False, 'message': f'一次最多只能生成{MAX_CODES_PER_BATCH}个充值码'})
 
+            # 批量生成充值码（同一事务内多行插入，冲突的码重新生成）
+            success, message, batch_no, codes = issue_codes(db_manager, 'recharge', count, description,
+                                                            user['id'], amount)
             db_manager.disconnect()
 
-            if len(generated_codes) == count:
-                return jsonify({'success': True, 'message': f'成功生成 {count} 个充值码', 'codes': generated_codes})
-            else:
-                return jsonify({'success': False, 'message': f'只成功生成 {len(generated_codes)} 个充值码'})
+            if not success:
+                return jsonify({'success': False, 'message': message})
+            result = {'success': True, 'message': f'成功生成 {count} 个充值码', 'batch_no': batch_no,
+                      'export_url': url_for('api_export_code_batch', kind='recharge', batch_no=batch_no)}
+            # 大批量只返回批次号，码通过CSV导出下载
+            if count <= 500:
+                result['codes'] = codes
+            return jsonify(result)
 
         except Exception as e:
             db_manager.disconnect()
@@ -3501,20 +2984,38 @@ def api_generate_recharge_codes():
     else:
         return jsonify({'success': False, 'message': '数据库连接失败'})
 
+# 生成批次列表API
+@app.route('/api/admin/code_batches/<kind>')
+@admin_required
+def api_get_code_batches(kind):
+    """最近的注册码/充值码生成批次"""
+    if kind not in CODE_KINDS:
+        return jsonify({'success': False, 'message': '未知的码类型'}), 404
+    if db_manager.connect():
+        batches = db_manager.get_code_batches(kind)
+        db_manager.disconnect()
+        for batch in batches:
+            batch['export_url'] = url_for('api_export_code_batch', kind=kind, batch_no=batch['batch_no'])
+        return jsonify({'success': True, 'batches': batches})
+    else:
+        return jsonify({'success': False, 'message': '数据库连接失败'})
+
+# 按批次导出CSV
+@app.route('/api/admin/code_batches/<kind>/<batch_no>/export.csv')
+@admin_required
+def api_export_code_batch(kind, batch_no):
+    """流式导出一个批次的注册码/充值码（逐段查询输出，适合上万个码的批次）"""
+    if kind not in CODE_KINDS or not batch_no.isalnum():
+        return jsonify({'success': False, 'message': '批次不存在'}), 404
+    return Response(stream_batch_csv(kind, batch_no), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={kind}_codes_{batch_no}.csv'})
+
 # 获取充值码列表API
 @app.route('/api/admin/recharge_codes')
+@admin_required
 def api_get_recharge_codes():
     """获取充值码列表"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         try:
             page = int(request.args.get('page', 1))
             per_page = 20
@@ -3551,18 +3052,10 @@ def api_get_recharge_codes():
 
 # 删除充值码API
 @app.route('/api/admin/recharge_codes/<code>/delete', methods=['POST'])
+@admin_required
 def api_delete_recharge_code(code):
     """删除充值码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 删除充值码
         result = db_manager.delete_recharge_code(code)
         db_manager.disconnect()
@@ -3576,18 +3069,10 @@ def api_delete_recharge_code(code):
 
 # 批量删除已使用充值码API
 @app.route('/api/admin/recharge_codes/delete_used', methods=['POST'])
+@admin_required
 def api_delete_used_recharge_codes():
     """批量删除已使用的充值码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
         # 批量删除已使用的充值码
         deleted_count = db_manager.delete_used_recharge_codes()
         db_manager.disconnect()
@@ -3608,11 +3093,9 @@ XIANYU_LINKS = {
 
 # 获取咸鱼购买链接API
 @app.route('/api/xianyu_link/<int:amount>')
+@login_required
 def api_get_xianyu_link(amount):
     """获取指定金额的咸鱼购买链接"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
     if amount in XIANYU_LINKS:
         return jsonify({'success': True, 'link': XIANYU_LINKS[amount]})
     else:
@@ -3620,11 +3103,9 @@ def api_get_xianyu_link(amount):
 
 # 充值码兑换API
 @app.route('/api/redeem_code', methods=['POST'])
+@login_required
 def api_redeem_code():
     """兑换充值码"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
     try:
         data = request.get_json()
         code = data.get('code', '').strip().upper()
@@ -3644,25 +3125,12 @@ def api_redeem_code():
                 db_manager.disconnect()
                 return jsonify({'success': False, 'message': '充值码已被使用'})
 
-            # 使用充值码
-            use_result = db_manager.use_recharge_code(code, session['user_id'])
+            # 标记充值码已使用、入账并记录充值（同一事务，并发兑换同一个码只有一个成功）
+            redeemed, redeem_msg, amount = db_manager.redeem_recharge_code(code, session['user_id'])
 
-            if use_result > 0:
-                # 获取用户当前余额
-                user = db_manager.get_user_by_id(session['user_id'])
-                current_balance = float(user.get('balance', 0))
-                new_balance = current_balance + float(recharge_code['amount'])
-
-                # 更新用户余额
-                db_manager.set_user_balance(session['user_id'], new_balance)
-
-                # 记录充值记录
-                db_manager.add_billing_record(
-                    user_id=session['user_id'],
-                    amount=float(recharge_code['amount']),
-                    type='recharge_code',
-                    description=f'充值码兑换：{code}'
-                )
+            if redeemed:
+                user = g.user
+                new_balance = float(user.get('balance', 0)) + float(amount)
 
                 db_manager.disconnect()
 
@@ -3676,7 +3144,7 @@ def api_redeem_code():
                 })
             else:
                 db_manager.disconnect()
-                return jsonify({'success': False, 'message': '充值码使用失败'})
+                return jsonify({'success': False, 'message': redeem_msg})
         else:
             return jsonify({'success': False, 'message': '数据库连接失败'})
 
@@ -3687,17 +3155,10 @@ def api_redeem_code():
 
 # 管理员配置咸鱼链接API
 @app.route('/api/admin/xianyu_links', methods=['GET', 'POST'])
+@admin_required
 def api_admin_xianyu_links():
     """管理员配置咸鱼链接"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
-    # 检查管理员权限
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
         db_manager.disconnect()
     else:
         return jsonify({'success': False, 'message': '数据库连接失败'})
@@ -3745,11 +3206,9 @@ def cleanup_user_mailbox_if_needed(user_id):
 
 # API端点：获取用户邮箱使用情况
 @app.route('/api/mailbox_usage')
+@login_required
 def api_get_mailbox_usage():
     """获取当前用户邮箱使用情况"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
     usage = check_user_mailbox_capacity(session['user_id'])
     if usage:
         # 检查是否超出限制
@@ -3767,11 +3226,9 @@ def api_get_mailbox_usage():
 
 # API端点：手动清理邮箱
 @app.route('/api/cleanup_mailbox', methods=['POST'])
+@login_required
 def api_cleanup_mailbox():
     """手动清理用户邮箱"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
-
     deleted_count = cleanup_user_mailbox_if_needed(session['user_id'])
 
     if deleted_count > 0:
@@ -3787,44 +3244,244 @@ def api_cleanup_mailbox():
             'deleted_count': 0
         })
 
-# 定时清理任务（可以通过cron或其他方式调用）
+# ========== 后台任务 ==========
+
+register_maintenance_jobs(job_scheduler)
+
+def enqueue_job(name):
+    """手动触发后台任务，返回JSON响应"""
+    if name not in job_scheduler.jobs:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    if not db_manager.connect():
+        return jsonify({'success': False, 'message': '数据库连接失败'}), 500
+    success, message, run_id = job_scheduler.enqueue(db_manager, name)
+    db_manager.disconnect()
+    if not success:
+        return jsonify({'success': False, 'message': message}), 409 if run_id == 0 else 500
+    return jsonify({'success': True, 'message': message, 'run_id': run_id})
+
+# API端点：清理所有超限邮箱（由后台任务执行，结果见 /api/admin/jobs/mailbox_capacity_sweep/runs）
 @app.route('/api/admin/cleanup_all_mailboxes', methods=['POST'])
+@admin_required
 def api_cleanup_all_mailboxes():
     """管理员清理所有超限邮箱"""
-    if 'user_id' not in session:
-        return jsonify({'success': False, 'message': '请先登录'}), 401
+    return enqueue_job('mailbox_capacity_sweep')
 
-    # 检查管理员权限
+# API端点：后台任务列表
+@app.route('/api/admin/jobs')
+@admin_required
+def api_list_jobs():
+    """所有定时任务的计划、下次执行时间和最近一次执行结果"""
+    if not db_manager.connect():
+        return jsonify({'success': False, 'message': '数据库连接失败'}), 500
+    jobs = db_manager.get_scheduled_jobs()
+    db_manager.disconnect()
+    return jsonify({'success': True, 'node': job_scheduler.node_id, 'is_leader': job_scheduler.is_leader, 'jobs': jobs})
+
+# API端点：后台任务执行记录
+@app.route('/api/admin/jobs/<name>/runs')
+@admin_required
+def api_job_runs(name):
+    """任务最近的执行记录（节点、耗时、结果或错误），最多200条"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    if not db_manager.connect():
+        return jsonify({'success': False, 'message': '数据库连接失败'}), 500
+    runs = db_manager.get_job_runs(name, limit)
+    db_manager.disconnect()
+    return jsonify({'success': True, 'runs': runs})
+
+# API端点：立即执行后台任务
+@app.route('/api/admin/jobs/<name>/run', methods=['POST'])
+@admin_required
+def api_run_job(name):
+    """立即执行一次任务（加入队列，由任一节点的工作线程执行）"""
+    return enqueue_job(name)
+
+# ========== 邮件接收死信队列管理 ==========
+
+dead_letter_store = DeadLetterStore()
+
+# API端点：死信列表
+@app.route('/api/admin/dead_letters')
+@admin_required
+def api_list_dead_letters():
+    """列出处理失败的邮件（可按状态过滤：pending/retrying/exhausted）"""
+    status = request.args.get('status') or None
+    entries = dead_letter_store.list_entries(status)
+    return jsonify({
+        'success': True,
+        'entries': entries,
+        'summary': dead_letter_store.get_summary()
+    })
+
+# API端点：重放死信
+@app.route('/api/admin/dead_letters/<entry_id>/replay', methods=['POST'])
+@admin_required
+def api_replay_dead_letter(entry_id):
+    """立即重放一封死信邮件，由监控器工作线程重新处理"""
+    entry = dead_letter_store.replay(entry_id)
+    if not entry:
+        return jsonify({'success': False, 'message': '死信不存在'}), 404
+    return jsonify({'success': True, 'message': '已安排重放', 'entry': entry})
+
+# API端点：清除死信
+@app.route('/api/admin/dead_letters/purge', methods=['POST'])
+@admin_required
+def api_purge_dead_letters():
+    """清除死信：可指定entry_id或status，不指定则清除全部"""
+    data = request.get_json(silent=True) or {}
+    deleted_count = dead_letter_store.purge(data.get('entry_id'), data.get('status'))
+    return jsonify({'success': True, 'message': f'已清除 {deleted_count} 封死信', 'deleted_count': deleted_count})
+
+# API端点：外部HTTP连接池统计
+@app.route('/api/admin/http_stats')
+@admin_required
+def api_http_stats():
+    """Resend、易支付等外部接口的请求数、重试数和连接复用率"""
+    from http_transport import http_transport
+    return jsonify({'success': True, 'hosts': http_transport.get_stats()})
+
+# API端点：外发调度统计
+@app.route('/api/admin/outbound_stats')
+@admin_required
+def api_outbound_stats():
+    """外发邮件吞吐量、合并率和限速情况"""
+    from email_sender import email_sender
+    return jsonify({'success': True, 'stats': email_sender.dispatcher.get_stats()})
+
+# API端点：计费统计
+@app.route('/api/admin/billing_stats')
+@admin_required
+def api_billing_stats():
+    """最近N天（默认30，最多366）全站每天的发信、充值和会员购买合计，读计费日汇总表"""
+    from datetime import timedelta
+
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    start_day = (datetime.now() - timedelta(days=days - 1)).date()
+    daily = []
     if db_manager.connect():
-        user = db_manager.get_user_by_username(session['username'])
-        if not user or not user.get('is_admin', False):
-            db_manager.disconnect()
-            return jsonify({'success': False, 'message': '权限不足'}), 403
-
-        # 获取所有用户
-        all_users = db_manager.get_all_users()
-        cleaned_users = []
-
-        for user in all_users:
-            usage = db_manager.get_user_mailbox_usage(user['id'])
-            if usage['total_size_mb'] > 100:
-                deleted_count = db_manager.cleanup_user_mailbox(user['id'], 100)
-                if deleted_count > 0:
-                    cleaned_users.append({
-                        'username': user['username'],
-                        'deleted_count': deleted_count,
-                        'old_size': usage['total_size_mb']
-                    })
-
+        for row in db_manager.get_billing_daily_totals(start_day):
+            daily.append({
+                'day': row['day'].isoformat(),
+                'send_count': int(row['send_count'] or 0),
+                'normal_count': int(row['normal_count'] or 0),
+                'vip_free_count': int(row['vip_free_count'] or 0),
+                'vip_over_count': int(row['vip_over_count'] or 0),
+                'send_cost': float(row['send_cost'] or 0),
+                'recharge_count': int(row['recharge_count'] or 0),
+                'recharge_amount': float(row['recharge_amount'] or 0),
+                'vip_purchase_count': int(row['vip_purchase_count'] or 0),
+                'vip_purchase_amount': float(row['vip_purchase_amount'] or 0),
+                'active_users': row['active_users'],
+            })
         db_manager.disconnect()
-
-        return jsonify({
-            'success': True,
-            'message': f'已清理 {len(cleaned_users)} 个用户的邮箱',
-            'cleaned_users': cleaned_users
-        })
-    else:
-        return jsonify({'success': False, 'message': '数据库连接失败'}), 500
+    totals = {key: round(sum(item[key] for item in daily), 2)
+              for key in ('send_count', 'send_cost', 'recharge_count', 'recharge_amount',
+                          'vip_purchase_count', 'vip_purchase_amount')}
+    return jsonify({'success': True, 'start_day': start_day.isoformat(), 'daily': daily, 'totals': totals})
+
+# API端点：新邮件推送统计
+@app.route('/api/admin/stream_stats')
+@admin_required
+def api_stream_stats():
+    """推送连接数和事件源状态"""
+    return jsonify({'success': True, 'stats': mail_event_broker.get_stats()})
+
+# API端点：查询缓存统计
+@app.route('/api/admin/cache_stats')
+@admin_required
+def api_cache_stats():
+    """域名、邮箱列表等热点数据缓存的命中率"""
+    return jsonify({'success': True, 'stats': query_cache.get_stats()})
+
+# SQL性能统计页面（仅管理员可见）
+@app.route('/admin/query_stats')
+@admin_required
+def admin_query_stats():
+    """按方法汇总的SQL耗时排行和最近的慢查询（当前Web进程）"""
+    order_by = request.args.get('order', 'total_ms')
+    limit = request.args.get('limit', 30, type=int)
+    return render_template('admin_query_stats.html',
+                           user=g.user,
+                           order_by=order_by,
+                           summary=query_stats.summary(),
+                           methods=query_stats.top_methods(limit, order_by),
+                           slow_queries=query_stats.recent_slow(50))
+
+# API端点：SQL性能统计
+@app.route('/api/admin/query_stats')
+@admin_required
+def api_query_stats():
+    """SQL耗时排行和慢查询（JSON）"""
+    limit = request.args.get('limit', 30, type=int)
+    return jsonify({
+        'success': True,
+        'summary': query_stats.summary(),
+        'methods': query_stats.top_methods(limit, request.args.get('order', 'total_ms')),
+        'slow_queries': query_stats.recent_slow(request.args.get('slow_limit', 50, type=int)),
+    })
+
+# API端点：调整慢查询设置（EXPLAIN抽样开关、阈值）
+@app.route('/api/admin/query_stats/settings', methods=['POST'])
+@admin_required
+def api_query_stats_settings():
+    """运行时修改，只对当前进程生效，重启后恢复环境变量配置"""
+    data = request.get_json(silent=True) or {}
+    try:
+        if 'explain' in data:
+            query_stats.explain_enabled = bool(data['explain'])
+        if 'explain_sample' in data:
+            query_stats.explain_sample = min(max(float(data['explain_sample']), 0.0), 1.0)
+        if 'threshold_ms' in data:
+            query_stats.threshold_ms = max(float(data['threshold_ms']), 0.0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '参数格式错误'}), 400
+    return jsonify({'success': True, 'message': '设置已更新', 'summary': query_stats.summary()})
+
+# API端点：清空SQL性能统计
+@app.route('/api/admin/query_stats/reset', methods=['POST'])
+@admin_required
+def api_query_stats_reset():
+    query_stats.reset()
+    return jsonify({'success': True, 'message': '统计已清空'})
+
+# API端点：请求分析结果列表
+@app.route('/api/admin/profiles')
+@admin_required
+def api_list_profiles():
+    """最近的请求采样分析结果（路由、耗时、采样数、热点函数）"""
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'success': True, 'profiles': profile_store.list_profiles(limit)})
+
+# API端点：下载请求分析结果
+@app.route('/api/admin/profiles/<profile_id>')
+@admin_required
+def api_download_profile(profile_id):
+    """下载折叠栈文件（可用 flamegraph.pl 或 speedscope 打开）"""
+    path = profile_store.get_collapsed_path(profile_id)
+    if not path:
+        return jsonify({'success': False, 'message': '分析结果不存在'}), 404
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=f"{profile_id}.collapsed",
+                     mimetype='text/plain')
+
+# 存活检查：不访问数据库和磁盘
+@app.route('/healthz')
+def healthz():
+    return Response('ok\n', mimetype='text/plain')
+
+# 就绪检查：数据库、磁盘空间、收件进程（结果缓存几秒）
+@app.route('/readyz')
+def readyz():
+    ready, checks = readiness_checker.check()
+    return jsonify({'ready': ready, 'checks': checks}), (200 if ready else 503)
+
+# Prometheus 指标（合并Web进程和收件进程）
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 抓取端点；设置 METRICS_TOKEN 后需要 Bearer 令牌"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(render_text(registry.collect()), mimetype='text/plain; version=0.0.4')
 
 # 数据库初始化函数
 def init_database_if_needed():
@@ -3901,6 +3558,15 @@ if __name__ == '__main__':
                 input("按回车键退出...")
             sys.exit(1)
 
+        # 启动发件箱后台发送线程
+        outbox_worker.start()
+
+        # 启动支付结算线程
+        settlement_worker.start()
+
+        # 启动后台任务调度（会员到期、邮箱清理、无主文件清理等维护任务）
+        job_scheduler.start()
+
         # 生产环境配置
         # 检测是否在Docker环境中
         is_docker = os.path.exists('/.dockerenv')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+附件落盘与流式编码
+上传：按块把上传流写入唯一命名的暂存文件，边写边计算sha256和大小，超限立即中止，
+      不再把整个附件读进内存，也不会因为同名文件互相覆盖。
+发送：Resend接口要求附件以base64放在JSON里，这里按块读取文件、按块编码输出请求体，
+      单个请求占用的缓冲内存不超过 OUTBOUND_MEMORY_CEILING。
+"""
+
+import os
+import json
+import uuid
+import base64
+import hashlib
+
+from werkzeug.utils import secure_filename
+
+from email_config import (
+    ATTACHMENT_SPOOL_DIR, ATTACHMENT_MAX_FILE_SIZE, ATTACHMENT_MAX_TOTAL_SIZE, OUTBOUND_MEMORY_CEILING
+)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentTooLarge(ValueError):
+    """附件超过大小限制"""
+
+
+class SpooledAttachment:
+    """已落盘的上传附件"""
+
+    def __init__(self, filename, path, size, sha256):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+    def move_to(self, directory):
+        """移动到永久目录（同一文件系统内只是重命名）"""
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, os.path.basename(self.path))
+        os.replace(self.path, target)
+        self.path = target
+        return target
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def to_dict(self):
+        return {'filename': self.filename, 'path': self.path, 'size': self.size, 'sha256': self.sha256}
+
+
+def spool_upload(file_storage, directory=None, max_size=None):
+    """
+    把一个上传文件按块写入暂存目录
+
+    Returns:
+        SpooledAttachment，磁盘文件名为 <uuid>_<安全文件名>
+    Raises:
+        AttachmentTooLarge: 超过单文件大小限制（已写入的部分会被删除）
+    """
+    directory = directory or ATTACHMENT_SPOOL_DIR
+    max_size = max_size or ATTACHMENT_MAX_FILE_SIZE
+    os.makedirs(directory, exist_ok=True)
+
+    filename = secure_filename(file_storage.filename) or 'attachment'
+    path = os.path.join(directory, f"{uuid.uuid4().hex}_{filename}")
+    partial_path = path + '.part'
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(partial_path, 'wb') as f:
+            while True:
+                chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise AttachmentTooLarge(f'附件 {filename} 超过大小限制（{max_size // (1024 * 1024)}MB）')
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(partial_path, path)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return SpooledAttachment(filename, path, size, digest.hexdigest())
+
+
+def spool_uploads(file_storages, directory=None, max_total_size=None):
+    """落盘一次请求的全部附件，总大小超限时清理已落盘的文件并抛出 AttachmentTooLarge"""
+    max_total_size = max_total_size or ATTACHMENT_MAX_TOTAL_SIZE
+    spooled = []
+    total = 0
+    try:
+        for file_storage in file_storages:
+            if not file_storage.filename:
+                continue
+            attachment = spool_upload(file_storage, directory)
+            spooled.append(attachment)
+            total += attachment.size
+            if total > max_total_size:
+                raise AttachmentTooLarge(f'附件总大小超过限制（{max_total_size // (1024 * 1024)}MB）')
+    except Exception:
+        for attachment in spooled:
+            attachment.discard()
+        raise
+    return spooled
+
+
+def base64_length(size):
+    return 4 * ((size + 2) // 3)
+
+
+class StreamingJSONBody:
+    """
+    流式JSON请求体：普通字段一次性序列化，附件内容按块读取并base64编码输出
+    可重复迭代（HTTP重试时重新读文件），实现 __len__ 以便以 Content-Length 发送而不是分块传输
+
+    attachments: [{'filename': str, 'path': str, 'size': int}]
+    """
+
+    def __init__(self, fields, attachments, memory_ceiling=None):
+        self.fields = fields
+        self.attachments = attachments
+        ceiling = memory_ceiling or OUTBOUND_MEMORY_CEILING
+        # 读取块必须是3的倍数，保证分块编码结果拼接后与整体编码一致；编码后约为读取块的4/3
+        self.read_size = max((ceiling * 3 // 4) // 3 * 3, 3)
+
+        head = json.dumps(fields, ensure_ascii=False)
+        self._prefix = (head[:-1] + (', ' if fields else '') + '"attachments": [').encode('utf-8')
+        self._suffix = b']}'
+        self._length = self._compute_length()
+
+    def _attachment_head(self, index, attachment):
+        separator = ', ' if index else ''
+        return f'{separator}{{"filename": {json.dumps(attachment["filename"], ensure_ascii=False)}, "content": "'.encode('utf-8')
+
+    def _compute_length(self):
+        length = len(self._prefix) + len(self._suffix)
+        for index, attachment in enumerate(self.attachments):
+            size = os.path.getsize(attachment['path'])
+            length += len(self._attachment_head(index, attachment)) + base64_length(size) + len(b'"}')
+        return length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        yield self._prefix
+        for index, attachment in enumerate(self.attachments):
+            yield self._attachment_head(index, attachment)
+            with open(attachment['path'], 'rb') as f:
+                while True:
+                    chunk = f.read(self.read_size)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+            yield b'"}'
+        yield self._suffix
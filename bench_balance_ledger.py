@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+余额流水并发扣费压测
+多个线程（每个线程一个数据库连接）同时对同一个用户执行发信扣费 charge_send，统计吞吐量，
+并校验：成功扣费次数 × 单价 = 余额减少量 = 流水合计，余额不出现负数。
+
+用法：
+    python bench_balance_ledger.py --user-id 2 --threads 16 --sends 200 --cost 0.01
+注意：会真实扣除该用户的余额并写入流水（entry_type='send_charge'），
+请使用测试库或测试账户；结束后按 --restore 把余额恢复为压测前的值（记一条 admin_adjust 流水）。
+"""
+
+import sys
+import time
+import argparse
+import threading
+from decimal import Decimal
+
+from database.db_manager import DatabaseManager, LEDGER_INSUFFICIENT
+
+
+def run_worker(user_id, sends, cost, results, lock):
+    db = DatabaseManager()
+    if not db.connect():
+        print("❌ 压测线程无法连接数据库")
+        return
+    ok = insufficient = errors = 0
+    try:
+        for _ in range(sends):
+            success, message = db.charge_send(user_id, cost, False, None)
+            if success:
+                ok += 1
+            elif message == LEDGER_INSUFFICIENT:
+                insufficient += 1
+            else:
+                errors += 1
+    finally:
+        db.disconnect()
+    with lock:
+        results['ok'] += ok
+        results['insufficient'] += insufficient
+        results['errors'] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='余额流水并发扣费压测')
+    parser.add_argument('--user-id', type=int, required=True, help='压测使用的用户ID')
+    parser.add_argument('--threads', type=int, default=16, help='并发线程数')
+    parser.add_argument('--sends', type=int, default=200, help='每个线程的扣费次数')
+    parser.add_argument('--cost', type=Decimal, default=Decimal('0.01'), help='每次扣费金额')
+    parser.add_argument('--restore', action='store_true', help='结束后恢复压测前的余额')
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    if not db.connect():
+        print("❌ 数据库连接失败")
+        return 1
+    user = db.get_user_by_id(args.user_id)
+    if not user:
+        print(f"❌ 用户 {args.user_id} 不存在")
+        return 1
+    balance_before = Decimal(str(user['balance']))
+    last_ledger_id = (db.execute_query("SELECT COALESCE(MAX(id), 0) as id FROM balance_ledger") or [{'id': 0}])[0]['id']
+
+    print(f"🚀 用户 {args.user_id} 初始余额 ¥{balance_before}，{args.threads} 线程 × {args.sends} 次，每次 ¥{args.cost}")
+    results = {'ok': 0, 'insufficient': 0, 'errors': 0}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_worker, args=(args.user_id, args.sends, args.cost, results, lock))
+               for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    attempts = results['ok'] + results['insufficient'] + results['errors']
+    print(f"⏱️ 耗时 {elapsed:.2f}s，{attempts} 次请求，吞吐 {attempts / elapsed:.1f} 次/秒")
+    print(f"✅ 成功 {results['ok']}，余额不足 {results['insufficient']}，错误 {results['errors']}")
+
+    # 结束压测前查询开启的只读事务，否则下面仍读到压测前的快照
+    db.connection.commit()
+    balance_after = Decimal(str(db.get_user_by_id(args.user_id)['balance']))
+    ledger = db.execute_query(
+        "SELECT COUNT(*) as count, COALESCE(SUM(amount), 0) as total FROM balance_ledger "
+        "WHERE id > %s AND user_id = %s AND entry_type = 'send_charge'",
+        (last_ledger_id, args.user_id))[0]
+    expected = args.cost * results['ok']
+    consistent = (balance_before - balance_after == expected
+                  and -Decimal(str(ledger['total'])) == expected
+                  and ledger['count'] == results['ok']
+                  and balance_after >= 0)
+    print(f"💰 余额 ¥{balance_before} → ¥{balance_after}，流水 {ledger['count']} 条合计 ¥{ledger['total']}")
+    print("✅ 余额与流水一致" if consistent else "❌ 余额与流水不一致")
+
+    if args.restore:
+        db.set_balance_by_admin(args.user_id, balance_before)
+        print(f"↩️ 已恢复余额 ¥{balance_before}")
+    db.disconnect()
+    return 0 if consistent else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+计费日汇总回填与校验
+billing_daily_rollups 上线前的历史数据需要回填；之后也可以定期校验汇总与明细表（email_outbox、recharge_records）是否一致。
+
+用法：
+    python billing_rollup_tool.py backfill --from 2024-01-01            # 逐天重建，默认到昨天
+    python billing_rollup_tool.py verify --from 2024-06-01 --to 2024-06-30
+    python billing_rollup_tool.py verify --days 7 --repair               # 校验最近7天，不一致的天重建
+注意：每天的重建是"删除该天汇总 + 从明细表重新统计"一个事务；当天仍有发信和充值在写入，
+默认范围不包含今天，确需处理今天请在低峰期显式指定 --to。
+"""
+
+import sys
+import argparse
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from database.db_manager import DatabaseManager, BILLING_ROLLUP_FIELDS
+
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def iter_days(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def diff_rollups(expected, actual):
+    """比较一天的汇总，返回 [(user_id, 字段, 应有值, 实际值)]"""
+    mismatches = []
+    for user_id in sorted(set(expected) | set(actual)):
+        want = expected.get(user_id, {})
+        have = actual.get(user_id, {})
+        for field in BILLING_ROLLUP_FIELDS:
+            want_value = Decimal(str(want.get(field) or 0))
+            have_value = Decimal(str(have.get(field) or 0))
+            if want_value != have_value:
+                mismatches.append((user_id, field, want_value, have_value))
+    return mismatches
+
+
+def backfill(db, start, end):
+    failed = 0
+    for day in iter_days(start, end):
+        if db.rebuild_billing_rollups(day):
+            print(f"✅ {day} 已重建")
+        else:
+            failed += 1
+    return 0 if failed == 0 else 1
+
+
+def verify(db, start, end, repair=False):
+    bad_days = []
+    for day in iter_days(start, end):
+        expected = db.compute_billing_rollups(day)
+        actual = db.get_billing_rollups_for_day(day)
+        if expected is None or actual is None:
+            print(f"❌ {day} 查询失败")
+            bad_days.append(day)
+            continue
+        mismatches = diff_rollups(expected, actual)
+        if not mismatches:
+            continue
+        bad_days.append(day)
+        print(f"❌ {day} 有 {len(mismatches)} 项不一致")
+        for user_id, field, want, have in mismatches[:20]:
+            print(f"   用户 {user_id} {field}: 应为 {want}，汇总为 {have}")
+        if repair and db.rebuild_billing_rollups(day):
+            print(f"↩️ {day} 已按明细重建")
+
+    total = (end - start).days + 1
+    print(f"📊 校验 {start} ~ {end} 共 {total} 天，不一致 {len(bad_days)} 天")
+    return 0 if not bad_days or repair else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='计费日汇总回填与校验')
+    parser.add_argument('command', choices=['backfill', 'verify'])
+    parser.add_argument('--from', dest='start', type=parse_day, help='开始日期（YYYY-MM-DD）')
+    parser.add_argument('--to', dest='end', type=parse_day, help='结束日期（含），默认昨天')
+    parser.add_argument('--days', type=int, default=30, help='未指定 --from 时处理最近多少天')
+    parser.add_argument('--repair', action='store_true', help='校验时重建不一致的天')
+    args = parser.parse_args()
+
+    end = args.end or date.today() - timedelta(days=1)
+    start = args.start or end - timedelta(days=args.days - 1)
+    if start > end:
+        print("❌ 开始日期晚于结束日期")
+        return 1
+
+    db = DatabaseManager()
+    if not db.connect():
+        print("❌ 数据库连接失败")
+        return 1
+    try:
+        if args.command == 'backfill':
+            return backfill(db, start, end)
+        return verify(db, start, end, args.repair)
+    finally:
+        db.disconnect()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
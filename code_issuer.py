@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+注册码/充值码批量发放
+一次生成整批候选码，用多行 INSERT IGNORE 分段写入（每段 CODE_INSERT_CHUNK 行），
+只为与已有码冲突而被忽略的部分重新生成；整批在一个事务内提交，要么全部生成要么全部不生成。
+每批码共用一个批次号，可按批次流式导出CSV（逐段查询、逐段输出，上万个码也不占用大量内存）。
+"""
+
+import io
+import csv
+import uuid
+import string
+import secrets
+from datetime import datetime
+
+from database.db_manager import DatabaseManager
+
+CODE_KINDS = ('registration', 'recharge')
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_RANDOM_LENGTH = 8  # 前缀之后的随机字符数
+CODE_INSERT_CHUNK = 1000  # 每条 INSERT 语句写入的行数
+CODE_MAX_ROUNDS = 5  # 冲突重新生成的最大轮数
+MAX_CODES_PER_BATCH = 50000  # 单批最多生成数量
+
+
+def new_batch_no():
+    """批次号：B + 时间 + 随机后缀"""
+    return f"B{datetime.now().strftime('%Y%m%d%H%M%S')}{uuid.uuid4().hex[:6].upper()}"
+
+
+def code_prefix(kind, amount=None):
+    return f'RC{amount:g}' if kind == 'recharge' else 'REG'
+
+
+def generate_candidates(prefix, count, exclude=()):
+    """生成 count 个互不重复的候选码（不与 exclude 重复）"""
+    candidates = set()
+    while len(candidates) < count:
+        code = prefix + ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_RANDOM_LENGTH))
+        if code not in exclude:
+            candidates.add(code)
+    return list(candidates)
+
+
+def issue_codes(db, kind, count, description=None, created_by_user_id=None, amount=None):
+    """
+    批量生成注册码/充值码（调用方负责 connect/disconnect）
+    Returns:
+        (success, message, batch_no, codes)
+    """
+    if kind not in CODE_KINDS:
+        return False, '未知的码类型', None, []
+    if count <= 0 or count > MAX_CODES_PER_BATCH:
+        return False, f'一次最多只能生成{MAX_CODES_PER_BATCH}个', None, []
+
+    batch_no = new_batch_no()
+    prefix = code_prefix(kind, amount)
+    issued = []
+    try:
+        for _ in range(CODE_MAX_ROUNDS):
+            candidates = generate_candidates(prefix, count - len(issued), exclude=set(issued))
+            for start in range(0, len(candidates), CODE_INSERT_CHUNK):
+                chunk = candidates[start:start + CODE_INSERT_CHUNK]
+                inserted = db.insert_codes_ignore(kind, chunk, batch_no, description, created_by_user_id, amount)
+                if inserted == len(chunk):
+                    issued.extend(chunk)
+                else:
+                    # 有冲突：查出本批次实际写入的码，其余的下一轮重新生成
+                    issued.extend(db.get_inserted_batch_codes(kind, batch_no, chunk))
+            if len(issued) >= count:
+                db.connection.commit()
+                return True, f'成功生成 {count} 个', batch_no, issued
+        db.connection.rollback()
+        return False, '生成的码冲突过多，请重试', None, []
+    except Exception as e:
+        print(f"❌ 批量生成{kind}码失败: {e}")
+        try:
+            db.connection.rollback()
+        except Exception:
+            pass
+        return False, f'生成失败: {str(e)}', None, []
+
+
+def stream_batch_csv(kind, batch_no, chunk_size=CODE_INSERT_CHUNK):
+    """
+    按批次流式输出CSV（生成器，配合 Flask Response 使用）
+    使用独立的数据库连接：响应体在视图函数返回之后才输出
+    """
+    db = DatabaseManager()
+    if not db.connect():
+        return
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # UTF-8 BOM，Excel 打开时不乱码
+        buffer.write('\ufeff')
+        if kind == 'recharge':
+            writer.writerow(['充值码', '面额', '是否已使用', '创建时间'])
+        else:
+            writer.writerow(['注册码', '是否已使用', '创建时间'])
+
+        for rows in db.iter_batch_codes(kind, batch_no, chunk_size):
+            for row in rows:
+                used = '是' if row['is_used'] else '否'
+                if kind == 'recharge':
+                    writer.writerow([row['code'], f"{row['amount']:.2f}", used, row['created_at']])
+                else:
+                    writer.writerow([row['code'], used, row['created_at']])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        db.disconnect()
@@ -19,6 +19,7 @@ from realtime_monitor import RealtimeEmailMonitor
 from email_parser import EmailParser
 from database.db_manager import DatabaseManager
 from email_config import EMAIL_SAVE_DIR, TARGET_DOMAIN
+from mail_events import mail_event_broker, build_summary, extract_address
 
 class ComponentConnector:
     """
@@ -233,7 +234,17 @@ class ComponentConnector:
                                     print(f"❌ 附件 '{filename}' 存储到数据库失败")
                             except Exception as e:
                                 print(f"❌ 保存附件 '{filename}' 时出错: {e}")
-                    
+
+                    # 通知在线用户（配置了Redis时发布到Redis Stream，否则Web进程会自行跟踪到新邮件）
+                    if mail_event_broker.shared:
+                        user_ids = self.db_manager.get_user_ids_by_email_addresses(
+                            [extract_address(receiver_email), extract_address(sender_email)]
+                        )
+                        mail_event_broker.publish(
+                            email_db_id, user_ids,
+                            build_summary(sender_email, receiver_email, subject, sent_time)
+                        )
+
                     return True
                 else:
                     print(f"❌ 邮件数据存储失败: {email_id}")
@@ -4,6 +4,8 @@
 统一管理所有系统参数，方便维护和调整
 """
 
+from datetime import date, datetime
+
 class Config:
     """系统配置类"""
     
@@ -59,6 +61,26 @@ class Config:
     
     # 是否启用会员系统
     ENABLE_VIP_SYSTEM = True
+
+    @staticmethod
+    def current_quota_period():
+        """当前免费额度周期（当月1日）"""
+        return date.today().replace(day=1)
+
+    @staticmethod
+    def is_vip_active(user):
+        """会员是否有效（已到期但尚未被定时任务取消的按非会员处理）"""
+        if not user.get('is_vip', False):
+            return False
+        expire_date = user.get('vip_expire_date')
+        return expire_date is None or expire_date > datetime.now()
+
+    @classmethod
+    def vip_quota_used(cls, user):
+        """本周期已使用的VIP免费额度（计数属于之前的周期时视为0）"""
+        if user.get('quota_period_start') != cls.current_quota_period():
+            return 0
+        return user.get('vip_email_count', 0) or 0
     
     @classmethod
     def get_email_send_cost(cls, user):
@@ -71,11 +93,11 @@ class Config:
         Returns:
             tuple: (费用, 是否使用VIP免费额度)
         """
-        if not user.get('is_vip', False):
+        if not cls.is_vip_active(user):
             return cls.EMAIL_SEND_COST_NORMAL, False
 
-        # VIP用户检查免费额度（使用VIP期间计数）
-        vip_email_count = user.get('vip_email_count', 0)
+        # VIP用户检查免费额度（本周期计数）
+        vip_email_count = cls.vip_quota_used(user)
         if vip_email_count < cls.VIP_FREE_EMAIL_QUOTA:
             return 0.0, True  # 免费额度内
         else:
@@ -92,10 +114,10 @@ class Config:
         Returns:
             str: 费用描述
         """
-        if not user.get('is_vip', False):
+        if not cls.is_vip_active(user):
             return f"接收邮件：免费，发送邮件：¥{cls.EMAIL_SEND_COST_NORMAL}/条"
 
-        vip_email_count = user.get('vip_email_count', 0)
+        vip_email_count = cls.vip_quota_used(user)
         if vip_email_count < cls.VIP_FREE_EMAIL_QUOTA:
             remaining = cls.VIP_FREE_EMAIL_QUOTA - vip_email_count
             return f"接收邮件：免费，发送邮件：免费（剩余{remaining}条）"
@@ -0,0 +1,8 @@
+-- 注册码/充值码批次号：批量生成的码共用一个批次号，按批次导出CSV
+ALTER TABLE registration_codes
+    ADD COLUMN batch_no VARCHAR(32) NULL COMMENT '生成批次号',
+    ADD INDEX idx_batch_no (batch_no, id);
+
+ALTER TABLE recharge_codes
+    ADD COLUMN batch_no VARCHAR(32) NULL COMMENT '生成批次号',
+    ADD INDEX idx_batch_no (batch_no, id);
@@ -0,0 +1,10 @@
+-- 支付通知快速确认：通知只把订单标记为 paid，由后台结算线程入账并失败重试
+-- 已执行过 create_payment_orders_table.sql 的数据库执行本文件升级
+ALTER TABLE payment_orders
+    MODIFY COLUMN status ENUM('created', 'paid', 'credited', 'failed') NOT NULL DEFAULT 'created' COMMENT '状态：已创建/已支付待入账/已入账/失败',
+    ADD COLUMN paid_amount DECIMAL(10,2) NULL COMMENT '支付平台通知的实付金额' AFTER trade_no,
+    ADD COLUMN settle_attempts INT NOT NULL DEFAULT 0 COMMENT '入账尝试次数' AFTER failure_reason,
+    ADD COLUMN next_attempt_at TIMESTAMP NULL COMMENT '下次入账尝试时间' AFTER settle_attempts,
+    ADD COLUMN last_error VARCHAR(255) NULL COMMENT '最近一次入账错误' AFTER next_attempt_at,
+    ADD COLUMN paid_at TIMESTAMP NULL COMMENT '收到支付通知时间' AFTER created_at,
+    ADD INDEX idx_status_next (status, next_attempt_at);
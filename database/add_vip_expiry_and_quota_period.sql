@@ -0,0 +1,9 @@
+-- 会员到期批量处理 + 按周期计数的免费额度
+-- vip_expire_date 加索引：定时任务按到期时间范围批量取消过期会员，不再每次请求逐个用户检查
+-- quota_period_start：vip_email_count 所属的计费周期（当月1日），跨月后计数自动视为0，发信时无需先写库重置
+ALTER TABLE users
+    ADD COLUMN quota_period_start DATE NULL COMMENT 'vip_email_count 所属周期（当月1日）',
+    ADD INDEX idx_vip_expire_date (vip_expire_date);
+
+-- 已有计数归入当前周期
+UPDATE users SET quota_period_start = DATE_FORMAT(CURDATE(), '%Y-%m-01') WHERE vip_email_count > 0;
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+热点数据缓存
+域名列表、用户邮箱列表这类读多写少的数据，在多个请求之间缓存，减少重复查询。
+分页用的邮件总数按范围（全局/用户/邮箱地址）缓存，收件和删除时增量调整，短TTL兜底。
+
+- 每类数据属于一个命名空间，命名空间有一个版本号，缓存键包含版本号
+- 写操作（创建/修改/删除）调用 invalidate(命名空间) 使版本号+1，旧版本的缓存立即失效，随TTL自然过期
+- TTL兜底：即使漏掉失效调用（例如直接改库），数据最多陈旧 CACHE_TTL 秒
+- 后端可选：默认进程内字典；设置 REDIS_URL 后使用Redis，多个Web进程/节点共享版本号，失效对所有进程生效
+"""
+
+import os
+import copy
+import time
+import pickle
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+REDIS_URL = os.environ.get('REDIS_URL', '')
+CACHE_TTL = int(os.environ.get('CACHE_TTL', '300'))  # 缓存有效期（秒）
+COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', '60'))  # 分页总数缓存有效期（秒），增量调整遗漏时的最长误差时间
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+CACHE_KEY_PREFIX = 'qqmail:cache'
+
+
+class InProcessCacheBackend:
+    """进程内缓存（单进程部署使用）"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._data = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+        # 返回副本，调用方修改结果不会污染缓存
+        return copy.deepcopy(value)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (copy.deepcopy(value), time.monotonic() + ttl)
+            # 顺便清理过期项，避免旧版本的键无限堆积
+            if len(self._data) > 1000:
+                now = time.monotonic()
+                for expired in [k for k, (_, exp) in self._data.items() if exp < now]:
+                    del self._data[expired]
+
+    def incr_existing(self, key, delta):
+        """计数存在且未过期时加上delta（不存在时不创建，等下次查询重新统计）"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                return None
+            value = max(item[0] + delta, 0)
+            self._data[key] = (value, item[1])
+            return value
+
+    def get_version(self, namespace):
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+    def incr_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            return self._versions[namespace]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCacheBackend:
+    """Redis缓存（多进程/多节点部署使用，版本号保存在Redis中）"""
+
+    name = 'redis'
+
+    # 键存在时才累加，保留原有的过期时间；不存在时不创建（避免生成没有TTL的计数）
+    INCR_EXISTING_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        local value = redis.call('GET', KEYS[1])
+        local updated = math.max(tonumber(value) + tonumber(ARGV[1]), 0)
+        redis.call('SET', KEYS[1], updated, 'KEEPTTL')
+        return updated
+    end
+    return nil
+    """
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._incr_existing = self.client.register_script(self.INCR_EXISTING_SCRIPT)
+
+    def set(self, key, value, ttl):
+        # 计数以明文整数保存，便于脚本累加
+        raw = value if isinstance(value, int) else pickle.dumps(value)
+        self.client.set(key, raw, ex=ttl)
+
+    def get(self, key):
+        raw = self.client.get(key)
+        if raw is None:
+            return None
+        return int(raw) if raw.isdigit() else pickle.loads(raw)
+
+    def incr_existing(self, key, delta):
+        return self._incr_existing(keys=[key], args=[delta])
+
+    def get_version(self, namespace):
+        raw = self.client.get(f"{CACHE_KEY_PREFIX}:version:{namespace}")
+        return int(raw) if raw is not None else 0
+
+    def incr_version(self, namespace):
+        return self.client.incr(f"{CACHE_KEY_PREFIX}:version:{namespace}")
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{CACHE_KEY_PREFIX}:*"):
+            self.client.delete(key)
+
+
+class QueryCache:
+    """带版本号失效的查询结果缓存，缓存后端出错时直接查库，不影响业务"""
+
+    def __init__(self, backend, ttl=None, enabled=True):
+        self.backend = backend
+        self.ttl = ttl or CACHE_TTL
+        self.enabled = enabled
+        self._stats_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_or_load(self, namespace, key, loader, ttl=None):
+        """
+        读取缓存，未命中时调用 loader() 查库并写入缓存
+        loader 返回 None（查询失败）时不缓存
+        """
+        if not self.enabled:
+            return loader()
+
+        try:
+            version = self.backend.get_version(namespace)
+            cache_key = f"{CACHE_KEY_PREFIX}:{namespace}:v{version}:{key}"
+            value = self.backend.get(cache_key)
+        except Exception as e:
+            print(f"⚠️ 读取缓存失败，直接查询数据库: {e}")
+            self._incr('errors')
+            return loader()
+
+        if value is not None:
+            self._incr('hits')
+            return value
+
+        self._incr('misses')
+        value = loader()
+        if value is not None:
+            try:
+                self.backend.set(cache_key, value, ttl or self.ttl)
+            except Exception as e:
+                print(f"⚠️ 写入缓存失败: {e}")
+                self._incr('errors')
+        return value
+
+    # ========== 分页总数 ==========
+
+    def get_count(self, scope, loader, ttl=None):
+        """读取某个范围的邮件总数，未命中时调用 loader() 统计"""
+        return self.get_or_load('count', scope, loader, ttl or COUNT_CACHE_TTL)
+
+    def peek_count(self, scope):
+        """只读取已缓存的总数，未缓存时返回None（不触发统计）"""
+        if not self.enabled:
+            return None
+        try:
+            version = self.backend.get_version('count')
+            return self.backend.get(f"{CACHE_KEY_PREFIX}:count:v{version}:{scope}")
+        except Exception as e:
+            print(f"⚠️ 读取缓存失败: {e}")
+            self._incr('errors')
+            return None
+
+    def adjust_counts(self, deltas):
+        """
+        收件/删除后增量调整已缓存的总数，deltas 为 {范围: 增量}
+        未缓存的范围不处理，下次查询时重新统计
+        """
+        if not self.enabled or not deltas:
+            return
+        try:
+            version = self.backend.get_version('count')
+            for scope, delta in deltas.items():
+                if delta:
+                    self.backend.incr_existing(f"{CACHE_KEY_PREFIX}:count:v{version}:{scope}", delta)
+        except Exception as e:
+            print(f"⚠️ 调整邮件总数缓存失败，将在 {COUNT_CACHE_TTL} 秒后重新统计: {e}")
+            self._incr('errors')
+
+    def invalidate(self, *namespaces):
+        """数据已修改，使这些命名空间下的缓存全部失效"""
+        if not self.enabled:
+            return
+        for namespace in namespaces:
+            try:
+                self.backend.incr_version(namespace)
+                self._incr('invalidations')
+            except Exception as e:
+                print(f"⚠️ 缓存失效失败（{namespace}），将在 {self.ttl} 秒后过期: {e}")
+                self._incr('errors')
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0
+        stats['backend'] = self.backend.name
+        stats['ttl'] = self.ttl
+        return stats
+
+
+def create_query_cache():
+    """根据配置选择缓存后端"""
+    if REDIS_URL and redis is not None:
+        return QueryCache(RedisCacheBackend(REDIS_URL), enabled=CACHE_ENABLED)
+    return QueryCache(InProcessCacheBackend(), enabled=CACHE_ENABLED)
+
+
+# 进程内所有 DatabaseManager 实例共享
+query_cache = create_query_cache()
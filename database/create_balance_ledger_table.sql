@@ -0,0 +1,16 @@
+-- 余额流水表：所有余额变动（发信扣费、退款、充值码、在线支付、会员购买、管理员调整）都记一条流水
+-- 扣款使用 UPDATE users SET balance = balance - 金额 WHERE id = 用户 AND balance >= 金额，
+-- 与流水插入在同一事务内提交；(entry_type, reference) 唯一，同一笔业务重复入账会被拒绝
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY COMMENT '流水ID',
+    user_id INT NOT NULL COMMENT '用户ID',
+    amount DECIMAL(10,2) NOT NULL COMMENT '变动金额（正数入账，负数扣款）',
+    balance_after DECIMAL(10,2) NOT NULL COMMENT '变动后余额',
+    entry_type VARCHAR(32) NOT NULL COMMENT '类型：send_charge/send_refund/email_registration/vip_purchase/redeem_code/payment/admin_adjust',
+    reference VARCHAR(100) NULL COMMENT '业务单号（订单号、充值码、发件记录ID等），用于防止重复入账',
+    description VARCHAR(255) NULL COMMENT '说明',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '记账时间',
+    UNIQUE KEY uk_type_reference (entry_type, reference),
+    INDEX idx_user_created (user_id, created_at),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='余额流水表';
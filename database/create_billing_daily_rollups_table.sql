@@ -0,0 +1,24 @@
+-- 计费日汇总表：每个用户每天一行
+-- 发信入队、投递失败退款、写入充值记录时在同一事务内增量更新（INSERT ... ON DUPLICATE KEY UPDATE），
+-- 充值页的本月统计和管理员计费统计只读汇总行，不再扫描明细表；历史数据用 billing_rollup_tool.py backfill 回填
+CREATE TABLE IF NOT EXISTS billing_daily_rollups (
+    user_id INT NOT NULL COMMENT '用户ID',
+    day DATE NOT NULL COMMENT '日期',
+    send_count INT NOT NULL DEFAULT 0 COMMENT '发信数（不含投递失败已退款的）',
+    normal_count INT NOT NULL DEFAULT 0 COMMENT '普通用户计费发信数',
+    vip_free_count INT NOT NULL DEFAULT 0 COMMENT 'VIP免费额度内发信数',
+    vip_over_count INT NOT NULL DEFAULT 0 COMMENT 'VIP超额计费发信数',
+    send_cost DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '发信费用合计',
+    recharge_count INT NOT NULL DEFAULT 0 COMMENT '余额充值次数',
+    recharge_amount DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '余额充值金额合计',
+    vip_purchase_count INT NOT NULL DEFAULT 0 COMMENT '会员购买次数',
+    vip_purchase_amount DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '会员购买金额合计',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (user_id, day),
+    INDEX idx_day (day),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) COMMENT = '计费日汇总表';
+
+-- 回填按天扫描明细表；充值页的最近记录按用户倒序取前几条
+ALTER TABLE email_outbox ADD INDEX idx_created_at (created_at);
+ALTER TABLE recharge_records ADD INDEX idx_user_created (user_id, created_at);
@@ -0,0 +1,27 @@
+-- 发件箱表：写信请求只负责校验、扣费和入队，由后台线程投递并重试
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INT AUTO_INCREMENT PRIMARY KEY COMMENT '发件记录ID',
+    user_id INT NOT NULL COMMENT '发件用户ID',
+    email_id INT NOT NULL COMMENT '对应emails表中的邮件ID',
+    from_email VARCHAR(255) NOT NULL COMMENT '发件人邮箱',
+    to_email VARCHAR(255) NOT NULL COMMENT '收件人邮箱',
+    subject TEXT COMMENT '邮件主题',
+    content LONGTEXT COMMENT '邮件正文',
+    attachments_json TEXT COMMENT '附件列表（JSON: filename/path/size）',
+    status ENUM('queued', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'queued' COMMENT '投递状态',
+    attempts INT NOT NULL DEFAULT 0 COMMENT '已投递次数',
+    next_attempt_at DATETIME NOT NULL COMMENT '下次可投递时间',
+    locked_by VARCHAR(100) NULL COMMENT '认领该记录的发送线程',
+    locked_at DATETIME NULL COMMENT '认领时间',
+    last_error TEXT COMMENT '最近一次失败原因',
+    provider_message_id VARCHAR(255) NULL COMMENT '服务商返回的邮件ID',
+    charged_amount DECIMAL(10,2) NOT NULL DEFAULT 0.00 COMMENT '入队时扣除的费用',
+    vip_counted TINYINT(1) NOT NULL DEFAULT 0 COMMENT '入队时是否计入了VIP邮件数',
+    refunded TINYINT(1) NOT NULL DEFAULT 0 COMMENT '最终失败后是否已退款',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '入队时间',
+    sent_at DATETIME NULL COMMENT '投递成功时间',
+    INDEX idx_status_next (status, next_attempt_at),
+    INDEX idx_email_id (email_id),
+    INDEX idx_user_id (user_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='发件箱表：异步投递队列';
@@ -0,0 +1,32 @@
+-- 后台任务调度表（job_scheduler.py）
+-- scheduled_jobs：每个定时任务一行，由调度主节点按代码中的注册信息同步，记录下次计划时间和最近一次执行结果；
+--   enabled 可手动改为 0 暂停某个任务（同步时不会覆盖）
+-- job_runs：每次执行一行（定时入队或管理员手动触发），工作线程用 SELECT ... FOR UPDATE SKIP LOCKED 认领（需要 MySQL 8.0+）
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    name VARCHAR(64) PRIMARY KEY COMMENT '任务名称',
+    cron VARCHAR(100) NULL COMMENT 'cron表达式（分 时 日 月 周），为空表示只能手动触发',
+    description VARCHAR(255) NULL COMMENT '任务说明',
+    enabled TINYINT(1) NOT NULL DEFAULT 1 COMMENT '是否按计划执行',
+    next_run_at DATETIME NULL COMMENT '下次计划执行时间',
+    last_run_at DATETIME NULL COMMENT '最近一次执行完成时间',
+    last_status VARCHAR(20) NULL COMMENT '最近一次执行结果',
+    last_duration_ms INT NULL COMMENT '最近一次执行耗时（毫秒）',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间'
+) COMMENT = '定时任务表';
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    job_name VARCHAR(64) NOT NULL COMMENT '任务名称',
+    status ENUM('queued', 'running', 'succeeded', 'failed') NOT NULL DEFAULT 'queued' COMMENT '状态',
+    trigger_type ENUM('schedule', 'manual') NOT NULL DEFAULT 'schedule' COMMENT '触发方式',
+    node VARCHAR(255) NULL COMMENT '执行节点（主机名-进程号）',
+    enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '入队时间',
+    started_at DATETIME NULL COMMENT '开始执行时间',
+    finished_at DATETIME NULL COMMENT '执行结束时间',
+    duration_ms INT NULL COMMENT '执行耗时（毫秒）',
+    result TEXT NULL COMMENT '执行结果（JSON）',
+    error TEXT NULL COMMENT '失败原因',
+    INDEX idx_status (status, id),
+    INDEX idx_job_name (job_name, id),
+    INDEX idx_enqueued_at (enqueued_at)
+) COMMENT = '任务执行记录表';
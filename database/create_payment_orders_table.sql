@@ -0,0 +1,29 @@
+-- 在线支付订单表：pay_confirm 生成订单号时创建，易支付异步通知按订单号推进状态
+-- 状态只通过 UPDATE ... WHERE order_no = 订单号 AND status = 旧状态 推进（比较并设置），
+-- 重复通知命中唯一索引后更新0行，直接返回，入账只会发生一次
+--   created -> paid（异步通知验签后立即标记并返回）-> credited（后台结算线程入账）
+--                                                    -> failed（金额不符等无法入账的情况）
+CREATE TABLE IF NOT EXISTS payment_orders (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY COMMENT '订单ID',
+    order_no VARCHAR(32) NOT NULL COMMENT '商户订单号',
+    user_id INT NOT NULL COMMENT '用户ID',
+    charge_type ENUM('balance', 'vip') NOT NULL COMMENT '充值类型：余额充值或会员购买',
+    amount DECIMAL(10,2) NOT NULL COMMENT '订单金额',
+    payment_method VARCHAR(20) NOT NULL COMMENT '支付方式',
+    status ENUM('created', 'paid', 'credited', 'failed') NOT NULL DEFAULT 'created' COMMENT '状态：已创建/已支付待入账/已入账/失败',
+    trade_no VARCHAR(64) NULL COMMENT '支付平台订单号',
+    paid_amount DECIMAL(10,2) NULL COMMENT '支付平台通知的实付金额',
+    failure_reason VARCHAR(255) NULL COMMENT '失败原因',
+    settle_attempts INT NOT NULL DEFAULT 0 COMMENT '入账尝试次数',
+    next_attempt_at TIMESTAMP NULL COMMENT '下次入账尝试时间',
+    last_error VARCHAR(255) NULL COMMENT '最近一次入账错误',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    paid_at TIMESTAMP NULL COMMENT '收到支付通知时间',
+    credited_at TIMESTAMP NULL COMMENT '入账时间',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+    UNIQUE KEY uk_order_no (order_no),
+    INDEX idx_user_created (user_id, created_at),
+    INDEX idx_status_created (status, created_at),
+    INDEX idx_status_next (status, next_attempt_at),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='在线支付订单表';
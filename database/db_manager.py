@@ -5,14 +5,53 @@
 """
 
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, IntegrityError
 import os
 import sys
+import threading
+from collections import Counter
+from email.utils import parseaddr
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import os
+import time
+from decimal import Decimal
+
+from database.cache import query_cache
+from database.query_stats import query_stats
+from metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS, DB_CONNECTIONS_OPEN, DB_CONNECTS
+from config import Config
+
+# 缓存命名空间：写操作调用 invalidate_cache 使对应缓存失效
+CACHE_DOMAINS = 'domains'
+CACHE_USER_EMAILS = 'user_emails'  # 包含域名名称和用户名，域名/用户修改时也要失效
+
+# 余额流水：扣款/入账失败的原因（作为 (success, message) 中的 message 返回）
+LEDGER_INSUFFICIENT = '余额不足'
+LEDGER_DUPLICATE = '该笔业务已入账'
+
+# 计费日汇总的统计项（billing_daily_rollups 除 user_id/day 以外的列）
+BILLING_ROLLUP_FIELDS = ('send_count', 'normal_count', 'vip_free_count', 'vip_over_count', 'send_cost',
+                         'recharge_count', 'recharge_amount', 'vip_purchase_count', 'vip_purchase_amount')
+
+# 邮件总数缓存范围：收件/删除时按范围增量调整，其余情况依靠短TTL刷新
+COUNT_SCOPE_ALL = 'emails:all'
+# 邮件表超过这个行数后，管理员查看全部邮件时显示 information_schema 中的估算值（"约 N 条"）
+COUNT_ESTIMATE_THRESHOLD = int(os.environ.get('COUNT_ESTIMATE_THRESHOLD', '50000'))
+
+
+def count_scope_address(email_address):
+    """按收发地址精确过滤的邮件总数"""
+    return f"emails:address:{(email_address or '').strip().lower()}"
+
+
+def count_scope_user(user_id, email_address=None):
+    """用户（可指定其名下某个邮箱）的隔离邮件总数"""
+    if email_address:
+        return f"emails:user:{user_id}:address:{email_address.strip().lower()}"
+    return f"emails:user:{user_id}"
 
 # 从环境变量或email_config获取数据库配置
 DB_HOST = os.environ.get('DB_HOST', 'localhost')
@@ -20,6 +59,33 @@ DB_USER = os.environ.get('DB_USER', 'root')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', '518107qW')
 DB_NAME = os.environ.get('DB_NAME', 'cloudfare_qq_mail')
 
+# 按线程统计查询次数（Web请求开始时清零，用于观察每个请求执行了多少条SQL）
+_query_stats = threading.local()
+
+
+def reset_query_count():
+    _query_stats.count = 0
+
+
+def get_query_count():
+    return getattr(_query_stats, 'count', 0)
+
+
+def _count_query():
+    _query_stats.count = get_query_count() + 1
+
+
+# 统计指标时跳过的内部包装函数，取真正发起查询的 DatabaseManager 方法名
+_QUERY_WRAPPERS = {'execute_query', 'execute_update', '_cached_count', 'load', '<lambda>', 'get_or_load', 'get_count'}
+
+
+def _query_method_name():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_name in _QUERY_WRAPPERS:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'unknown'
+
+
 class DatabaseManager:
     """数据库管理类"""
     
@@ -27,6 +93,7 @@ class DatabaseManager:
         """初始化数据库管理器"""
         self.connection = None
         self.cursor = None
+        self._connection_counted = False  # 当前连接是否已计入打开连接数指标
     
     def connect(self):
         """连接到数据库"""
@@ -40,10 +107,16 @@ class DatabaseManager:
             
             if self.connection.is_connected():
                 self.cursor = self.connection.cursor(dictionary=True)
+                DB_CONNECTS.inc(result='success')
+                if not self._connection_counted:
+                    # 未断开就重新连接时旧连接被替换，打开数不变
+                    DB_CONNECTIONS_OPEN.inc()
+                    self._connection_counted = True
                 print("✅ 数据库连接成功")
                 return True
                 
         except Error as e:
+            DB_CONNECTS.inc(result='failure')
             print(f"❌ 数据库连接失败: {e}")
             return False
     
@@ -53,6 +126,9 @@ class DatabaseManager:
             if self.cursor:
                 self.cursor.close()
             self.connection.close()
+            if self._connection_counted:
+                DB_CONNECTIONS_OPEN.dec()
+                self._connection_counted = False
             print("🔒 数据库连接已关闭")
     
     def execute_query(self, query, params=None):
@@ -64,6 +140,10 @@ class DatabaseManager:
                 print("❌ 无法重新连接到数据库")
                 return None
         
+        _count_query()
+        method = _query_method_name()
+        started = time.perf_counter()
+        failed = False
         try:
             if params:
                 self.cursor.execute(query, params)
@@ -71,10 +151,17 @@ class DatabaseManager:
                 self.cursor.execute(query)
             
             result = self.cursor.fetchall()
-            return result
         except Error as e:
+            failed = True
+            DB_QUERY_ERRORS.inc(method=method, kind='query')
             print(f"❌ 查询执行失败: {e}")
             return None
+        finally:
+            slow_entry = self._record_statement(method, 'query', query, params, started, failed)
+        
+        if slow_entry is not None and query_stats.should_explain(slow_entry):
+            self._explain_slow_statement(slow_entry, query, params)
+        return result
     
     def execute_update(self, query, params=None):
         """执行更新语句（INSERT, UPDATE, DELETE）"""
@@ -85,6 +172,10 @@ class DatabaseManager:
                 print("❌ 无法重新连接到数据库")
                 return -1
         
+        _count_query()
+        method = _query_method_name()
+        started = time.perf_counter()
+        failed = False
         try:
             if params:
                 self.cursor.execute(query, params)
@@ -92,11 +183,41 @@ class DatabaseManager:
                 self.cursor.execute(query)
             
             self.connection.commit()
-            return self.cursor.rowcount
+            rowcount = self.cursor.rowcount
         except Error as e:
+            failed = True
+            DB_QUERY_ERRORS.inc(method=method, kind='update')
             print(f"❌ 更新执行失败: {e}")
             self.connection.rollback()
             return -1
+        finally:
+            slow_entry = self._record_statement(method, 'update', query, params, started, failed)
+        
+        if slow_entry is not None and query_stats.should_explain(slow_entry):
+            self._explain_slow_statement(slow_entry, query, params)
+        return rowcount
+
+    def _record_statement(self, method, kind, query, params, started, failed):
+        """记录语句耗时（指标 + 按方法汇总 + 慢查询缓冲区），返回慢查询记录或None"""
+        elapsed = time.perf_counter() - started
+        DB_QUERY_SECONDS.observe(elapsed, method=method, kind=kind)
+        return query_stats.record(method, kind, query, params, elapsed, failed)
+
+    def _explain_slow_statement(self, entry, query, params):
+        """对抽样到的慢查询执行EXPLAIN（使用单独的游标，不影响当前结果，也不计入统计）"""
+        cursor = None
+        try:
+            cursor = self.connection.cursor(dictionary=True)
+            if params:
+                cursor.execute(f"EXPLAIN {query}", params)
+            else:
+                cursor.execute(f"EXPLAIN {query}")
+            entry['explain'] = cursor.fetchall()
+        except Error as e:
+            entry['explain'] = [{'error': str(e)}]
+        finally:
+            if cursor is not None:
+                cursor.close()
     
     def create_user(self, username, password, email=None, is_vip=False, is_admin=False, balance=0.0):
         """创建用户，返回用户ID"""
@@ -137,10 +258,45 @@ class DatabaseManager:
         result = self.execute_query(query, params)
         return result[0] if result else None
     
+    def invalidate_cache(self, *namespaces):
+        """数据已修改，使对应的缓存失效（所有Web进程共享）"""
+        query_cache.invalidate(*namespaces)
+
+    def _cached_count(self, scope, query, params=None):
+        """执行COUNT查询并按范围缓存（查询失败时返回0且不缓存）"""
+        def load():
+            result = self.execute_query(query, params)
+            return result[0]['count'] if result else None
+
+        count = query_cache.get_count(scope, load)
+        return count if count is not None else 0
+
+    def _adjust_email_counts(self, sender_email, receiver_email, delta):
+        """
+        新增/删除一封邮件后调整已缓存的总数
+        用户隔离查询按 user_emails 行连接，一封邮件匹配用户的几个邮箱就计几次，这里保持一致
+        """
+        if not query_cache.enabled:
+            return
+        deltas = Counter({COUNT_SCOPE_ALL: delta})
+        for raw in {(sender_email or '').strip().lower(), (receiver_email or '').strip().lower()}:
+            if raw:
+                deltas[count_scope_address(raw)] += delta
+
+        addresses = {parseaddr(value or '')[1].strip().lower() for value in (sender_email, receiver_email)}
+        addresses.discard('')
+        if addresses:
+            placeholders = ', '.join(['%s'] * len(addresses))
+            query = f"SELECT user_id, email_address FROM user_emails WHERE email_address IN ({placeholders})"
+            for row in self.execute_query(query, tuple(addresses)) or []:
+                deltas[count_scope_user(row['user_id'])] += delta
+                deltas[count_scope_user(row['user_id'], row['email_address'])] += delta
+        query_cache.adjust_counts(deltas)
+
     def get_all_domains(self):
-        """获取所有域名"""
+        """获取所有域名（缓存）"""
         query = "SELECT * FROM domains"
-        return self.execute_query(query)
+        return query_cache.get_or_load(CACHE_DOMAINS, 'all', lambda: self.execute_query(query))
     
     def create_domain(self, domain_name):
         """创建域名，返回域名ID"""
@@ -148,6 +304,7 @@ class DatabaseManager:
         params = (domain_name,)
         result = self.execute_update(query, params)
         if result > 0:
+            self.invalidate_cache(CACHE_DOMAINS)
             return self.cursor.lastrowid
         return 0
 
@@ -169,13 +326,19 @@ class DatabaseManager:
         """删除域名"""
         query = "DELETE FROM domains WHERE id = %s"
         params = (domain_id,)
-        return self.execute_update(query, params)
+        result = self.execute_update(query, params)
+        if result > 0:
+            self.invalidate_cache(CACHE_DOMAINS, CACHE_USER_EMAILS)
+        return result
 
     def update_domain(self, domain_id, domain_name):
         """更新域名"""
         query = "UPDATE domains SET domain_name = %s WHERE id = %s"
         params = (domain_name, domain_id)
-        return self.execute_update(query, params)
+        result = self.execute_update(query, params)
+        if result > 0:
+            self.invalidate_cache(CACHE_DOMAINS, CACHE_USER_EMAILS)
+        return result
 
     def get_emails_by_domain_id(self, domain_id):
         """获取指定域名ID下的所有邮箱"""
@@ -184,7 +347,7 @@ class DatabaseManager:
         return self.execute_query(query, params)
     
     def get_user_emails(self, user_id):
-        """获取用户的所有邮箱"""
+        """获取用户的所有邮箱（缓存）"""
         query = """
         SELECT ue.*, d.domain_name 
         FROM user_emails ue 
@@ -192,7 +355,8 @@ class DatabaseManager:
         WHERE ue.user_id = %s
         """
         params = (user_id,)
-        return self.execute_query(query, params)
+        return query_cache.get_or_load(CACHE_USER_EMAILS, f'user:{user_id}',
+                                       lambda: self.execute_query(query, params))
     
     def check_email_exists(self, email_address, domain_id):
         """检查邮箱是否已存在（同一域名下）"""
@@ -209,8 +373,46 @@ class DatabaseManager:
         
         query = "INSERT INTO user_emails (user_id, email_address, domain_id) VALUES (%s, %s, %s)"
         params = (user_id, email_address, domain_id)
-        return self.execute_update(query, params)
+        result = self.execute_update(query, params)
+        if result > 0:
+            self.invalidate_cache(CACHE_USER_EMAILS)
+        return result
     
+    def create_user_email_with_charge(self, user_id, email_address, domain_id, cost, description):
+        """
+        注册邮箱：扣费记流水、创建邮箱、写消费记录（和计费日汇总）在一个事务内完成，创建失败时不会扣款
+        Returns:
+            (success, message)：余额不足时 message 为 LEDGER_INSUFFICIENT
+        """
+        if not self._ensure_connection():
+            return False, "数据库连接失败"
+        try:
+            if cost > 0 and not self._apply_ledger_entry(user_id, -Decimal(str(cost)), 'email_registration',
+                                                         description=description):
+                self.connection.rollback()
+                return False, LEDGER_INSUFFICIENT
+            _count_query()
+            self.cursor.execute("SELECT COUNT(*) as count FROM user_emails WHERE email_address = %s AND domain_id = %s",
+                                (email_address, domain_id))
+            if self.cursor.fetchone()['count'] > 0:
+                self.connection.rollback()
+                return False, "该邮箱已被其他用户创建，请选择其他邮箱名"
+            _count_query()
+            self.cursor.execute("INSERT INTO user_emails (user_id, email_address, domain_id) VALUES (%s, %s, %s)",
+                                (user_id, email_address, domain_id))
+            if cost > 0:
+                self._insert_recharge_record(user_id, 'email_registration', cost, description)
+            self.connection.commit()
+        except IntegrityError:
+            self.connection.rollback()
+            return False, "该邮箱已被其他用户创建，请选择其他邮箱名"
+        except Error as e:
+            print(f"❌ 注册邮箱失败: {e}")
+            self.connection.rollback()
+            return False, "邮箱注册失败"
+        self.invalidate_cache(CACHE_USER_EMAILS)
+        return True, "成功"
+
     def save_email(self, sender_email, receiver_email, subject, content, sent_time):
         """保存邮件信息"""
         query = """
@@ -220,6 +422,10 @@ class DatabaseManager:
         params = (sender_email, receiver_email, subject, content, sent_time)
         result = self.execute_update(query, params)
         if result > 0:
+            try:
+                self._adjust_email_counts(sender_email, receiver_email, 1)
+            except Exception as e:
+                print(f"⚠️ 调整邮件总数缓存失败: {e}")
             # 获取插入的邮件ID
             try:
                 self.cursor.execute("SELECT LAST_INSERT_ID()")
@@ -304,7 +510,7 @@ class DatabaseManager:
             print(f"⚠️ 记录容量超限状态时出错: {e}")
 
     def cleanup_expired_mailboxes(self):
-        """清理已到期的超限邮箱（定时任务调用）"""
+        """清理已到期的超限邮箱（定时任务 mailbox_cleanup 调用），返回处理的用户数，出错返回-1"""
         try:
             from datetime import datetime
 
@@ -316,6 +522,9 @@ class DatabaseManager:
             current_time = datetime.now()
             expired_records = self.execute_query(query, (current_time,))
 
+            if expired_records is None:
+                return -1
+
             if expired_records:
                 for record in expired_records:
                     user_id = record['user_id']
@@ -330,9 +539,11 @@ class DatabaseManager:
                         print(f"🧹 用户 {user_id} 邮箱已清理 {deleted_count} 封旧邮件")
 
                 print(f"✅ 定时清理完成，处理了 {len(expired_records)} 个用户")
+            return len(expired_records)
 
         except Exception as e:
             print(f"⚠️ 定时清理邮箱时出错: {e}")
+            return -1
     
     def get_emails(self, limit=50, offset=0):
         """获取邮件列表"""
@@ -408,15 +619,69 @@ class DatabaseManager:
         WHERE sender_email = %s OR receiver_email = %s
         """
         params = (email_filter, email_filter)
-        result = self.execute_query(query, params)
-        return result[0]['count'] if result else 0
+        return self._cached_count(count_scope_address(email_filter), query, params)
     
     def get_emails_count(self):
         """获取所有邮件总数（管理员用）"""
         query = "SELECT COUNT(*) as count FROM emails"
+        return self._cached_count(COUNT_SCOPE_ALL, query)
+
+    def get_emails_count_estimate(self):
+        """
+        所有邮件总数，大表时使用估算值避免全表COUNT
+        Returns:
+            (count, is_exact)：优先使用已缓存的精确值；否则邮件表超过 COUNT_ESTIMATE_THRESHOLD 行时
+            返回 information_schema 中的统计行数（InnoDB为估算值）
+        """
+        cached = query_cache.peek_count(COUNT_SCOPE_ALL)
+        if cached is not None:
+            return cached, True
+
+        query = """
+        SELECT TABLE_ROWS as count FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'emails'
+        """
         result = self.execute_query(query)
-        return result[0]['count'] if result else 0
-    
+        estimate = result[0]['count'] if result else None
+        if estimate is None or estimate < COUNT_ESTIMATE_THRESHOLD:
+            return self.get_emails_count(), True
+        return estimate, False
+
+    def get_max_email_id(self):
+        """当前最大的邮件ID（新邮件推送从这里开始跟踪）"""
+        result = self.execute_query("SELECT COALESCE(MAX(id), 0) as max_id FROM emails")
+        return result[0]['max_id'] if result else 0
+
+    def get_emails_after_id(self, last_email_id, limit=200):
+        """获取ID大于 last_email_id 的新邮件摘要，以及收发地址所属的用户ID（逗号分隔）"""
+        query = """
+        SELECT e.id, e.sender_email, e.receiver_email, e.subject, e.sent_time,
+               GROUP_CONCAT(DISTINCT ue.user_id) as user_ids
+        FROM emails e
+        LEFT JOIN user_emails ue ON (
+            e.receiver_email = ue.email_address OR
+            e.sender_email = ue.email_address OR
+            e.receiver_email LIKE CONCAT('%<', ue.email_address, '>') OR
+            e.sender_email LIKE CONCAT('%<', ue.email_address, '>')
+        )
+        WHERE e.id > %s
+        GROUP BY e.id
+        ORDER BY e.id
+        LIMIT %s
+        """
+        result = self.execute_query(query, (last_email_id, limit))
+        return result if result else []
+
+    def get_user_ids_by_email_addresses(self, addresses):
+        """根据邮箱地址查找所属用户ID"""
+        addresses = [address for address in addresses if address]
+        if not addresses:
+            return []
+        placeholders = ', '.join(['%s'] * len(addresses))
+        query = f"SELECT DISTINCT user_id FROM user_emails WHERE email_address IN ({placeholders})"
+        result = self.execute_query(query, tuple(addresses))
+        return [row['user_id'] for row in result] if result else []
+
     def get_user_emails_with_isolation_by_email_filter(self, user_id, email_filter, limit=50, offset=0):
         """获取与指定用户相关且包含指定邮箱的邮件"""
         query = """
@@ -451,8 +716,7 @@ class DatabaseManager:
         AND ue.email_address = %s
         """
         params = (user_id, email_filter)
-        result = self.execute_query(query, params)
-        return result[0]['count'] if result else 0
+        return self._cached_count(count_scope_user(user_id, email_filter), query, params)
     
     def get_user_emails_count_with_isolation(self, user_id):
         """获取与指定用户相关的邮件总数"""
@@ -468,18 +732,17 @@ class DatabaseManager:
         WHERE ue.user_id = %s
         """
         params = (user_id,)
-        result = self.execute_query(query, params)
-        return result[0]['count'] if result else 0
+        return self._cached_count(count_scope_user(user_id), query, params)
     
     def get_all_user_emails(self):
-        """获取所有用户邮箱（管理员用）"""
+        """获取所有用户邮箱（管理员用，缓存）"""
         query = """
         SELECT DISTINCT ue.email_address, u.username
         FROM user_emails ue
         JOIN users u ON ue.user_id = u.id
         ORDER BY ue.email_address
         """
-        return self.execute_query(query)
+        return query_cache.get_or_load(CACHE_USER_EMAILS, 'all', lambda: self.execute_query(query))
     
     # 注册码相关方法
     def create_registration_code(self, code, description=None, created_by_user_id=None):
@@ -539,51 +802,28 @@ class DatabaseManager:
 
     # ========== 邮箱绑定相关方法 ==========
 
-    def create_verification_code(self, user_id, email_address, code, code_type, expires_at):
-        """创建验证码"""
-        query = """
-        INSERT INTO verification_codes (user_id, email_address, code, type, expires_at)
-        VALUES (%s, %s, %s, %s, %s)
-        """
-        params = (user_id, email_address, code, code_type, expires_at)
-        return self.execute_update(query, params)
+    # 验证码本身保存在 verification_store（带过期时间），verification_codes 表只剩旧数据等待清理
 
-    def get_verification_code(self, user_id, email_address, code, code_type):
-        """获取验证码"""
+    def purge_verification_codes(self, limit):
+        """删除一批已使用或已过期的旧验证码，返回删除行数"""
         query = """
-        SELECT * FROM verification_codes
-        WHERE user_id = %s AND email_address = %s AND code = %s AND type = %s
-        AND is_used = FALSE AND expires_at > NOW()
-        ORDER BY created_at DESC LIMIT 1
+        DELETE FROM verification_codes
+        WHERE is_used = TRUE OR expires_at <= NOW()
+        LIMIT %s
         """
-        params = (user_id, email_address, code, code_type)
-        result = self.execute_query(query, params)
-        return result[0] if result else None
+        return self.execute_update(query, (limit,))
 
-    def use_verification_code(self, code_id):
-        """标记验证码为已使用"""
-        query = "UPDATE verification_codes SET is_used = TRUE, used_at = NOW() WHERE id = %s"
-        params = (code_id,)
-        return self.execute_update(query, params)
-
-    def delete_verification_code(self, code_id):
-        """删除验证码"""
-        query = "DELETE FROM verification_codes WHERE id = %s"
-        params = (code_id,)
-        return self.execute_update(query, params)
-
-    def delete_user_verification_codes(self, user_id, email, code_type):
-        """删除用户指定邮箱和类型的所有验证码"""
-        query = "DELETE FROM verification_codes WHERE user_id = %s AND email_address = %s AND type = %s"
-        params = (user_id, email, code_type)
-        return self.execute_update(query, params)
+    def count_verification_codes(self):
+        """旧验证码表剩余行数"""
+        result = self.execute_query("SELECT COUNT(*) as count FROM verification_codes")
+        return result[0]['count'] if result else None
 
     def get_daily_verification_count(self, user_id, email_address, code_type):
         """获取用户今日验证码发送次数"""
         query = """
         SELECT COUNT(*) as count FROM verification_codes
         WHERE user_id = %s AND email_address = %s AND type = %s
-        AND DATE(created_at) = CURDATE()
+        AND created_at >= CURDATE()
         """
         params = (user_id, email_address, code_type)
         result = self.execute_query(query, params)
@@ -634,8 +874,7 @@ class DatabaseManager:
     def get_all_emails_count_for_admin(self):
         """管理员获取所有邮件总数"""
         query = "SELECT COUNT(*) as count FROM emails"
-        result = self.execute_query(query)
-        return result[0]['count'] if result else 0
+        return self._cached_count(COUNT_SCOPE_ALL, query)
 
     def get_admin_created_emails(self, admin_user_id, per_page=20, offset=0):
         """获取管理员创建的邮箱的邮件"""
@@ -657,8 +896,8 @@ class DatabaseManager:
         WHERE ue.created_by = %s
         """
         params = (admin_user_id,)
-        result = self.execute_query(query, params)
-        return result[0]['count'] if result else 0
+        # 该范围收件时不好判断归属，只依靠短TTL刷新
+        return self._cached_count(f"emails:admin:{admin_user_id}", query, params)
 
     def get_verification_limit(self, user_id, email_address, code_type):
         """获取验证码发送限制"""
@@ -722,6 +961,10 @@ class DatabaseManager:
 
     def update_user_vip_status(self, user_id, is_vip, expire_date=None, reset_count=True):
         """更新用户VIP状态"""
+        return self.execute_update(*self._vip_status_statement(user_id, is_vip, expire_date, reset_count))
+
+    def _vip_status_statement(self, user_id, is_vip, expire_date=None, reset_count=True):
+        """更新VIP状态的 (SQL, 参数)，供单独执行或在事务内执行"""
         from datetime import datetime
 
         if is_vip and expire_date:
@@ -729,10 +972,11 @@ class DatabaseManager:
                 # 新购买VIP，重置计数和开始时间
                 query = """
                 UPDATE users
-                SET is_vip = %s, vip_expire_date = %s, vip_email_count = 0, vip_start_date = %s
+                SET is_vip = %s, vip_expire_date = %s, vip_email_count = 0, quota_period_start = %s,
+                    vip_start_date = %s
                 WHERE id = %s
                 """
-                params = (is_vip, expire_date, datetime.now(), user_id)
+                params = (is_vip, expire_date, Config.current_quota_period(), datetime.now(), user_id)
             else:
                 # 续费VIP，只更新到期时间，不重置计数
                 query = """
@@ -749,7 +993,28 @@ class DatabaseManager:
             WHERE id = %s
             """
             params = (is_vip, user_id)
-        return self.execute_update(query, params)
+        return query, params
+
+    def _grant_vip_days(self, user_id, days):
+        """
+        在当前事务内开通或续费会员（不提交，锁定用户行）
+        会员有效时在现有到期时间上延长，不重置VIP邮件计数；否则从现在开始计算，重置计数、周期和开始时间
+        Returns:
+            新的到期时间；用户不存在时返回 None
+        """
+        from datetime import datetime, timedelta
+
+        _count_query()
+        self.cursor.execute("SELECT is_vip, vip_expire_date FROM users WHERE id = %s FOR UPDATE", (user_id,))
+        user = self.cursor.fetchone()
+        if not user:
+            return None
+        renewal = Config.is_vip_active(user)
+        start = user['vip_expire_date'] if renewal and user['vip_expire_date'] else datetime.now()
+        expire_date = start + timedelta(days=days)
+        _count_query()
+        self.cursor.execute(*self._vip_status_statement(user_id, True, expire_date, reset_count=not renewal))
+        return expire_date
 
     def get_vip_email_count(self, user_id):
         """获取用户VIP期间已发送邮件数量"""
@@ -891,6 +1156,72 @@ class DatabaseManager:
             print(f"❌ 注册用户异常: {e}")
             return {'success': False, 'message': f'注册过程出现异常: {str(e)}'}
 
+    # ========== 批量发码 ==========
+    # 由 code_issuer 在一个事务内调用（这里不提交）：多行 INSERT IGNORE 一次写入一批候选码，
+    # 与已有码冲突的行被忽略，再按批次号查出实际写入的码，只为冲突的部分重新生成
+
+    def insert_codes_ignore(self, kind, codes, batch_no, description=None, created_by_user_id=None, amount=None):
+        """
+        多行插入注册码/充值码，已存在的码被忽略（不提交）
+        Returns:
+            实际插入的行数
+        """
+        if kind == 'recharge':
+            query = "INSERT IGNORE INTO recharge_codes (code, amount, description, created_by_user_id, batch_no) VALUES "
+            placeholder = "(%s, %s, %s, %s, %s)"
+            params = [value for code in codes for value in (code, amount, description, created_by_user_id, batch_no)]
+        else:
+            query = """INSERT IGNORE INTO registration_codes
+            (code, description, created_by_user_id, batch_no, created_at, is_used) VALUES """
+            placeholder = "(%s, %s, %s, %s, NOW(), FALSE)"
+            params = [value for code in codes for value in (code, description, created_by_user_id, batch_no)]
+        _count_query()
+        self.cursor.execute(query + ', '.join([placeholder] * len(codes)), params)
+        return self.cursor.rowcount
+
+    def get_inserted_batch_codes(self, kind, batch_no, codes):
+        """候选码中实际写入本批次的码（与 insert_codes_ignore 在同一事务内调用）"""
+        table = 'recharge_codes' if kind == 'recharge' else 'registration_codes'
+        placeholders = ', '.join(['%s'] * len(codes))
+        _count_query()
+        self.cursor.execute(f"SELECT code FROM {table} WHERE batch_no = %s AND code IN ({placeholders})",
+                            [batch_no] + list(codes))
+        return [row['code'] for row in self.cursor.fetchall()]
+
+    def iter_batch_codes(self, kind, batch_no, chunk_size=1000):
+        """按ID分段读取一个批次的码（按主键游标翻页，导出大批次时不一次性读入内存）"""
+        if kind == 'recharge':
+            columns = "id, code, amount, is_used, created_at"
+            table = 'recharge_codes'
+        else:
+            columns = "id, code, is_used, created_at"
+            table = 'registration_codes'
+        last_id = 0
+        while True:
+            rows = self.execute_query(
+                f"SELECT {columns} FROM {table} WHERE batch_no = %s AND id > %s ORDER BY id LIMIT %s",
+                (batch_no, last_id, chunk_size))
+            if not rows:
+                return
+            yield rows
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]['id']
+
+    def get_code_batches(self, kind, limit=20):
+        """最近的生成批次（码数量、已使用数量）"""
+        table = 'recharge_codes' if kind == 'recharge' else 'registration_codes'
+        amount = ", MAX(amount) as amount" if kind == 'recharge' else ""
+        query = f"""
+        SELECT batch_no, COUNT(*) as count, SUM(is_used) as used, MIN(created_at) as created_at{amount}
+        FROM {table}
+        WHERE batch_no IS NOT NULL
+        GROUP BY batch_no
+        ORDER BY created_at DESC
+        LIMIT %s
+        """
+        return self.execute_query(query, (limit,)) or []
+
     # ========== 充值码管理方法 ==========
 
     def create_recharge_code(self, code, amount, description, created_by_user_id):
@@ -1064,9 +1395,14 @@ class DatabaseManager:
                     except Exception as e:
                         print(f"删除附件文件失败: {file_path}, 错误: {e}")
 
+            # 删除前记下收发地址，用于调整邮件总数缓存
+            email = self.execute_query("SELECT sender_email, receiver_email FROM emails WHERE id = %s", (email_id,))
+
             # 删除数据库记录
             self.execute_update("DELETE FROM attachments WHERE email_id = %s", (email_id,))
             result = self.execute_update("DELETE FROM emails WHERE id = %s", (email_id,))
+            if result > 0 and email:
+                self._adjust_email_counts(email[0]['sender_email'], email[0]['receiver_email'], -1)
             return result > 0
         except Exception as e:
             print(f"删除邮件失败: {e}")
@@ -1267,13 +1603,19 @@ class DatabaseManager:
         else:
             query = "UPDATE users SET username=%s, email=%s, is_vip=%s, balance=%s WHERE id=%s"
             params = (username, email, is_vip, balance, user_id)
-        return self.execute_update(query, params)
+        result = self.execute_update(query, params)
+        if result > 0:
+            self.invalidate_cache(CACHE_USER_EMAILS)
+        return result
     
     def delete_user(self, user_id):
-        """删除用户"""
+        """删除用户（邮箱随外键级联删除）"""
         query = "DELETE FROM users WHERE id=%s"
         params = (user_id,)
-        return self.execute_update(query, params)
+        result = self.execute_update(query, params)
+        if result > 0:
+            self.invalidate_cache(CACHE_USER_EMAILS)
+        return result
     
     def create_attachment(self, email_id, filename, file_path, file_size):
         """创建附件记录"""
@@ -1297,101 +1639,245 @@ class DatabaseManager:
         result = self.execute_query(query, params)
         return result[0] if result else None
     
-    # 会员和充值相关方法
-    def update_user_balance(self, user_id, amount):
-        """更新用户余额（增加金额）"""
-        query = "UPDATE users SET balance = balance + %s WHERE id = %s"
-        params = (amount, user_id)
-        return self.execute_update(query, params)
+    # ========== 余额流水 ==========
+    # 所有余额变动都通过这里：余额更新和流水插入在同一事务内提交
+    # 扣款是一条条件更新（balance >= 金额），并发扣款不会出现丢失更新或扣成负数
+    # (entry_type, reference) 唯一，同一笔业务（订单号、充值码等）重复入账会被拒绝
 
-    def set_user_balance(self, user_id, balance):
-        """设置用户余额（绝对值）"""
-        query = "UPDATE users SET balance = %s WHERE id = %s"
-        params = (balance, user_id)
-        return self.execute_update(query, params)
-    
-    def set_user_vip(self, user_id, expire_date):
-        """设置用户会员状态和过期时间"""
-        query = """
-        UPDATE users SET 
-            is_vip = TRUE, 
-            vip_expire_date = %s,
-            monthly_email_count = 0,
-            monthly_reset_date = CURDATE()
-        WHERE id = %s
-        """
-        params = (expire_date, user_id)
-        return self.execute_update(query, params)
-    
-    def check_and_update_vip_status(self, user_id):
-        """检查并更新会员状态（如果过期则取消）"""
-        from datetime import datetime
-        query = """
-        UPDATE users SET 
-            is_vip = FALSE, 
-            vip_expire_date = NULL
-        WHERE id = %s AND vip_expire_date IS NOT NULL AND vip_expire_date < NOW()
+    def _ensure_connection(self):
+        if not self.connection or not self.connection.is_connected():
+            return self.connect()
+        return True
+
+    def _apply_ledger_entry(self, user_id, amount, entry_type, reference=None, description=None):
         """
-        params = (user_id,)
-        self.execute_update(query, params)
-        
-        # 返回当前会员状态
-        user = self.get_user_by_id(user_id)
-        return user.get('is_vip', False) if user else False
-    
-    def reset_monthly_email_count_if_needed(self, user_id):
-        """如果需要，重置月度邮件计数"""
-        from datetime import date
-        query = """
-        UPDATE users SET 
-            monthly_email_count = 0,
-            monthly_reset_date = CURDATE()
-        WHERE id = %s AND (monthly_reset_date IS NULL OR monthly_reset_date < CURDATE())
+        在当前事务内变动余额并写流水（不提交，由调用方提交或回滚）
+        Returns:
+            True 成功；False 扣款时余额不足或用户不存在
+        Raises:
+            IntegrityError: 同一 (entry_type, reference) 已入账
         """
-        params = (user_id,)
-        return self.execute_update(query, params)
+        amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+        if amount == 0:
+            return True
+        _count_query()
+        if amount < 0:
+            self.cursor.execute("UPDATE users SET balance = balance + %s WHERE id = %s AND balance >= %s",
+                                (amount, user_id, -amount))
+        else:
+            self.cursor.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (amount, user_id))
+        if self.cursor.rowcount != 1:
+            return False
+        # 行锁在本事务内，读到的就是本次变动后的余额
+        _count_query()
+        self.cursor.execute("""
+        INSERT INTO balance_ledger (user_id, amount, balance_after, entry_type, reference, description)
+        SELECT id, %s, balance, %s, %s, %s FROM users WHERE id = %s
+        """, (amount, entry_type, reference, (description or '')[:255], user_id))
+        return True
+
+    def apply_balance_change(self, user_id, amount, entry_type, reference=None, description=None, record=None):
+        """
+        变动余额并记流水（单独事务）
+        amount 为正数入账，负数扣款（余额不足时不扣）
+        record 为 (充值记录类型, 描述) 时在同一事务内写一条金额为 |amount| 的充值/消费记录
+        Returns:
+            (success, message)：失败时 message 为 LEDGER_INSUFFICIENT、LEDGER_DUPLICATE 或错误信息
+        """
+        if not self._ensure_connection():
+            return False, "数据库连接失败"
+        try:
+            if not self._apply_ledger_entry(user_id, amount, entry_type, reference, description):
+                self.connection.rollback()
+                return False, LEDGER_INSUFFICIENT if Decimal(str(amount)) < 0 else "用户不存在"
+            if record:
+                recharge_type, record_description = record
+                self._insert_recharge_record(user_id, recharge_type, abs(Decimal(str(amount))), record_description)
+            self.connection.commit()
+            return True, "成功"
+        except IntegrityError:
+            self.connection.rollback()
+            return False, LEDGER_DUPLICATE
+        except Error as e:
+            print(f"❌ 余额变动失败: {e}")
+            self.connection.rollback()
+            return False, str(e)
+
+    def debit_balance(self, user_id, amount, entry_type, reference=None, description=None, record=None):
+        """扣款（余额不足时返回 (False, LEDGER_INSUFFICIENT)）"""
+        return self.apply_balance_change(user_id, -abs(Decimal(str(amount))), entry_type, reference, description,
+                                         record)
+
+    def credit_balance(self, user_id, amount, entry_type, reference=None, description=None, record=None):
+        """入账（reference 重复时返回 (False, LEDGER_DUPLICATE)）"""
+        return self.apply_balance_change(user_id, abs(Decimal(str(amount))), entry_type, reference, description,
+                                         record)
+
+    def purchase_vip_with_balance(self, user_id, cost, days, description):
+        """
+        余额购买会员：扣款记流水、开通或续费会员、写消费记录（和计费日汇总）在一个事务内完成
+        Returns:
+            (success, message)
+        """
+        if not self._ensure_connection():
+            return False, "数据库连接失败"
+        try:
+            if not self._apply_ledger_entry(user_id, -Decimal(str(cost)), 'vip_purchase', description=description):
+                self.connection.rollback()
+                return False, LEDGER_INSUFFICIENT
+            self._grant_vip_days(user_id, days)
+            self._insert_recharge_record(user_id, 'vip', cost, description)
+            self.connection.commit()
+            return True, "成功"
+        except Error as e:
+            print(f"❌ 余额购买会员失败: {e}")
+            self.connection.rollback()
+            return False, str(e)
+
+    def charge_send(self, user_id, cost, count_vip, reference=None):
+        """
+        发信扣费：扣余额、记流水、VIP邮件计数+1 在一个事务内完成
+        VIP邮件计数按周期（quota_period_start）累计，计数属于之前的周期时从1重新开始，跨月不需要单独重置
+        Returns:
+            (success, message)
+        """
+        if not self._ensure_connection():
+            return False, "数据库连接失败"
+        try:
+            if cost > 0 and not self._apply_ledger_entry(user_id, -Decimal(str(cost)), 'send_charge',
+                                                         reference, '发送邮件'):
+                self.connection.rollback()
+                return False, LEDGER_INSUFFICIENT
+            if count_vip:
+                period = Config.current_quota_period()
+                _count_query()
+                # 单表UPDATE按从左到右赋值：先用旧的 quota_period_start 计算计数，再更新周期
+                self.cursor.execute("""
+                UPDATE users
+                SET vip_email_count = IF(quota_period_start = %s, vip_email_count + 1, 1),
+                    quota_period_start = %s
+                WHERE id = %s
+                """, (period, period, user_id))
+            self.connection.commit()
+            return True, "成功"
+        except Error as e:
+            print(f"❌ 发信扣费失败: {e}")
+            self.connection.rollback()
+            return False, str(e)
+
+    def set_balance_by_admin(self, user_id, new_balance, admin_user_id=None):
+        """管理员直接修改余额：按差额记一条 admin_adjust 流水"""
+        if not self._ensure_connection():
+            return False, "数据库连接失败"
+        try:
+            _count_query()
+            self.cursor.execute("SELECT balance FROM users WHERE id = %s FOR UPDATE", (user_id,))
+            row = self.cursor.fetchone()
+            if not row:
+                self.connection.rollback()
+                return False, "用户不存在"
+            delta = Decimal(str(new_balance)).quantize(Decimal('0.01')) - Decimal(str(row['balance']))
+            if delta != 0:
+                self._apply_ledger_entry(user_id, delta, 'admin_adjust', None,
+                                         f"管理员调整余额（操作人ID:{admin_user_id}）")
+            self.connection.commit()
+            return True, "成功"
+        except Error as e:
+            print(f"❌ 调整余额失败: {e}")
+            self.connection.rollback()
+            return False, str(e)
+
+    def redeem_recharge_code(self, code, user_id):
+        """
+        兑换充值码：标记已使用、余额入账和充值记录在同一事务内完成，同一个码只能兑换一次
+        Returns:
+            (success, message, amount)
+        """
+        if not self._ensure_connection():
+            return False, "数据库连接失败", 0
+        try:
+            _count_query()
+            self.cursor.execute("""
+            UPDATE recharge_codes
+            SET is_used = TRUE, used_by_user_id = %s, used_at = NOW()
+            WHERE code = %s AND is_used = FALSE
+            """, (user_id, code))
+            if self.cursor.rowcount != 1:
+                self.connection.rollback()
+                return False, "充值码已被使用", 0
+            _count_query()
+            self.cursor.execute("SELECT amount FROM recharge_codes WHERE code = %s", (code,))
+            amount = self.cursor.fetchone()['amount']
+            self._apply_ledger_entry(user_id, amount, 'redeem_code', code, f'充值码兑换：{code}')
+            self._insert_recharge_record(user_id, 'balance', amount, f'充值码兑换：{code}')
+            self.connection.commit()
+            return True, "充值成功", amount
+        except Error as e:
+            print(f"❌ 兑换充值码失败: {e}")
+            self.connection.rollback()
+            return False, str(e), 0
+
+    def get_user_balance_ledger(self, user_id, limit=20):
+        """用户最近的余额流水"""
+        query = "SELECT * FROM balance_ledger WHERE user_id = %s ORDER BY id DESC LIMIT %s"
+        return self.execute_query(query, (user_id, limit)) or []
+
+    # 会员和充值相关方法
     
-    def increment_monthly_email_count(self, user_id):
-        """增加月度邮件计数"""
-        query = "UPDATE users SET monthly_email_count = monthly_email_count + 1 WHERE id = %s"
-        params = (user_id,)
-        return self.execute_update(query, params)
+    def set_user_vip(self, user_id, days=None, record=None):
+        """
+        开通或续费会员（有效会员在现有到期时间上延长）
+        record 为 (金额, 描述) 时在同一事务内写会员购买记录
+        Returns:
+            新的到期时间，失败返回 None
+        """
+        if not self._ensure_connection():
+            return None
+        try:
+            expire_date = self._grant_vip_days(user_id, days or Config.VIP_DURATION_DAYS)
+            if expire_date and record:
+                amount, description = record
+                self._insert_recharge_record(user_id, 'vip', amount, description)
+            self.connection.commit()
+            return expire_date
+        except Error as e:
+            print(f"❌ 开通会员失败: {e}")
+            self.connection.rollback()
+            return None
     
-    def get_user_monthly_stats(self, user_id):
-        """获取用户月度统计"""
+    def expire_vip_users(self, limit):
+        """
+        批量取消已到期的会员（定时任务调用，按 idx_vip_expire_date 范围扫描），返回本批取消的人数
+        发信、页面访问不再逐个用户检查到期；到期后尚未被取消的会员由 Config.is_vip_active 按非会员计费
+        """
         query = """
-        SELECT monthly_email_count, monthly_reset_date, is_vip, vip_expire_date, balance
-        FROM users WHERE id = %s
+        UPDATE users SET is_vip = FALSE, vip_expire_date = NULL
+        WHERE vip_expire_date < NOW()
+        LIMIT %s
         """
-        params = (user_id,)
-        result = self.execute_query(query, params)
-        return result[0] if result else None
-    
-    def calculate_email_cost(self, user_id):
-        """计算邮件发送费用"""
-        stats = self.get_user_monthly_stats(user_id)
-        if not stats:
-            return 0.4  # 默认普通用户费用
-        
-        is_vip = stats.get('is_vip', False)
-        monthly_count = stats.get('monthly_email_count', 0)
-        
-        if is_vip:
-            if monthly_count < 100:
-                return 0.0  # 会员用户前100条免费
-            else:
-                return 0.2  # 会员用户超出部分0.2元/条
-        else:
-            return 0.4  # 普通用户0.4元/条
+        return self.execute_update(query, (limit,))
     
     def add_recharge_record(self, user_id, recharge_type, amount, description=""):
-        """添加充值记录"""
-        query = """
+        """添加充值记录（同一事务内更新计费日汇总），返回写入行数，失败返回-1"""
+        if not self._ensure_connection():
+            return -1
+        try:
+            self._insert_recharge_record(user_id, recharge_type, amount, description)
+            self.connection.commit()
+            return 1
+        except Error as e:
+            print(f"❌ 添加充值记录失败: {e}")
+            self.connection.rollback()
+            return -1
+
+    def _insert_recharge_record(self, user_id, recharge_type, amount, description=""):
+        """在当前事务内写充值/消费记录并累加计费日汇总（不提交）"""
+        _count_query()
+        self.cursor.execute("""
         INSERT INTO recharge_records (user_id, type, amount, description)
         VALUES (%s, %s, %s, %s)
-        """
-        params = (user_id, recharge_type, amount, description)
-        return self.execute_update(query, params)
+        """, (user_id, recharge_type, amount, description))
+        self._bump_recharge_rollup(self.cursor.lastrowid)
 
     def add_billing_record(self, user_id, amount, type, description=""):
         """添加消费记录（通用方法）"""
@@ -1400,22 +1886,153 @@ class DatabaseManager:
             type = 'balance'
         return self.add_recharge_record(user_id, type, amount, description)
 
+    # ========== 在线支付订单 ==========
+    # 订单在 pay_confirm 创建，状态用比较并设置推进，重复通知更新0行直接返回：
+    #   created -> paid：异步通知验签后只做这一条更新就返回，不在回调里入账
+    #   paid -> credited：后台结算线程入账（失败按退避重试）
+
+    def create_payment_order(self, order_no, user_id, charge_type, amount, payment_method):
+        """创建支付订单（订单号唯一）"""
+        query = """
+        INSERT INTO payment_orders (order_no, user_id, charge_type, amount, payment_method)
+        VALUES (%s, %s, %s, %s, %s)
+        """
+        return self.execute_update(query, (order_no, user_id, charge_type, amount, payment_method))
+
+    def get_payment_order(self, order_no):
+        """按订单号获取支付订单"""
+        result = self.execute_query("SELECT * FROM payment_orders WHERE order_no = %s", (order_no,))
+        return result[0] if result else None
+
+    def mark_payment_order_paid(self, order_no, trade_no, paid_amount, payment_type):
+        """
+        收到支付成功通知：created -> paid，等待结算线程入账
+        Returns:
+            1 本次标记成功；0 订单不存在或已处理过（重复通知）；-1 数据库错误
+        """
+        query = """
+        UPDATE payment_orders
+        SET status = 'paid', trade_no = %s, paid_amount = %s, payment_method = %s,
+            paid_at = NOW(), next_attempt_at = NOW()
+        WHERE order_no = %s AND status = 'created'
+        """
+        return self.execute_update(query, (trade_no, paid_amount, payment_type, order_no))
+
+    def create_paid_payment_order(self, order_no, user_id, charge_type, paid_amount, payment_type, trade_no):
+        """补建已支付的订单（兼容没有订单记录的旧订单号），订单号已存在时不做任何修改"""
+        query = """
+        INSERT IGNORE INTO payment_orders
+            (order_no, user_id, charge_type, amount, payment_method, status, trade_no, paid_amount,
+             paid_at, next_attempt_at)
+        VALUES (%s, %s, %s, %s, %s, 'paid', %s, %s, NOW(), NOW())
+        """
+        return self.execute_update(query, (order_no, user_id, charge_type, paid_amount, payment_type,
+                                           trade_no, paid_amount))
+
+    def get_due_payment_orders(self, limit=20):
+        """待入账且到达重试时间的订单（waited_seconds 为收到通知至今的秒数）"""
+        query = """
+        SELECT *, TIMESTAMPDIFF(SECOND, paid_at, NOW()) as waited_seconds
+        FROM payment_orders
+        WHERE status = 'paid' AND next_attempt_at <= NOW()
+        ORDER BY next_attempt_at
+        LIMIT %s
+        """
+        return self.execute_query(query, (limit,)) or []
+
+    def get_settlement_backlog(self):
+        """待入账订单数和最早一笔的等待秒数"""
+        query = """
+        SELECT COUNT(*) as pending, COALESCE(TIMESTAMPDIFF(SECOND, MIN(paid_at), NOW()), 0) as oldest_seconds
+        FROM payment_orders WHERE status = 'paid'
+        """
+        result = self.execute_query(query)
+        return result[0] if result else None
+
+    def mark_payment_order_retry(self, order_no, error, delay_seconds):
+        """入账失败，延迟后重试"""
+        query = """
+        UPDATE payment_orders
+        SET settle_attempts = settle_attempts + 1, last_error = %s,
+            next_attempt_at = DATE_ADD(NOW(), INTERVAL %s SECOND)
+        WHERE order_no = %s AND status = 'paid'
+        """
+        return self.execute_update(query, (error[:255], delay_seconds, order_no))
+
+    def fail_payment_order(self, order_no, reason):
+        """无法入账的订单标记为失败（已入账的订单不受影响）"""
+        query = """
+        UPDATE payment_orders SET status = 'failed', failure_reason = %s
+        WHERE order_no = %s AND status IN ('created', 'paid')
+        """
+        return self.execute_update(query, (reason[:255], order_no))
+
+    def settle_payment_order(self, order, vip_days=30):
+        """
+        已支付订单入账：状态 paid -> credited、余额入账或开通会员、充值记录在同一事务内完成
+        Args:
+            order: get_due_payment_orders 返回的订单
+        Returns:
+            'credited' 本次入账成功；'duplicate' 订单已被其他线程/进程入账；
+            'amount_mismatch' 实付金额与订单金额不符（订单标记为失败）；'error' 数据库错误（可重试）
+        """
+        order_no = order['order_no']
+        if Decimal(str(order['paid_amount'])) != Decimal(str(order['amount'])):
+            self.fail_payment_order(order_no, f"支付金额 {order['paid_amount']} 与订单金额 {order['amount']} 不符")
+            return 'amount_mismatch'
+
+        if not self._ensure_connection():
+            return 'error'
+        try:
+            _count_query()
+            self.cursor.execute("""
+            UPDATE payment_orders SET status = 'credited', credited_at = NOW()
+            WHERE order_no = %s AND status = 'paid'
+            """, (order_no,))
+            if self.cursor.rowcount != 1:
+                self.connection.rollback()
+                return 'duplicate'
+
+            user_id, amount = order['user_id'], order['amount']
+            payment_type, trade_no = order['payment_method'], order['trade_no']
+            if order['charge_type'] == 'balance':
+                self._apply_ledger_entry(user_id, amount, 'payment', order_no, f"易支付余额充值（{payment_type}）")
+                description = f"易支付余额充值¥{amount:.2f}（{payment_type}，订单号:{order_no}，平台单号:{trade_no}）"
+            else:
+                self._grant_vip_days(user_id, vip_days)
+                description = f"易支付会员购买¥{amount:.2f}（{payment_type}，订单号:{order_no}，平台单号:{trade_no}）"
+
+            self._insert_recharge_record(user_id, order['charge_type'], amount, description)
+            self.connection.commit()
+            return 'credited'
+        except IntegrityError:
+            # 该订单号已有入账流水（通过其他途径入过账），只补上订单状态
+            self.connection.rollback()
+            self.execute_update("""
+            UPDATE payment_orders SET status = 'credited', credited_at = NOW()
+            WHERE order_no = %s AND status = 'paid'
+            """, (order_no,))
+            return 'duplicate'
+        except Error as e:
+            print(f"❌ 支付订单入账失败: {e}")
+            self.connection.rollback()
+            return 'error'
+
     def get_monthly_email_stats(self, user_id):
-        """获取用户本月邮件发送统计"""
-        from datetime import datetime
+        """获取用户本月邮件发送统计（读计费日汇总，最多31行）"""
+        from datetime import date
 
         # 获取本月第一天
-        now = datetime.now()
-        month_start = datetime(now.year, now.month, 1)
+        month_start = date.today().replace(day=1)
 
         query = """
         SELECT
-            COUNT(*) as total_count,
-            SUM(CASE WHEN cost = 0.4 THEN 1 ELSE 0 END) as normal_count,
-            SUM(CASE WHEN cost = 0.0 AND is_vip_free = 1 THEN 1 ELSE 0 END) as vip_free_count,
-            SUM(CASE WHEN cost = 0.2 THEN 1 ELSE 0 END) as vip_over_count
-        FROM email_send_records
-        WHERE user_id = %s AND sent_at >= %s
+            SUM(send_count) as total_count,
+            SUM(normal_count) as normal_count,
+            SUM(vip_free_count) as vip_free_count,
+            SUM(vip_over_count) as vip_over_count
+        FROM billing_daily_rollups
+        WHERE user_id = %s AND day >= %s
         """
         params = (user_id, month_start)
         result = self.execute_query(query, params)
@@ -1423,10 +2040,10 @@ class DatabaseManager:
         if result:
             stats = result[0]
             return {
-                'total_count': stats['total_count'] or 0,
-                'normal_count': stats['normal_count'] or 0,  # 普通用户¥0.4/条
-                'vip_free_count': stats['vip_free_count'] or 0,  # VIP免费
-                'vip_over_count': stats['vip_over_count'] or 0,  # VIP超额¥0.2/条
+                'total_count': int(stats['total_count'] or 0),
+                'normal_count': int(stats['normal_count'] or 0),  # 普通用户计费
+                'vip_free_count': int(stats['vip_free_count'] or 0),  # VIP免费
+                'vip_over_count': int(stats['vip_over_count'] or 0),  # VIP超额计费
             }
         else:
             return {
@@ -1468,7 +2085,137 @@ class DatabaseManager:
         """
         params = (user_id, limit)
         return self.execute_query(query, params)
-    
+
+    # ========== 计费日汇总 ==========
+    # billing_daily_rollups 每个用户每天一行，由写入明细的事务顺带增量更新，统计页面只读汇总行：
+    #   发信：email_outbox 入队 +1，投递最终失败退款 -1（记在入队当天），即未退款的发件记录
+    #   充值：recharge_records 每写入一条 +1（type=balance 计为余额充值，type=vip 计为会员购买）
+    # 分类按入队时记录的 vip_counted / charged_amount 判断，不依赖具体单价
+
+    SEND_ROLLUP_SELECT = """
+        SELECT user_id, DATE(created_at) AS day,
+               {sign} * COUNT(*) AS send_count,
+               {sign} * SUM(vip_counted = 0) AS normal_count,
+               {sign} * SUM(vip_counted = 1 AND charged_amount = 0) AS vip_free_count,
+               {sign} * SUM(vip_counted = 1 AND charged_amount > 0) AS vip_over_count,
+               {sign} * SUM(charged_amount) AS send_cost
+        FROM email_outbox
+        WHERE {where}
+        GROUP BY user_id, DATE(created_at)
+    """
+
+    RECHARGE_ROLLUP_SELECT = """
+        SELECT user_id, DATE(created_at) AS day,
+               SUM(type = 'balance') AS recharge_count,
+               SUM(IF(type = 'balance', amount, 0)) AS recharge_amount,
+               SUM(type = 'vip') AS vip_purchase_count,
+               SUM(IF(type = 'vip', amount, 0)) AS vip_purchase_amount
+        FROM recharge_records
+        WHERE {where}
+        GROUP BY user_id, DATE(created_at)
+    """
+
+    def _bump_send_rollup(self, outbox_id, sign):
+        """按发件记录增减当天的发信汇总（不提交）"""
+        _count_query()
+        self.cursor.execute(f"""
+        INSERT INTO billing_daily_rollups
+            (user_id, day, send_count, normal_count, vip_free_count, vip_over_count, send_cost)
+        SELECT * FROM ({self.SEND_ROLLUP_SELECT.format(sign=int(sign), where='id = %s')}) AS s
+        ON DUPLICATE KEY UPDATE
+            send_count = billing_daily_rollups.send_count + VALUES(send_count),
+            normal_count = billing_daily_rollups.normal_count + VALUES(normal_count),
+            vip_free_count = billing_daily_rollups.vip_free_count + VALUES(vip_free_count),
+            vip_over_count = billing_daily_rollups.vip_over_count + VALUES(vip_over_count),
+            send_cost = billing_daily_rollups.send_cost + VALUES(send_cost)
+        """, (outbox_id,))
+
+    def _bump_recharge_rollup(self, record_id):
+        """按充值记录累加当天的充值汇总（不提交）"""
+        _count_query()
+        self.cursor.execute(f"""
+        INSERT INTO billing_daily_rollups
+            (user_id, day, recharge_count, recharge_amount, vip_purchase_count, vip_purchase_amount)
+        SELECT * FROM ({self.RECHARGE_ROLLUP_SELECT.format(where='id = %s')}) AS s
+        ON DUPLICATE KEY UPDATE
+            recharge_count = billing_daily_rollups.recharge_count + VALUES(recharge_count),
+            recharge_amount = billing_daily_rollups.recharge_amount + VALUES(recharge_amount),
+            vip_purchase_count = billing_daily_rollups.vip_purchase_count + VALUES(vip_purchase_count),
+            vip_purchase_amount = billing_daily_rollups.vip_purchase_amount + VALUES(vip_purchase_amount)
+        """, (record_id,))
+
+    def rebuild_billing_rollups(self, day):
+        """用明细表重新计算某一天的汇总（删除后重建，一个事务），返回是否成功"""
+        if not self._ensure_connection():
+            return False
+        where = 'created_at >= %s AND created_at < DATE_ADD(%s, INTERVAL 1 DAY)'
+        try:
+            _count_query()
+            self.cursor.execute("DELETE FROM billing_daily_rollups WHERE day = %s", (day,))
+            _count_query()
+            self.cursor.execute(f"""
+            INSERT INTO billing_daily_rollups
+                (user_id, day, send_count, normal_count, vip_free_count, vip_over_count, send_cost)
+            {self.SEND_ROLLUP_SELECT.format(sign=1, where=where + ' AND refunded = 0')}
+            """, (day, day))
+            _count_query()
+            self.cursor.execute(f"""
+            INSERT INTO billing_daily_rollups
+                (user_id, day, recharge_count, recharge_amount, vip_purchase_count, vip_purchase_amount)
+            SELECT * FROM ({self.RECHARGE_ROLLUP_SELECT.format(where=where)}) AS s
+            ON DUPLICATE KEY UPDATE
+                recharge_count = VALUES(recharge_count),
+                recharge_amount = VALUES(recharge_amount),
+                vip_purchase_count = VALUES(vip_purchase_count),
+                vip_purchase_amount = VALUES(vip_purchase_amount)
+            """, (day, day))
+            self.connection.commit()
+            return True
+        except Error as e:
+            print(f"❌ 重建 {day} 计费汇总失败: {e}")
+            self.connection.rollback()
+            return False
+
+    def compute_billing_rollups(self, day):
+        """用明细表计算某一天每个用户应有的汇总（不写库），返回 {user_id: 各项数值}"""
+        where = 'created_at >= %s AND created_at < DATE_ADD(%s, INTERVAL 1 DAY)'
+        expected = {}
+        sends = self.execute_query(self.SEND_ROLLUP_SELECT.format(sign=1, where=where + ' AND refunded = 0'),
+                                   (day, day))
+        recharges = self.execute_query(self.RECHARGE_ROLLUP_SELECT.format(where=where), (day, day))
+        if sends is None or recharges is None:
+            return None
+        for row in sends + recharges:
+            values = expected.setdefault(row['user_id'], dict.fromkeys(BILLING_ROLLUP_FIELDS, 0))
+            for field in BILLING_ROLLUP_FIELDS:
+                if field in row:
+                    values[field] = row[field] or 0
+        return expected
+
+    def get_billing_rollups_for_day(self, day):
+        """某一天已有的汇总行，返回 {user_id: 各项数值}"""
+        rows = self.execute_query("SELECT * FROM billing_daily_rollups WHERE day = %s", (day,))
+        if rows is None:
+            return None
+        return {row['user_id']: {field: row[field] for field in BILLING_ROLLUP_FIELDS} for row in rows}
+
+    def get_billing_daily_totals(self, start_day):
+        """从 start_day 起每天全站的计费合计（管理员统计）"""
+        query = """
+        SELECT day,
+               SUM(send_count) as send_count, SUM(normal_count) as normal_count,
+               SUM(vip_free_count) as vip_free_count, SUM(vip_over_count) as vip_over_count,
+               SUM(send_cost) as send_cost,
+               SUM(recharge_count) as recharge_count, SUM(recharge_amount) as recharge_amount,
+               SUM(vip_purchase_count) as vip_purchase_count, SUM(vip_purchase_amount) as vip_purchase_amount,
+               COUNT(*) as active_users
+        FROM billing_daily_rollups
+        WHERE day >= %s
+        GROUP BY day
+        ORDER BY day
+        """
+        return self.execute_query(query, (start_day,)) or []
+
     # 待确认支付管理方法
     def create_pending_payment(self, record_data):
         """创建待确认支付记录"""
@@ -1543,24 +2290,20 @@ class DatabaseManager:
             
             # 处理充值
             if payment['payment_type'] == 'balance':
-                # 余额充值
-                success = self.update_user_balance(payment['user_id'], payment['amount'])
-                if success:
-                    description = f"余额充值¥{payment['amount']}（{payment['payment_method']}支付，管理员确认）"
-                    if admin_note:
-                        description += f" 备注：{admin_note}"
-                    self.add_recharge_record(payment['user_id'], 'balance', payment['amount'], description)
+                # 余额充值（以待支付记录ID防止重复入账）
+                description = f"余额充值¥{payment['amount']}（{payment['payment_method']}支付，管理员确认）"
+                if admin_note:
+                    description += f" 备注：{admin_note}"
+                self.credit_balance(payment['user_id'], payment['amount'], 'payment',
+                                    f"pending:{payment['id']}", '待支付订单管理员确认',
+                                    record=('balance', description))
                     
             elif payment['payment_type'] == 'vip':
-                # 会员购买
-                from datetime import datetime, timedelta
-                expire_date = datetime.now() + timedelta(days=30)
-                self.set_user_vip(payment['user_id'], expire_date)
-                
+                # 会员购买（开通和购买记录同一事务）
                 description = f"会员购买（1个月，{payment['payment_method']}支付，管理员确认）"
                 if admin_note:
                     description += f" 备注：{admin_note}"
-                self.add_recharge_record(payment['user_id'], 'vip', payment['amount'], description)
+                self.set_user_vip(payment['user_id'], record=(payment['amount'], description))
             
             # 更新支付记录状态
             from datetime import datetime
@@ -1596,6 +2339,361 @@ class DatabaseManager:
             print(f"❌ 取消支付失败: {e}")
             return False, f"取消失败: {str(e)}"
 
+    # ========== 发件箱（异步投递） ==========
+
+    def queue_outgoing_email(self, user_id, from_email, to_email, subject, content,
+                             charged_amount=0.0, vip_counted=False, store_attachments=None):
+        """
+        保存发件邮件和附件记录并加入发件箱，在一个事务内完成（任一步失败全部回滚，不会留下没有入队的邮件）
+        Args:
+            store_attachments: store_attachments(email_id) 把附件文件放到该邮件的目录，
+                返回附件记录列表 [{'filename', 'path', 'size', ...}]；回滚后由调用方删除文件
+        Returns:
+            (email_id, outbox_id, attachment_records)
+        Raises:
+            Exception: 保存或入队失败（事务已回滚）
+        """
+        import json
+        from datetime import datetime
+
+        if not self._ensure_connection():
+            raise Exception("数据库连接失败")
+        try:
+            _count_query()
+            self.cursor.execute("""
+            INSERT INTO emails (sender_email, receiver_email, subject, content, sent_time)
+            VALUES (%s, %s, %s, %s, %s)
+            """, (from_email, to_email, subject, content, datetime.now()))
+            email_id = self.cursor.lastrowid
+
+            attachment_records = store_attachments(email_id) if store_attachments else []
+            for record in attachment_records:
+                _count_query()
+                self.cursor.execute("""
+                INSERT INTO attachments (email_id, filename, file_path, file_size)
+                VALUES (%s, %s, %s, %s)
+                """, (email_id, record['filename'], record['path'], record['size']))
+
+            _count_query()
+            self.cursor.execute("""
+            INSERT INTO email_outbox (user_id, email_id, from_email, to_email, subject, content,
+                                      attachments_json, status, next_attempt_at, charged_amount, vip_counted)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 'queued', NOW(), %s, %s)
+            """, (user_id, email_id, from_email, to_email, subject, content,
+                  json.dumps(attachment_records, ensure_ascii=False) if attachment_records else None,
+                  charged_amount, vip_counted))
+            outbox_id = self.cursor.lastrowid
+            self._bump_send_rollup(outbox_id, 1)
+            self.connection.commit()
+        except Exception:
+            if self.connection and self.connection.is_connected():
+                self.connection.rollback()
+            raise
+
+        try:
+            self._adjust_email_counts(from_email, to_email, 1)
+        except Exception as e:
+            print(f"⚠️ 调整邮件总数缓存失败: {e}")
+        return email_id, outbox_id, attachment_records
+
+    def claim_outbox_entries(self, worker_id, limit=10):
+        """
+        认领到期的待发邮件（条件更新，多个发送线程/进程不会认领到同一封）
+        返回本次认领到的记录
+        """
+        claim_query = """
+        UPDATE email_outbox
+        SET status = 'sending', locked_by = %s, locked_at = NOW(), attempts = attempts + 1
+        WHERE status = 'queued' AND next_attempt_at <= NOW()
+        ORDER BY id
+        LIMIT %s
+        """
+        claimed = self.execute_update(claim_query, (worker_id, limit))
+        if claimed <= 0:
+            return []
+
+        query = "SELECT * FROM email_outbox WHERE status = 'sending' AND locked_by = %s ORDER BY id"
+        return self.execute_query(query, (worker_id,)) or []
+
+    def mark_outbox_sent(self, outbox_id, worker_id, provider_message_id):
+        """投递成功"""
+        query = """
+        UPDATE email_outbox
+        SET status = 'sent', provider_message_id = %s, sent_at = NOW(), last_error = NULL, locked_by = NULL
+        WHERE id = %s AND status = 'sending' AND locked_by = %s
+        """
+        return self.execute_update(query, (provider_message_id, outbox_id, worker_id))
+
+    def mark_outbox_retry(self, outbox_id, worker_id, error, delay_seconds):
+        """投递失败，延迟后重新入队"""
+        query = """
+        UPDATE email_outbox
+        SET status = 'queued', last_error = %s, locked_by = NULL,
+            next_attempt_at = DATE_ADD(NOW(), INTERVAL %s SECOND)
+        WHERE id = %s AND status = 'sending' AND locked_by = %s
+        """
+        return self.execute_update(query, (str(error)[:1000], int(delay_seconds), outbox_id, worker_id))
+
+    def fail_outbox_entry_and_refund(self, outbox_id, worker_id, error):
+        """
+        最终失败：标记失败并退还入队时扣除的费用和VIP邮件计数
+        状态更新和退款在同一事务内完成，只有抢到状态更新的一方才会退款
+        """
+        if not self.connection or not self.connection.is_connected():
+            if not self.connect():
+                return False
+
+        try:
+            self.cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'failed', last_error = %s, locked_by = NULL, refunded = 1
+            WHERE id = %s AND status = 'sending' AND locked_by = %s
+            """, (str(error)[:1000], outbox_id, worker_id))
+            if self.cursor.rowcount != 1:
+                self.connection.rollback()
+                return False
+
+            self.cursor.execute("SELECT user_id, charged_amount, vip_counted FROM email_outbox WHERE id = %s", (outbox_id,))
+            entry = self.cursor.fetchone()
+            if entry['charged_amount'] and float(entry['charged_amount']) > 0:
+                self._apply_ledger_entry(entry['user_id'], entry['charged_amount'], 'send_refund',
+                                         f"outbox:{outbox_id}", '邮件投递失败退款')
+            if entry['vip_counted']:
+                self._uncount_vip_email(entry['user_id'])
+            self._bump_send_rollup(outbox_id, -1)
+
+            self.connection.commit()
+            return True
+        except Error as e:
+            print(f"❌ 发件失败退款出错: {e}")
+            self.connection.rollback()
+            return False
+
+    def refund_send_charge(self, user_id, amount, vip_counted):
+        """邮件未能入队时退还已扣除的费用和VIP邮件计数（一个事务），返回是否成功"""
+        if not self._ensure_connection():
+            return False
+        try:
+            if amount and float(amount) > 0:
+                self._apply_ledger_entry(user_id, amount, 'send_refund', None, '邮件入队失败退款')
+            if vip_counted:
+                self._uncount_vip_email(user_id)
+            self.connection.commit()
+            return True
+        except Error as e:
+            print(f"❌ 入队失败退款出错: {e}")
+            self.connection.rollback()
+            return False
+
+    def _uncount_vip_email(self, user_id):
+        """退还一条VIP邮件计数（不提交；计数已进入新周期时不退）"""
+        _count_query()
+        self.cursor.execute("""
+        UPDATE users SET vip_email_count = GREATEST(vip_email_count - 1, 0)
+        WHERE id = %s AND quota_period_start = %s
+        """, (user_id, Config.current_quota_period()))
+
+    def requeue_stale_outbox_entries(self, stale_seconds):
+        """把认领后长时间未完成（发送线程异常退出）的记录重新入队"""
+        query = """
+        UPDATE email_outbox
+        SET status = 'queued', locked_by = NULL, next_attempt_at = NOW()
+        WHERE status = 'sending' AND locked_at < DATE_SUB(NOW(), INTERVAL %s SECOND)
+        """
+        return self.execute_update(query, (int(stale_seconds),))
+
+    def get_outbox_status_by_email_ids(self, email_ids):
+        """批量获取邮件的投递状态，返回 {email_id: outbox记录}"""
+        if not email_ids:
+            return {}
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        query = f"""
+        SELECT email_id, status, attempts, last_error, sent_at
+        FROM email_outbox
+        WHERE email_id IN ({placeholders})
+        """
+        rows = self.execute_query(query, tuple(email_ids)) or []
+        return {row['email_id']: row for row in rows}
+
+    # ========== 后台任务调度 ==========
+
+    def acquire_named_lock(self, name):
+        """不等待地获取 MySQL 命名锁（GET_LOCK），锁属于当前连接，连接断开时自动释放"""
+        result = self.execute_query("SELECT GET_LOCK(%s, 0) AS acquired", (name,))
+        return bool(result) and result[0]['acquired'] == 1
+
+    def holds_named_lock(self, name):
+        """当前连接是否仍持有命名锁（连接断开重连后返回 False）"""
+        result = self.execute_query("SELECT IS_USED_LOCK(%s) = CONNECTION_ID() AS held", (name,))
+        return bool(result) and result[0]['held'] == 1
+
+    def release_named_lock(self, name):
+        result = self.execute_query("SELECT RELEASE_LOCK(%s) AS released", (name,))
+        return bool(result) and result[0]['released'] == 1
+
+    def sync_scheduled_job(self, name, cron, description, next_run_at):
+        """
+        按代码中的注册信息创建或更新定时任务（不修改 enabled）
+        cron 没变时保留原来的下次执行时间，变了才使用新算出的 next_run_at
+        """
+        query = """
+        INSERT INTO scheduled_jobs (name, cron, description, next_run_at)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            next_run_at = IF(cron <=> VALUES(cron) AND (next_run_at IS NOT NULL OR cron IS NULL),
+                             next_run_at, VALUES(next_run_at)),
+            cron = VALUES(cron),
+            description = VALUES(description)
+        """
+        return self.execute_update(query, (name, cron, description, next_run_at))
+
+    def get_due_scheduled_jobs(self, now):
+        """到达计划时间的任务"""
+        query = """
+        SELECT name, next_run_at FROM scheduled_jobs
+        WHERE enabled = 1 AND next_run_at <= %s
+        ORDER BY next_run_at
+        """
+        return self.execute_query(query, (now,)) or []
+
+    def enqueue_job_run(self, job_name, trigger_type, next_run_at=None):
+        """
+        任务入队；next_run_at 不为空时同时推进下次计划时间
+        同一任务已有排队或执行中的记录时不再入队（错过的计划执行合并为一次）
+        Returns:
+            执行记录ID；已有未完成的执行返回0；任务不存在或出错返回-1
+        """
+        if not self._ensure_connection():
+            return -1
+        try:
+            # 锁住任务行，主节点定时入队和管理员手动触发不会同时插入
+            _count_query()
+            self.cursor.execute("SELECT name FROM scheduled_jobs WHERE name = %s FOR UPDATE", (job_name,))
+            if self.cursor.fetchone() is None:
+                self.connection.rollback()
+                return -1
+
+            _count_query()
+            self.cursor.execute("""
+            SELECT id FROM job_runs WHERE job_name = %s AND status IN ('queued', 'running') LIMIT 1
+            """, (job_name,))
+            run_id = 0
+            if self.cursor.fetchone() is None:
+                _count_query()
+                self.cursor.execute("INSERT INTO job_runs (job_name, trigger_type) VALUES (%s, %s)",
+                                    (job_name, trigger_type))
+                run_id = self.cursor.lastrowid
+
+            if next_run_at is not None:
+                _count_query()
+                self.cursor.execute("UPDATE scheduled_jobs SET next_run_at = %s WHERE name = %s",
+                                    (next_run_at, job_name))
+            self.connection.commit()
+            return run_id
+        except Error as e:
+            print(f"❌ 任务入队失败: {e}")
+            self.connection.rollback()
+            return -1
+
+    def claim_job_run(self, node, job_names):
+        """
+        认领一条排队中的执行记录（只认领本节点注册了的任务）
+        SKIP LOCKED 跳过其他节点正在认领的行，多个工作线程/节点不会互相等待，也不会认领到同一条
+        """
+        if not job_names or not self._ensure_connection():
+            return None
+        placeholders = ', '.join(['%s'] * len(job_names))
+        try:
+            _count_query()
+            self.cursor.execute(f"""
+            SELECT id, job_name, trigger_type FROM job_runs
+            WHERE status = 'queued' AND job_name IN ({placeholders})
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+            """, tuple(job_names))
+            run = self.cursor.fetchone()
+            if run is None:
+                self.connection.commit()
+                return None
+
+            _count_query()
+            self.cursor.execute("""
+            UPDATE job_runs SET status = 'running', node = %s, started_at = NOW() WHERE id = %s
+            """, (node, run['id']))
+            self.connection.commit()
+            return run
+        except Error as e:
+            print(f"❌ 认领任务失败: {e}")
+            self.connection.rollback()
+            return None
+
+    def finish_job_run(self, run_id, job_name, status, duration_ms, result=None, error=None):
+        """记录执行结果，并更新任务的最近一次执行信息"""
+        if not self._ensure_connection():
+            return False
+        try:
+            _count_query()
+            self.cursor.execute("""
+            UPDATE job_runs
+            SET status = %s, finished_at = NOW(), duration_ms = %s, result = %s, error = %s
+            WHERE id = %s AND status = 'running'
+            """, (status, duration_ms, result, error, run_id))
+            if self.cursor.rowcount != 1:
+                # 执行太久已被标记为超时失败
+                self.connection.rollback()
+                return False
+
+            _count_query()
+            self.cursor.execute("""
+            UPDATE scheduled_jobs SET last_run_at = NOW(), last_status = %s, last_duration_ms = %s
+            WHERE name = %s
+            """, (status, duration_ms, job_name))
+            self.connection.commit()
+            return True
+        except Error as e:
+            print(f"❌ 记录任务结果失败: {e}")
+            self.connection.rollback()
+            return False
+
+    def fail_stale_job_runs(self, stale_seconds):
+        """把开始执行后长时间未结束（执行节点已退出）的记录标记为失败，任务才能再次入队"""
+        query = """
+        UPDATE job_runs
+        SET status = 'failed', finished_at = NOW(), error = '执行超时（执行节点可能已退出）'
+        WHERE status = 'running' AND started_at < DATE_SUB(NOW(), INTERVAL %s SECOND)
+        """
+        return self.execute_update(query, (int(stale_seconds),))
+
+    def get_scheduled_jobs(self):
+        return self.execute_query("SELECT * FROM scheduled_jobs ORDER BY name") or []
+
+    def get_job_runs(self, job_name=None, limit=50):
+        """最近的执行记录（可按任务过滤）"""
+        if job_name:
+            query = "SELECT * FROM job_runs WHERE job_name = %s ORDER BY id DESC LIMIT %s"
+            return self.execute_query(query, (job_name, limit)) or []
+        return self.execute_query("SELECT * FROM job_runs ORDER BY id DESC LIMIT %s", (limit,)) or []
+
+    def prune_job_runs(self, keep_days, limit):
+        """删除 keep_days 天前已结束的执行记录，返回本批删除的行数"""
+        query = """
+        DELETE FROM job_runs
+        WHERE enqueued_at < DATE_SUB(NOW(), INTERVAL %s DAY) AND status IN ('succeeded', 'failed')
+        LIMIT %s
+        """
+        return self.execute_update(query, (int(keep_days), limit))
+
+    def get_existing_email_ids(self, email_ids):
+        """返回 email_ids 中在 emails 表里仍存在的ID集合"""
+        if not email_ids:
+            return set()
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        rows = self.execute_query(f"SELECT id FROM emails WHERE id IN ({placeholders})", tuple(email_ids))
+        if rows is None:
+            return None
+        return {row['id'] for row in rows}
+
 # 测试代码
 if __name__ == "__main__":
     # 创建数据库管理器实例
@@ -1698,4 +2796,4 @@ def add_verification_methods_to_db_manager():
 
         except Exception as e:
             print(f"⚠️ 获取验证码发送统计时出错: {e}")
-            return {'today_count': 0, 'last_sent_time': None, 'remaining_count': 2}
\ No newline at end of file
+            return {'today_count': 0, 'last_sent_time': None, 'remaining_count': 2}
@@ -16,9 +16,11 @@ CREATE TABLE IF NOT EXISTS users (
     monthly_email_count INT DEFAULT 0 COMMENT '当月邮件发送数量统计',
     monthly_reset_date DATE NULL COMMENT '月度统计重置日期',
     vip_email_count INT DEFAULT 0 COMMENT 'VIP用户邮件发送计数',
+    quota_period_start DATE NULL COMMENT 'vip_email_count 所属周期（当月1日）',
     vip_start_date DATETIME NULL COMMENT 'VIP会员开始时间',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '账户创建时间',
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '账户最后更新时间'
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '账户最后更新时间',
+    INDEX idx_vip_expire_date (vip_expire_date)
 ) COMMENT = '系统用户表：存储用户账号、权限、余额等基本信息';
 
 -- 域名表：存储邮箱服务支持的域名
@@ -70,11 +72,16 @@ CREATE TABLE IF NOT EXISTS attachments (
 CREATE TABLE IF NOT EXISTS registration_codes (
     id INT AUTO_INCREMENT PRIMARY KEY,
     code VARCHAR(50) NOT NULL UNIQUE,
+    description TEXT NULL,
+    created_by_user_id INT NULL,
+    batch_no VARCHAR(32) NULL COMMENT '生成批次号',
     is_used TINYINT(1) DEFAULT 0,
-    used_by INT NULL,
+    used_by_user_id INT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     used_at TIMESTAMP NULL,
-    FOREIGN KEY (used_by) REFERENCES users(id) ON DELETE SET NULL
+    INDEX idx_batch_no (batch_no, id),
+    FOREIGN KEY (created_by_user_id) REFERENCES users(id) ON DELETE SET NULL,
+    FOREIGN KEY (used_by_user_id) REFERENCES users(id) ON DELETE SET NULL
 ) COMMENT = '注册码表：存储用户注册系统的邀请码';
 
 -- 充值码表：存储充值码信息
@@ -82,11 +89,16 @@ CREATE TABLE IF NOT EXISTS recharge_codes (
     id INT AUTO_INCREMENT PRIMARY KEY,
     code VARCHAR(50) NOT NULL UNIQUE,
     amount DECIMAL(10,2) NOT NULL,
+    description TEXT NULL,
+    created_by_user_id INT NULL,
+    batch_no VARCHAR(32) NULL COMMENT '生成批次号',
     is_used TINYINT(1) DEFAULT 0,
-    used_by INT NULL,
+    used_by_user_id INT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     used_at TIMESTAMP NULL,
-    FOREIGN KEY (used_by) REFERENCES users(id) ON DELETE SET NULL
+    INDEX idx_batch_no (batch_no, id),
+    FOREIGN KEY (created_by_user_id) REFERENCES users(id) ON DELETE SET NULL,
+    FOREIGN KEY (used_by_user_id) REFERENCES users(id) ON DELETE SET NULL
 ) COMMENT = '充值码表：存储用户充值的兑换码';
 
 -- 用户密码历史表：存储用户密码历史记录
@@ -126,6 +138,132 @@ CREATE TABLE IF NOT EXISTS verification_code_logs (
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 ) COMMENT = '验证码发送记录表：记录用户验证码发送历史，用于限制发送频率';
 
+-- 发件箱表：写信请求只负责校验、扣费和入队，由后台线程投递并重试
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INT AUTO_INCREMENT PRIMARY KEY COMMENT '发件记录ID',
+    user_id INT NOT NULL COMMENT '发件用户ID',
+    email_id INT NOT NULL COMMENT '对应emails表中的邮件ID',
+    from_email VARCHAR(255) NOT NULL COMMENT '发件人邮箱',
+    to_email VARCHAR(255) NOT NULL COMMENT '收件人邮箱',
+    subject TEXT COMMENT '邮件主题',
+    content LONGTEXT COMMENT '邮件正文',
+    attachments_json TEXT COMMENT '附件列表（JSON: filename/path/size）',
+    status ENUM('queued', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'queued' COMMENT '投递状态',
+    attempts INT NOT NULL DEFAULT 0 COMMENT '已投递次数',
+    next_attempt_at DATETIME NOT NULL COMMENT '下次可投递时间',
+    locked_by VARCHAR(100) NULL COMMENT '认领该记录的发送线程',
+    locked_at DATETIME NULL COMMENT '认领时间',
+    last_error TEXT COMMENT '最近一次失败原因',
+    provider_message_id VARCHAR(255) NULL COMMENT '服务商返回的邮件ID',
+    charged_amount DECIMAL(10,2) NOT NULL DEFAULT 0.00 COMMENT '入队时扣除的费用',
+    vip_counted TINYINT(1) NOT NULL DEFAULT 0 COMMENT '入队时是否计入了VIP邮件数',
+    refunded TINYINT(1) NOT NULL DEFAULT 0 COMMENT '最终失败后是否已退款',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '入队时间',
+    sent_at DATETIME NULL COMMENT '投递成功时间',
+    INDEX idx_status_next (status, next_attempt_at),
+    INDEX idx_email_id (email_id),
+    INDEX idx_user_id (user_id),
+    INDEX idx_created_at (created_at),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) COMMENT = '发件箱表：异步投递队列';
+
+-- 余额流水表：所有余额变动（发信扣费、退款、充值码、在线支付、会员购买、管理员调整）都记一条流水
+-- 扣款使用 UPDATE users SET balance = balance - 金额 WHERE id = 用户 AND balance >= 金额，
+-- 与流水插入在同一事务内提交；(entry_type, reference) 唯一，同一笔业务重复入账会被拒绝
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY COMMENT '流水ID',
+    user_id INT NOT NULL COMMENT '用户ID',
+    amount DECIMAL(10,2) NOT NULL COMMENT '变动金额（正数入账，负数扣款）',
+    balance_after DECIMAL(10,2) NOT NULL COMMENT '变动后余额',
+    entry_type VARCHAR(32) NOT NULL COMMENT '类型：send_charge/send_refund/email_registration/vip_purchase/redeem_code/payment/admin_adjust',
+    reference VARCHAR(100) NULL COMMENT '业务单号（订单号、充值码、发件记录ID等），用于防止重复入账',
+    description VARCHAR(255) NULL COMMENT '说明',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '记账时间',
+    UNIQUE KEY uk_type_reference (entry_type, reference),
+    INDEX idx_user_created (user_id, created_at),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) COMMENT = '余额流水表';
+
+-- 在线支付订单表：pay_confirm 生成订单号时创建，易支付异步通知按订单号推进状态
+-- 状态只通过 UPDATE ... WHERE order_no = 订单号 AND status = 旧状态 推进（比较并设置），
+-- 重复通知命中唯一索引后更新0行，直接返回，入账只会发生一次
+--   created -> paid（异步通知验签后立即标记并返回）-> credited（后台结算线程入账）
+--                                                    -> failed（金额不符等无法入账的情况）
+CREATE TABLE IF NOT EXISTS payment_orders (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY COMMENT '订单ID',
+    order_no VARCHAR(32) NOT NULL COMMENT '商户订单号',
+    user_id INT NOT NULL COMMENT '用户ID',
+    charge_type ENUM('balance', 'vip') NOT NULL COMMENT '充值类型：余额充值或会员购买',
+    amount DECIMAL(10,2) NOT NULL COMMENT '订单金额',
+    payment_method VARCHAR(20) NOT NULL COMMENT '支付方式',
+    status ENUM('created', 'paid', 'credited', 'failed') NOT NULL DEFAULT 'created' COMMENT '状态：已创建/已支付待入账/已入账/失败',
+    trade_no VARCHAR(64) NULL COMMENT '支付平台订单号',
+    paid_amount DECIMAL(10,2) NULL COMMENT '支付平台通知的实付金额',
+    failure_reason VARCHAR(255) NULL COMMENT '失败原因',
+    settle_attempts INT NOT NULL DEFAULT 0 COMMENT '入账尝试次数',
+    next_attempt_at TIMESTAMP NULL COMMENT '下次入账尝试时间',
+    last_error VARCHAR(255) NULL COMMENT '最近一次入账错误',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    paid_at TIMESTAMP NULL COMMENT '收到支付通知时间',
+    credited_at TIMESTAMP NULL COMMENT '入账时间',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+    UNIQUE KEY uk_order_no (order_no),
+    INDEX idx_user_created (user_id, created_at),
+    INDEX idx_status_created (status, created_at),
+    INDEX idx_status_next (status, next_attempt_at),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) COMMENT = '在线支付订单表';
+
+-- 计费日汇总表：每个用户每天一行，发信入队/投递失败退款/写入充值记录时在同一事务内增量更新
+-- 充值页的本月统计和管理员计费统计只读汇总行；历史数据用 billing_rollup_tool.py 回填和校验
+CREATE TABLE IF NOT EXISTS billing_daily_rollups (
+    user_id INT NOT NULL COMMENT '用户ID',
+    day DATE NOT NULL COMMENT '日期',
+    send_count INT NOT NULL DEFAULT 0 COMMENT '发信数（不含投递失败已退款的）',
+    normal_count INT NOT NULL DEFAULT 0 COMMENT '普通用户计费发信数',
+    vip_free_count INT NOT NULL DEFAULT 0 COMMENT 'VIP免费额度内发信数',
+    vip_over_count INT NOT NULL DEFAULT 0 COMMENT 'VIP超额计费发信数',
+    send_cost DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '发信费用合计',
+    recharge_count INT NOT NULL DEFAULT 0 COMMENT '余额充值次数',
+    recharge_amount DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '余额充值金额合计',
+    vip_purchase_count INT NOT NULL DEFAULT 0 COMMENT '会员购买次数',
+    vip_purchase_amount DECIMAL(12,2) NOT NULL DEFAULT 0.00 COMMENT '会员购买金额合计',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (user_id, day),
+    INDEX idx_day (day),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) COMMENT = '计费日汇总表';
+
+-- 后台任务调度表（工作线程用 SELECT ... FOR UPDATE SKIP LOCKED 认领，需要 MySQL 8.0+）
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    name VARCHAR(64) PRIMARY KEY COMMENT '任务名称',
+    cron VARCHAR(100) NULL COMMENT 'cron表达式（分 时 日 月 周），为空表示只能手动触发',
+    description VARCHAR(255) NULL COMMENT '任务说明',
+    enabled TINYINT(1) NOT NULL DEFAULT 1 COMMENT '是否按计划执行',
+    next_run_at DATETIME NULL COMMENT '下次计划执行时间',
+    last_run_at DATETIME NULL COMMENT '最近一次执行完成时间',
+    last_status VARCHAR(20) NULL COMMENT '最近一次执行结果',
+    last_duration_ms INT NULL COMMENT '最近一次执行耗时（毫秒）',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间'
+) COMMENT = '定时任务表';
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    job_name VARCHAR(64) NOT NULL COMMENT '任务名称',
+    status ENUM('queued', 'running', 'succeeded', 'failed') NOT NULL DEFAULT 'queued' COMMENT '状态',
+    trigger_type ENUM('schedule', 'manual') NOT NULL DEFAULT 'schedule' COMMENT '触发方式',
+    node VARCHAR(255) NULL COMMENT '执行节点（主机名-进程号）',
+    enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '入队时间',
+    started_at DATETIME NULL COMMENT '开始执行时间',
+    finished_at DATETIME NULL COMMENT '执行结束时间',
+    duration_ms INT NULL COMMENT '执行耗时（毫秒）',
+    result TEXT NULL COMMENT '执行结果（JSON）',
+    error TEXT NULL COMMENT '失败原因',
+    INDEX idx_status (status, id),
+    INDEX idx_job_name (job_name, id),
+    INDEX idx_enqueued_at (enqueued_at)
+) COMMENT = '任务执行记录表';
+
 -- 插入默认管理员账户
 -- 密码: 518107qW (使用正确的bcrypt哈希)
 INSERT IGNORE INTO users (username, password, email, is_admin, is_vip, balance) VALUES
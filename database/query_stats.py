@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+SQL执行统计和慢查询记录
+DatabaseManager 每条语句执行后调用 query_stats.record()：
+
+- 按发起查询的方法汇总次数、总耗时、最大耗时、失败次数，管理员页面按总耗时排出最耗时的方法
+- 超过 SLOW_QUERY_THRESHOLD_MS 的语句进入环形缓冲区（只保留最近 SLOW_QUERY_BUFFER 条），
+  只记录参数的类型和长度，不记录参数值（避免把密码、验证码等写进日志）
+- 调试开关打开后，按 SLOW_QUERY_EXPLAIN_SAMPLE 的比例对慢查询执行 EXPLAIN，结果附在记录上
+统计只保存在当前进程内存中，进程重启后清空。
+"""
+
+import os
+import re
+import random
+import threading
+from collections import deque
+from datetime import datetime
+
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '200'))  # 慢查询阈值（毫秒）
+SLOW_QUERY_BUFFER = int(os.environ.get('SLOW_QUERY_BUFFER', '200'))  # 保留的最近慢查询条数
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'False').lower() in ('1', 'true', 'yes')  # 是否对慢查询执行EXPLAIN
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', '0.1'))  # 执行EXPLAIN的抽样比例
+
+# 可以安全EXPLAIN的语句（EXPLAIN不会真正执行）
+_EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def normalize_sql(query, max_length=1000):
+    """压缩空白，便于展示和聚合"""
+    return re.sub(r'\s+', ' ', query or '').strip()[:max_length]
+
+
+def param_shape(params):
+    """参数形状：只保留类型和长度，例如 ['int', 'str(12)', 'None']"""
+    if params is None:
+        return []
+    if isinstance(params, dict):
+        return {key: param_shape([value])[0] for key, value in params.items()}
+    shape = []
+    for value in params:
+        if value is None:
+            shape.append('None')
+        elif isinstance(value, (str, bytes)):
+            shape.append(f"{type(value).__name__}({len(value)})")
+        else:
+            shape.append(type(value).__name__)
+    return shape
+
+
+class QueryStats:
+    """按方法汇总的SQL耗时统计和慢查询环形缓冲区（线程安全）"""
+
+    def __init__(self, threshold_ms=None, buffer_size=None, explain=None, explain_sample=None):
+        self.threshold_ms = SLOW_QUERY_THRESHOLD_MS if threshold_ms is None else threshold_ms
+        self.explain_enabled = SLOW_QUERY_EXPLAIN if explain is None else explain
+        self.explain_sample = SLOW_QUERY_EXPLAIN_SAMPLE if explain_sample is None else explain_sample
+        self._methods = {}
+        self._slow = deque(maxlen=buffer_size or SLOW_QUERY_BUFFER)
+        self._lock = threading.Lock()
+        self.started_at = datetime.now()
+
+    def record(self, method, kind, query, params, seconds, failed=False):
+        """
+        记录一条语句的执行结果
+        Returns:
+            慢查询记录（dict），需要执行EXPLAIN时由调用方填入 entry['explain']；不是慢查询时返回None
+        """
+        elapsed_ms = seconds * 1000
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                                 'errors': 0, 'slow': 0, 'kinds': set()}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['kinds'].add(kind)
+            if failed:
+                stats['errors'] += 1
+            if elapsed_ms < self.threshold_ms:
+                return None
+            stats['slow'] += 1
+
+        entry = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'method': method,
+            'kind': kind,
+            'duration_ms': round(elapsed_ms, 1),
+            'sql': normalize_sql(query),
+            'params': param_shape(params),
+            'failed': failed,
+            'explain': None,
+        }
+        with self._lock:
+            self._slow.append(entry)
+        return entry
+
+    def should_explain(self, entry):
+        """调试开关打开且命中抽样时，对可EXPLAIN的慢查询执行EXPLAIN"""
+        if not self.explain_enabled or entry['failed']:
+            return False
+        if not entry['sql'].upper().startswith(_EXPLAINABLE):
+            return False
+        return random.random() < self.explain_sample
+
+    def top_methods(self, limit=20, order_by='total_ms'):
+        """按总耗时（或 count / max_ms / slow）排序的方法统计"""
+        with self._lock:
+            rows = [
+                {
+                    'method': method,
+                    'kinds': sorted(stats['kinds']),
+                    'count': stats['count'],
+                    'total_ms': round(stats['total_ms'], 1),
+                    'avg_ms': round(stats['total_ms'] / stats['count'], 2) if stats['count'] else 0,
+                    'max_ms': round(stats['max_ms'], 1),
+                    'errors': stats['errors'],
+                    'slow': stats['slow'],
+                }
+                for method, stats in self._methods.items()
+            ]
+        if order_by not in ('total_ms', 'count', 'max_ms', 'slow', 'avg_ms'):
+            order_by = 'total_ms'
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:limit]
+
+    def recent_slow(self, limit=50):
+        """最近的慢查询（新的在前）"""
+        with self._lock:
+            entries = list(self._slow)
+        entries.reverse()
+        return entries[:limit]
+
+    def summary(self):
+        with self._lock:
+            count = sum(stats['count'] for stats in self._methods.values())
+            total_ms = sum(stats['total_ms'] for stats in self._methods.values())
+            slow_buffered = len(self._slow)
+        return {
+            'since': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'uptime_seconds': int((datetime.now() - self.started_at).total_seconds()),
+            'statements': count,
+            'total_ms': round(total_ms, 1),
+            'methods': len(self._methods),
+            'slow_buffered': slow_buffered,
+            'threshold_ms': self.threshold_ms,
+            'explain_enabled': self.explain_enabled,
+            'explain_sample': self.explain_sample,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._slow.clear()
+            self.started_at = datetime.now()
+
+
+# 进程内所有 DatabaseManager 实例共享
+query_stats = QueryStats()
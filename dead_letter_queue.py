@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+邮件接收死信队列
+处理失败的邮件不再直接丢弃，而是连同原始邮件内容持久化到死信目录，
+由监控器的工作线程按指数退避自动重试，管理员也可以手动重放或清除。
+
+存储结构（每条死信两个文件，与 frontend_queue 的文件队列方式一致）:
+    dead_letters/<entry_id>.json  元数据（错误类型、重试次数、下次重试时间等）
+    dead_letters/<entry_id>.eml   原始邮件内容
+"""
+
+import os
+import json
+import uuid
+import email
+import threading
+from datetime import datetime, timedelta
+
+from email_config import (
+    DEAD_LETTER_DIR, DEAD_LETTER_MAX_ATTEMPTS,
+    DEAD_LETTER_BASE_DELAY, DEAD_LETTER_MAX_DELAY
+)
+
+# 死信状态
+STATUS_PENDING = 'pending'      # 等待重试
+STATUS_RETRYING = 'retrying'    # 已重新投递到处理队列
+STATUS_EXHAUSTED = 'exhausted'  # 超过最大重试次数，等待人工处理
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class DeadLetterStore:
+    """
+    基于文件的死信存储
+    监控进程和Web进程共享同一个目录，元数据写入采用临时文件+原子替换
+    """
+
+    def __init__(self, directory=None, max_attempts=None, base_delay=None, max_delay=None):
+        self.directory = directory or DEAD_LETTER_DIR
+        self.max_attempts = max_attempts or DEAD_LETTER_MAX_ATTEMPTS
+        self.base_delay = base_delay or DEAD_LETTER_BASE_DELAY
+        self.max_delay = max_delay or DEAD_LETTER_MAX_DELAY
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    # ========== 内部工具方法 ==========
+
+    def _meta_path(self, entry_id):
+        return os.path.join(self.directory, f"{entry_id}.json")
+
+    def _eml_path(self, entry_id):
+        return os.path.join(self.directory, f"{entry_id}.eml")
+
+    def _write_meta(self, entry):
+        """原子写入元数据，避免另一进程读到半个文件"""
+        path = self._meta_path(entry['id'])
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+
+    def _read_meta(self, entry_id):
+        try:
+            with open(self._meta_path(entry_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def compute_next_retry(self, attempts, now=None):
+        """计算下次重试时间：base_delay * 2^(attempts-1)，不超过max_delay"""
+        now = now or datetime.now()
+        delay = min(self.base_delay * (2 ** max(attempts - 1, 0)), self.max_delay)
+        return now + timedelta(seconds=delay)
+
+    # ========== 写入 ==========
+
+    def add(self, email_data, error, error_class):
+        """首次处理失败，写入死信队列"""
+        with self._lock:
+            entry_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+            with open(self._eml_path(entry_id), 'wb') as f:
+                f.write(email_data['raw_content'])
+
+            headers = email_data.get('headers')
+            now = datetime.now()
+            entry = {
+                'id': entry_id,
+                'email_id': email_data['id'],
+                'subject': headers.get('Subject', '') if headers else '',
+                'to': headers.get('To', '') if headers else '',
+                'received_time': email_data['timestamp'].strftime(TIME_FORMAT),
+                'error_class': error_class,
+                'error': str(error),
+                'attempts': 1,
+                'status': STATUS_PENDING,
+                'first_failed_at': now.strftime(TIME_FORMAT),
+                'last_failed_at': now.strftime(TIME_FORMAT),
+                'next_retry_at': self.compute_next_retry(1, now).strftime(TIME_FORMAT),
+            }
+            self._write_meta(entry)
+            return entry
+
+    def record_failure(self, entry_id, error, error_class):
+        """重试再次失败：增加重试次数并安排下次重试"""
+        with self._lock:
+            entry = self._read_meta(entry_id)
+            if not entry:
+                return None
+
+            now = datetime.now()
+            entry['attempts'] += 1
+            entry['error_class'] = error_class
+            entry['error'] = str(error)
+            entry['last_failed_at'] = now.strftime(TIME_FORMAT)
+
+            if entry['attempts'] >= self.max_attempts:
+                entry['status'] = STATUS_EXHAUSTED
+                entry['next_retry_at'] = None
+            else:
+                entry['status'] = STATUS_PENDING
+                entry['next_retry_at'] = self.compute_next_retry(entry['attempts'], now).strftime(TIME_FORMAT)
+
+            self._write_meta(entry)
+            return entry
+
+    def mark_retrying(self, entry_id):
+        """标记为已投递到处理队列，防止重复投递"""
+        with self._lock:
+            entry = self._read_meta(entry_id)
+            if not entry or entry['status'] != STATUS_PENDING:
+                return False
+            entry['status'] = STATUS_RETRYING
+            self._write_meta(entry)
+            return True
+
+    def reset_in_flight(self):
+        """进程重启后，把上次未完成的重试恢复为等待状态"""
+        count = 0
+        for entry in self.list_entries(STATUS_RETRYING):
+            entry['status'] = STATUS_PENDING
+            self._write_meta(entry)
+            count += 1
+        return count
+
+    def remove(self, entry_id):
+        """重试成功后删除死信"""
+        with self._lock:
+            removed = False
+            for path in (self._meta_path(entry_id), self._eml_path(entry_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed = True
+            return removed
+
+    # ========== 读取 ==========
+
+    def list_entries(self, status=None):
+        """列出死信（按首次失败时间排序）"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            entry = self._read_meta(filename[:-5])
+            if entry and (status is None or entry.get('status') == status):
+                entries.append(entry)
+        entries.sort(key=lambda e: e.get('first_failed_at', ''))
+        return entries
+
+    def get_due_entries(self, now=None):
+        """获取已到重试时间的死信"""
+        now_str = (now or datetime.now()).strftime(TIME_FORMAT)
+        return [e for e in self.list_entries(STATUS_PENDING)
+                if e.get('next_retry_at') and e['next_retry_at'] <= now_str]
+
+    def load_email_data(self, entry):
+        """从死信还原监控器使用的 email_data 结构"""
+        with open(self._eml_path(entry['id']), 'rb') as f:
+            raw_content = f.read()
+
+        return {
+            'id': entry['email_id'],
+            'raw_content': raw_content,
+            'timestamp': datetime.strptime(entry['received_time'], TIME_FORMAT),
+            'headers': email.message_from_bytes(raw_content),
+            'dead_letter_id': entry['id'],
+        }
+
+    # ========== 管理操作 ==========
+
+    def replay(self, entry_id):
+        """立即重放（包括已耗尽重试次数的死信）"""
+        with self._lock:
+            entry = self._read_meta(entry_id)
+            if not entry:
+                return None
+            if entry['status'] == STATUS_EXHAUSTED:
+                entry['attempts'] = 0
+            entry['status'] = STATUS_PENDING
+            entry['next_retry_at'] = datetime.now().strftime(TIME_FORMAT)
+            self._write_meta(entry)
+            return entry
+
+    def purge(self, entry_id=None, status=None):
+        """清除死信：指定ID则只删一条，否则按状态（不传则全部）删除"""
+        if entry_id:
+            return 1 if self.remove(entry_id) else 0
+
+        count = 0
+        for entry in self.list_entries(status):
+            if self.remove(entry['id']):
+                count += 1
+        return count
+
+    def get_summary(self):
+        """按状态统计死信数量"""
+        summary = {STATUS_PENDING: 0, STATUS_RETRYING: 0, STATUS_EXHAUSTED: 0}
+        for entry in self.list_entries():
+            summary[entry.get('status', STATUS_PENDING)] = summary.get(entry.get('status', STATUS_PENDING), 0) + 1
+        return summary
@@ -68,7 +68,7 @@ max_attempts=30
 attempt=1
 
 while [ $attempt -le $max_attempts ]; do
-    if curl -f http://localhost:5000/ > /dev/null 2>&1; then
+    if curl -f http://localhost:5000/readyz > /dev/null 2>&1; then
         echo "✅ 应用健康检查通过"
         break
     fi
@@ -22,6 +22,116 @@ CHECK_INTERVAL = 6  # 检查间隔（秒）- 改为6秒快速监控
 TARGET_DOMAIN = os.getenv('TARGET_DOMAIN', "shiep.edu.kg")  # 只处理这个域名的邮件
 PROCESS_HISTORICAL = False  # 不处理历史邮件，只处理新邮件
 
+# 死信队列配置（处理失败的邮件按指数退避重试）
+DEAD_LETTER_DIR = os.getenv('DEAD_LETTER_DIR', "./dead_letters")
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv('DEAD_LETTER_MAX_ATTEMPTS', '8'))  # 最大重试次数
+DEAD_LETTER_BASE_DELAY = int(os.getenv('DEAD_LETTER_BASE_DELAY', '30'))  # 首次重试延迟（秒）
+DEAD_LETTER_MAX_DELAY = int(os.getenv('DEAD_LETTER_MAX_DELAY', '3600'))  # 最大重试延迟（秒）
+DEAD_LETTER_SCAN_INTERVAL = 15  # 扫描到期死信的间隔（秒）
+
+# 接收处理队列配置（有界队列 + 按积压自动伸缩的工作线程）
+INGEST_QUEUE_MAXSIZE = int(os.getenv('INGEST_QUEUE_MAXSIZE', '200'))  # 队列容量，满时暂停拉取
+INGEST_MIN_WORKERS = int(os.getenv('INGEST_MIN_WORKERS', '1'))  # 最少处理线程数
+INGEST_MAX_WORKERS = int(os.getenv('INGEST_MAX_WORKERS', '6'))  # 最多处理线程数
+INGEST_SCALE_INTERVAL = 5  # 检查是否需要扩容的间隔（秒）
+INGEST_WORKER_IDLE_TIMEOUT = 30  # 线程空闲多久后退出（秒）
+INGEST_TARGET_DRAIN_SECONDS = 10  # 期望积压在多少秒内处理完
+
+# 发件箱配置（写信请求只入队，后台线程调用Resend投递）
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '2'))  # 后台发送线程数，0表示不启动
+OUTBOX_BATCH_SIZE = 10  # 每个线程一次认领的邮件数
+OUTBOX_POLL_INTERVAL = 2  # 发件箱空闲时的轮询间隔（秒）
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))  # 最大投递次数，超过后标记失败并退款
+OUTBOX_RETRY_BASE_DELAY = 15  # 首次重试延迟（秒），之后按指数退避
+OUTBOX_RETRY_MAX_DELAY = 900  # 最大重试延迟（秒）
+OUTBOX_STALE_SECONDS = 300  # 认领后超过该时间仍处于发送中，视为线程异常退出并重新入队
+
+# 支付结算配置（支付通知只标记订单已支付并立即返回，后台线程入账）
+SETTLEMENT_ENABLED = os.getenv('SETTLEMENT_ENABLED', 'True').lower() == 'true'  # 是否在本进程启动结算线程
+SETTLEMENT_BATCH_SIZE = 20  # 每轮处理的待入账订单数
+SETTLEMENT_POLL_INTERVAL = 5  # 没有待入账订单时的轮询间隔（秒）
+SETTLEMENT_RETRY_BASE_DELAY = 5  # 入账失败后首次重试延迟（秒），之后按指数退避
+SETTLEMENT_RETRY_MAX_DELAY = 300  # 最大重试延迟（秒），已付款的订单会一直重试到入账为止
+
+# 外发调度配置（令牌桶限速 + 批量合并，保持在Resend配额以内）
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '2'))  # 每秒最多调用服务商接口次数
+OUTBOUND_GLOBAL_BURST = int(os.getenv('OUTBOUND_GLOBAL_BURST', '2'))  # 全局突发容量
+OUTBOUND_SENDER_RATE = float(os.getenv('OUTBOUND_SENDER_RATE', '1'))  # 单个发件地址每秒最多发送封数
+OUTBOUND_SENDER_BURST = int(os.getenv('OUTBOUND_SENDER_BURST', '10'))  # 单个发件地址突发容量
+SYSTEM_FROM_EMAIL = os.getenv('SYSTEM_FROM_EMAIL', "longgekutta@shiep.edu.kg")  # 验证码等系统邮件的发件地址，不受单发件人限速
+OUTBOUND_BATCH_WINDOW = float(os.getenv('OUTBOUND_BATCH_WINDOW', '0.05'))  # 合并等待窗口（秒）
+OUTBOUND_BATCH_MAX = 100  # Resend批量接口单次上限
+OUTBOUND_SEND_THREADS = 4  # 并发调用服务商接口的线程数
+
+# 附件配置（上传按块落盘，发送时按块编码）
+ATTACHMENT_SPOOL_DIR = os.getenv('ATTACHMENT_SPOOL_DIR', "./temp_attachments")  # 上传暂存目录
+ATTACHMENT_MAX_FILE_SIZE = int(os.getenv('ATTACHMENT_MAX_FILE_SIZE', str(25 * 1024 * 1024)))  # 单个附件上限（字节）
+ATTACHMENT_MAX_TOTAL_SIZE = int(os.getenv('ATTACHMENT_MAX_TOTAL_SIZE', str(30 * 1024 * 1024)))  # 单封邮件附件总上限，base64后不超过Resend的40MB
+OUTBOUND_MEMORY_CEILING = 256 * 1024  # 发送时每个请求用于附件编码的缓冲上限（字节）
+
+# 附件下载配置
+# 开启后Flask只做鉴权，返回 X-Accel-Redirect 由nginx直接发送文件（需要nginx挂载相同的附件目录）
+ATTACHMENT_ACCEL_REDIRECT = os.getenv('ATTACHMENT_ACCEL_REDIRECT', 'False').lower() in ('1', 'true', 'yes')
+ATTACHMENT_ACCEL_PREFIX = os.getenv('ATTACHMENT_ACCEL_PREFIX', "/_protected_files/")  # nginx internal location
+ATTACHMENT_ROOTS = ['sent_attachments', 'received_emails', 'uploads']  # 允许下载的目录（相对应用根目录）
+
+# 新邮件推送配置（/api/stream/mails）
+# 设置 REDIS_URL 后事件经Redis Stream在多个节点间共享；否则由Web进程内的单个线程跟踪emails表新增记录
+REDIS_URL = os.getenv('REDIS_URL', '')
+MAIL_EVENTS_STREAM = os.getenv('MAIL_EVENTS_STREAM', 'mail_events')  # Redis Stream 名称
+MAIL_EVENTS_BUFFER = 1000  # 保留的最近事件数（用于 Last-Event-ID 断线续传）
+MAIL_EVENTS_POLL_INTERVAL = float(os.getenv('MAIL_EVENTS_POLL_INTERVAL', '1'))  # 无Redis时跟踪新邮件的间隔（秒）
+SSE_HEARTBEAT_SECONDS = 15  # 心跳间隔，需小于nginx的 proxy_read_timeout
+SSE_MAX_CONNECTIONS = int(os.getenv('SSE_MAX_CONNECTIONS', '200'))  # 单进程最大推送连接数
+SSE_MAX_PER_USER = int(os.getenv('SSE_MAX_PER_USER', '3'))  # 单用户最大推送连接数（多个标签页）
+SSE_MAX_LIFETIME = 30 * 60  # 单个连接最长保持时间（秒），到期后由浏览器带 Last-Event-ID 自动重连
+
+# 限流配置（滑动窗口，按用户/邮箱/IP计数；设置 REDIS_URL 后多进程共享计数）
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))  # 进程内后端最多跟踪的键数，超出时淘汰最久未访问的
+# 受信任的反向代理（逗号分隔的IP或网段）；只有直接连接方在其中时才读取 X-Real-IP / X-Forwarded-For 作为客户端IP
+TRUSTED_PROXIES = os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1')
+VERIFY_CODE_DAILY_LIMIT = int(os.getenv('VERIFY_CODE_DAILY_LIMIT', '2'))  # 每个邮箱每24小时最多发送验证码次数
+VERIFY_CODE_USER_LIMIT = int(os.getenv('VERIFY_CODE_USER_LIMIT', '5'))  # 每个登录用户每24小时最多发送验证码次数（不同邮箱合计）
+VERIFY_CODE_IP_LIMIT = int(os.getenv('VERIFY_CODE_IP_LIMIT', '10'))  # 每个IP每小时最多请求发送验证码次数
+LOGIN_IP_LIMIT = int(os.getenv('LOGIN_IP_LIMIT', '30'))  # 每个IP每5分钟最多登录尝试次数
+LOGIN_ACCOUNT_LIMIT = int(os.getenv('LOGIN_ACCOUNT_LIMIT', '10'))  # 每个用户名/邮箱每5分钟最多登录尝试次数
+
+# 验证码存储（默认进程内；设置 REDIS_URL 后保存在Redis，多进程共享）
+VERIFICATION_CODE_TTL = int(os.getenv('VERIFICATION_CODE_TTL', '600'))  # 验证码有效期（秒）
+VERIFICATION_MAX_ATTEMPTS = int(os.getenv('VERIFICATION_MAX_ATTEMPTS', '5'))  # 输错多少次后验证码作废
+
+# 密码哈希线程池（bcrypt 不在请求线程中计算，排队已满时直接返回"系统繁忙"）
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))  # bcrypt成本因子，每+1耗时翻倍；修改后旧密码在用户登录时自动升级
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))  # 哈希工作线程数
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', '32'))  # 最多排队等待的任务数
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))  # 请求等待哈希结果的最长时间（秒）
+
+# 会员到期（定时任务 vip_expiry 每分钟按到期时间索引批量取消过期会员）
+VIP_EXPIRY_BATCH_SIZE = int(os.getenv('VIP_EXPIRY_BATCH_SIZE', '500'))  # 每条 UPDATE 最多处理的用户数
+
+# 后台任务调度（maintenance_jobs.py 中的定时任务）
+# 多个Web节点通过 MySQL GET_LOCK 选出一个主节点按计划入队，各节点的工作线程用 SKIP LOCKED 认领执行
+JOB_SCHEDULER_ENABLED = os.getenv('JOB_SCHEDULER_ENABLED', 'True').lower() == 'true'
+JOB_SCHEDULER_TICK = float(os.getenv('JOB_SCHEDULER_TICK', '15'))  # 主节点检查到期任务、非主节点尝试接管的间隔（秒）
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))  # 每个进程执行任务的线程数
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))  # 工作线程空闲时查询队列的间隔（秒）
+JOB_RUN_STALE_SECONDS = int(os.getenv('JOB_RUN_STALE_SECONDS', '3600'))  # 执行超过该时间未结束视为执行节点已退出
+JOB_HISTORY_DAYS = int(os.getenv('JOB_HISTORY_DAYS', '30'))  # 执行记录保留天数
+ORPHAN_FILE_MIN_AGE = int(os.getenv('ORPHAN_FILE_MIN_AGE', str(24 * 3600)))  # 无主附件文件至少存在多久才删除（秒）
+
+# 按需请求采样分析（管理员请求带 X-Profile: 1 头或 ?__profile=1 时启用）
+PROFILE_DIR = os.getenv('PROFILE_DIR', "./profiles")  # 分析结果保存目录
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))  # 采样间隔（毫秒）
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))  # 最多保留的分析结果数，超出时删除最旧的
+
+# 容器探针配置（/healthz 存活检查不做IO；/readyz 就绪检查结果缓存 READY_CACHE_SECONDS 秒）
+INGEST_HEARTBEAT_FILE = os.path.join(EMAIL_SAVE_DIR, '.ingest_heartbeat.json')  # 收件进程每轮检查写入的心跳
+READY_CACHE_SECONDS = float(os.getenv('READY_CACHE_SECONDS', '5'))  # 就绪检查结果缓存时间（秒）
+READY_MIN_FREE_MB = int(os.getenv('READY_MIN_FREE_MB', '500'))  # received_emails 所在磁盘最少剩余空间（MB）
+READY_MAX_INGEST_LAG = int(os.getenv('READY_MAX_INGEST_LAG', '120'))  # 收件心跳最长间隔（秒），超过视为收件停滞
+READY_MAX_INGEST_BACKLOG = int(os.getenv('READY_MAX_INGEST_BACKLOG', str(INGEST_QUEUE_MAXSIZE)))  # 收件队列积压上限
+
 # Cloudflare配置（预留）
 CLOUDFLARE_DOMAIN = "shiep.edu.kg"
 CLOUDFLARE_WORKER_NAME = "longgekutta"
@@ -9,7 +9,8 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from database.db_manager import DatabaseManager
+from database.db_manager import DatabaseManager, LEDGER_INSUFFICIENT
+from config import Config
 
 class EmailCostHandler:
     """邮件费用处理器"""
@@ -26,30 +27,29 @@ class EmailCostHandler:
             return False, "数据库连接失败", 0
         
         try:
-            # 检查并更新会员状态
-            self.db_manager.check_and_update_vip_status(user_id)
-            # 重置月度计数（如果需要）
-            self.db_manager.reset_monthly_email_count_if_needed(user_id)
-            
+            # 会员到期和额度周期都按读到的用户信息判断，不需要先写库更新
+            user = self.db_manager.get_user_by_id(user_id)
+            if not user:
+                return False, "用户信息获取失败", 0
+
             # 计算邮件费用
-            email_cost = self.db_manager.calculate_email_cost(user_id)
-            user_stats = self.db_manager.get_user_monthly_stats(user_id)
-            current_balance = user_stats.get('balance', 0) if user_stats else 0
-            
-            # 检查余额是否足够
-            if current_balance < email_cost:
-                return False, f'余额不足！当前余额：¥{current_balance:.2f}，需要：¥{email_cost:.2f}', email_cost
-            
-            # 扣除费用
+            email_cost, _ = Config.get_email_send_cost(user)
+            is_vip = Config.is_vip_active(user)
+            current_balance = float(user.get('balance', 0))
+
+            # 条件扣款 + VIP邮件计数在一个事务内完成：并发发送时余额不足的请求直接失败，不会扣成负数
+            charged, message = self.db_manager.charge_send(user_id, email_cost, is_vip)
+            if not charged:
+                if message == LEDGER_INSUFFICIENT:
+                    return False, f'余额不足！当前余额：¥{current_balance:.2f}，需要：¥{email_cost:.2f}', email_cost
+                return False, f'费用扣除失败：{message}', 0
+
             if email_cost > 0:
-                self.db_manager.update_user_balance(user_id, -email_cost)
-                self.db_manager.increment_monthly_email_count(user_id)
-                
                 # 记录计费
-                user_type = 'vip' if user_stats.get('is_vip', False) else 'normal'
-                monthly_count = user_stats.get('monthly_email_count', 0) + 1
-                self.db_manager.add_email_billing(user_id, email_id, email_cost, user_type, monthly_count)
-            
+                user_type = 'vip' if is_vip else 'normal'
+                self.db_manager.add_email_billing(user_id, email_id, email_cost, user_type,
+                                                  Config.vip_quota_used(user) + 1)
+
             return True, f'邮件发送成功！费用：¥{email_cost:.2f}', email_cost
             
         finally:
@@ -61,24 +61,18 @@ class EmailCostHandler:
             return None
         
         try:
-            # 检查并更新会员状态
-            self.db_manager.check_and_update_vip_status(user_id)
-            # 重置月度计数（如果需要）
-            self.db_manager.reset_monthly_email_count_if_needed(user_id)
-            
-            # 获取用户统计
-            stats = self.db_manager.get_user_monthly_stats(user_id)
-            if not stats:
+            user = self.db_manager.get_user_by_id(user_id)
+            if not user:
                 return None
-            
+
             # 计算当前邮件费用
-            current_cost = self.db_manager.calculate_email_cost(user_id)
-            
+            current_cost, _ = Config.get_email_send_cost(user)
+
             return {
-                'balance': stats.get('balance', 0),
-                'is_vip': stats.get('is_vip', False),
-                'monthly_count': stats.get('monthly_email_count', 0),
-                'vip_expire_date': stats.get('vip_expire_date'),
+                'balance': user.get('balance', 0),
+                'is_vip': Config.is_vip_active(user),
+                'monthly_count': Config.vip_quota_used(user),
+                'vip_expire_date': user.get('vip_expire_date'),
                 'current_email_cost': current_cost
             }
             
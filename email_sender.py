@@ -3,22 +3,190 @@
 # 作者: justlovemaki
 # 日期: 2025年8月28日
 
-import resend
 import base64
 import os
+import uuid
+import threading
 from datetime import datetime
 from typing import List, Dict, Optional
 
+from http_transport import http_transport, HttpTransportError, RETRYABLE_STATUS
+from outbound_dispatcher import OutboundDispatcher
+from attachment_spool import StreamingJSONBody
+
+RESEND_API_BASE = os.getenv('RESEND_API_BASE', 'https://api.resend.com')
+
+
+class ResendTransport:
+    """
+    通过Resend HTTP API投递邮件（默认）
+    直接走共享的 http_transport 连接池，突发发送时复用TLS连接
+    """
+    
+    name = 'resend'
+    
+    def __init__(self, api_key: str, http=None):
+        self.api_key = api_key
+        self.http = http or http_transport
+    
+    def _headers(self, idempotency_key: str = None) -> Dict:
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        return headers
+    
+    def _parse(self, response):
+        """检查响应状态，失败时抛出带 retryable 标记的异常"""
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        
+        if response.status_code >= 400:
+            message = data.get('message') if isinstance(data, dict) else None
+            raise HttpTransportError(
+                f"Resend API错误 {response.status_code}: {message or response.text[:200]}",
+                status_code=response.status_code,
+                retryable=response.status_code in RETRYABLE_STATUS
+            )
+        return data
+    
+    def send(self, email_params: Dict, idempotency_key: str = None) -> str:
+        """
+        发送一封邮件，失败时抛出异常，成功返回服务商邮件ID
+        附件以文件路径给出时（{'filename', 'path'}），请求体从磁盘按块编码发送
+        """
+        attachments = email_params.get('attachments') or []
+        if any('path' in attachment for attachment in attachments):
+            fields = {k: v for k, v in email_params.items() if k != 'attachments'}
+            request_kwargs = {'data': StreamingJSONBody(fields, attachments)}
+        else:
+            request_kwargs = {'json': email_params}
+        
+        response = self.http.post(
+            f"{RESEND_API_BASE}/emails",
+            headers=self._headers(idempotency_key),
+            idempotent=idempotency_key is not None,
+            **request_kwargs
+        )
+        return str(self._parse(response).get('id'))
+    
+    def send_batch(self, params_list: List[Dict], idempotency_key: str = None):
+        response = self.http.post(
+            f"{RESEND_API_BASE}/emails/batch",
+            json=params_list,
+            headers=self._headers(idempotency_key),
+            idempotent=idempotency_key is not None
+        )
+        return self._parse(response)
+    
+    def get(self, email_id: str) -> Dict:
+        response = self.http.get(f"{RESEND_API_BASE}/emails/{email_id}", headers=self._headers())
+        return self._parse(response)
+
+
+class StubTransport:
+    """
+    本地桩投递：不访问网络，只把邮件记录在内存里
+    通过环境变量 MAIL_TRANSPORT=stub 启用，用于测试和本地开发
+    """
+    
+    name = 'stub'
+    
+    def __init__(self):
+        self.sent = []
+        self._idempotency = {}
+        self._lock = threading.Lock()
+    
+    def send(self, email_params: Dict, idempotency_key: str = None) -> str:
+        with self._lock:
+            # 与Resend一致：相同幂等键只投递一次
+            if idempotency_key and idempotency_key in self._idempotency:
+                return self._idempotency[idempotency_key]
+            message_id = f"stub-{uuid.uuid4().hex}"
+            self.sent.append({'id': message_id, 'params': email_params, 'sent_at': datetime.now()})
+            if idempotency_key:
+                self._idempotency[idempotency_key] = message_id
+        return message_id
+    
+    def send_batch(self, params_list: List[Dict], idempotency_key: str = None):
+        return {'data': [{'id': self.send(params)} for params in params_list]}
+    
+    def get(self, email_id: str) -> Optional[Dict]:
+        with self._lock:
+            for message in self.sent:
+                if message['id'] == email_id:
+                    return {'id': email_id, **message['params']}
+        return None
+
+
+def create_transport(name: str = None, api_key: str = None):
+    """根据名称（或环境变量 MAIL_TRANSPORT）创建投递方式"""
+    name = (name or os.getenv('MAIL_TRANSPORT', 'resend')).lower()
+    if name == 'stub':
+        return StubTransport()
+    return ResendTransport(api_key)
+
+
 class EmailSender:
-    """邮件发送类，封装Resend API"""
+    """邮件发送类，封装Resend API（投递方式可替换为本地桩）"""
     
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, transport=None):
         """初始化邮件发送器"""
         if api_key is None:
             api_key = os.getenv('RESEND_API_KEY', "re_6giBFioy_HW9cYt9xfR473x39HkuKtXT5")  # 生产环境请使用环境变量
-        resend.api_key = api_key
         self.api_key = api_key
-        print(f"📧 邮件发送器已初始化")
+        self.transport = transport or create_transport(api_key=api_key)
+        # 所有外发邮件经调度器限速并合并批量发送
+        self.dispatcher = OutboundDispatcher(self.transport)
+        print(f"📧 邮件发送器已初始化 (投递方式: {self.transport.name})")
+    
+    def build_email_params(self, from_email: str, to_email: str, subject: str, content: str,
+                           attachments: List[Dict] = None) -> Dict:
+        """
+        构建Resend邮件参数
+        附件格式：[{'filename': str, 'content': bytes}] 或 [{'filename': str, 'path': str}]
+        以路径给出的附件不在这里读取，由投递方式发送时按块编码
+        """
+        email_params = {
+            "from": from_email,
+            "to": [to_email],
+            "subject": subject,
+            "html": self._format_content(content)
+        }
+        
+        if attachments:
+            email_params["attachments"] = []
+            for attachment in attachments:
+                if 'path' in attachment:
+                    email_params["attachments"].append({
+                        "filename": attachment['filename'],
+                        "path": attachment['path']
+                    })
+                    continue
+                # 将附件内容编码为base64
+                encoded_content = base64.b64encode(attachment['content']).decode('utf-8')
+                email_params["attachments"].append({
+                    "filename": attachment['filename'],
+                    "content": encoded_content
+                })
+        
+        return email_params
+    
+    def deliver(self, from_email: str, to_email: str, subject: str, content: str,
+                attachments: List[Dict] = None, idempotency_key: str = None) -> str:
+        """
+        发送邮件，失败时抛出异常（供发件箱工作线程判断是否重试）
+        带幂等键时，网络失败后的重试不会导致重复投递
+        
+        Returns:
+            服务商返回的邮件ID
+        """
+        email_params = self.build_email_params(from_email, to_email, subject, content, attachments)
+        return self.dispatcher.send(email_params, idempotency_key=idempotency_key)
     
     def send_email_with_attachments(self, 
                                   from_email: str, 
@@ -34,7 +202,7 @@ class EmailSender:
             to_email: 收件人邮箱
             subject: 邮件主题
             content: 邮件内容（支持HTML）
-            attachments: 附件列表，格式：[{'filename': str, 'content': bytes}]
+            attachments: 附件列表，格式：[{'filename': str, 'content': bytes}] 或 [{'filename': str, 'path': str}]
         
         Returns:
             邮件ID（成功）或None（失败）
@@ -46,28 +214,13 @@ class EmailSender:
             print(f"   主题: {subject}")
             print(f"   附件数量: {len(attachments) if attachments else 0}")
             
-            # 构建邮件参数
-            email_params = {
-                "from": from_email,
-                "to": [to_email],
-                "subject": subject,
-                "html": self._format_content(content)
-            }
-            
-            # 添加附件
             if attachments:
-                email_params["attachments"] = []
                 for attachment in attachments:
-                    # 将附件内容编码为base64
-                    encoded_content = base64.b64encode(attachment['content']).decode('utf-8')
-                    email_params["attachments"].append({
-                        "filename": attachment['filename'],
-                        "content": encoded_content
-                    })
-                    print(f"📎 添加附件: {attachment['filename']} ({len(attachment['content'])} 字节)")
+                    size = os.path.getsize(attachment['path']) if 'path' in attachment else len(attachment['content'])
+                    print(f"📎 添加附件: {attachment['filename']} ({size} 字节)")
             
             # 发送邮件
-            email_result = resend.Emails.send(email_params)
+            email_result = self.deliver(from_email, to_email, subject, content, attachments)
             
             print(f"✅ 邮件发送成功！")
             print(f"   邮件ID: {email_result}")
@@ -115,7 +268,7 @@ class EmailSender:
         获取邮件信息
         """
         try:
-            email_info = resend.Emails.get(email_id=email_id)
+            email_info = self.transport.get(email_id)
             return email_info
         except Exception as e:
             print(f"❌ 获取邮件信息失败: {e}")
@@ -123,10 +276,13 @@ class EmailSender:
     
     def send_batch_emails(self, email_list: List[Dict]) -> Optional[List]:
         """
-        批量发送邮件
+        批量发送邮件（交给调度器按配额合并为批量接口调用）
         
         Args:
             email_list: 邮件列表，每个元素包含from_email, to_email, subject, content
+        
+        Returns:
+            服务商邮件ID列表（失败返回None）
         """
         try:
             params = []
@@ -139,7 +295,8 @@ class EmailSender:
                 }
                 params.append(param)
             
-            result = resend.Batch.send(params)
+            futures = [self.dispatcher.submit(param) for param in params]
+            result = [future.result(timeout=60) for future in futures]
             print(f"✅ 批量邮件发送成功: {len(email_list)} 封")
             return result
             
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+容器探针
+- /healthz 存活检查：进程能处理请求即返回200，不访问数据库和磁盘
+- /readyz 就绪检查：数据库可用、received_emails 磁盘空间充足、收件进程没有停滞或严重积压
+  检查结果缓存 READY_CACHE_SECONDS 秒，探针再频繁也最多每隔几秒真正检查一次
+
+收件进程不一定和Web进程在同一个容器里：没有心跳文件时收件检查记为 skipped，不影响就绪状态。
+"""
+
+import os
+import json
+import shutil
+import threading
+import time
+
+from email_config import (
+    EMAIL_SAVE_DIR, INGEST_HEARTBEAT_FILE, READY_CACHE_SECONDS, READY_MIN_FREE_MB,
+    READY_MAX_INGEST_LAG, READY_MAX_INGEST_BACKLOG
+)
+
+
+def write_ingest_heartbeat(queue_depth, path=None):
+    """收件进程每轮检查调用，记录时间和队列积压（原子替换，读取方不会读到半个文件）"""
+    path = path or INGEST_HEARTBEAT_FILE
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'updated_at': time.time(), 'queue_depth': queue_depth, 'pid': os.getpid()}, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"⚠️ 写入收件心跳失败: {e}")
+
+
+class ReadinessChecker:
+    """就绪检查（结果缓存，线程安全）"""
+
+    def __init__(self, cache_seconds=None):
+        self.cache_seconds = READY_CACHE_SECONDS if cache_seconds is None else cache_seconds
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = 0.0
+        self._db = None
+
+    def check(self):
+        """返回 (ready, checks)，checks 为每项检查的状态和说明"""
+        with self._lock:
+            if self._result is None or time.monotonic() - self._checked_at >= self.cache_seconds:
+                checks = {
+                    'database': self._check_database(),
+                    'disk': self._check_disk(),
+                    'ingestion': self._check_ingestion(),
+                }
+                ready = all(item['status'] != 'fail' for item in checks.values())
+                self._result = (ready, checks)
+                self._checked_at = time.monotonic()
+            return self._result
+
+    def _check_database(self):
+        """用探针专用的连接执行 SELECT 1（不占用请求使用的连接）"""
+        from database.db_manager import DatabaseManager
+
+        if self._db is None:
+            self._db = DatabaseManager()
+        started = time.monotonic()
+        try:
+            if not self._db.connection or not self._db.connection.is_connected():
+                if not self._db.connect():
+                    return {'status': 'fail', 'message': '数据库连接失败'}
+            result = self._db.execute_query("SELECT 1 as ok")
+            if not result:
+                self._db.disconnect()
+                return {'status': 'fail', 'message': '数据库查询失败'}
+            return {'status': 'ok', 'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+        except Exception as e:
+            return {'status': 'fail', 'message': str(e)}
+
+    def _check_disk(self):
+        try:
+            usage = shutil.disk_usage(EMAIL_SAVE_DIR if os.path.isdir(EMAIL_SAVE_DIR) else '.')
+        except OSError as e:
+            return {'status': 'fail', 'message': str(e)}
+        free_mb = usage.free // (1024 * 1024)
+        status = 'ok' if free_mb >= READY_MIN_FREE_MB else 'fail'
+        return {'status': status, 'free_mb': free_mb, 'min_free_mb': READY_MIN_FREE_MB}
+
+    def _check_ingestion(self):
+        try:
+            with open(INGEST_HEARTBEAT_FILE, 'r', encoding='utf-8') as f:
+                heartbeat = json.load(f)
+        except FileNotFoundError:
+            return {'status': 'skipped', 'message': '未发现收件进程心跳'}
+        except (OSError, ValueError) as e:
+            return {'status': 'fail', 'message': f"心跳文件无法读取: {e}"}
+
+        lag = int(time.time() - heartbeat.get('updated_at', 0))
+        backlog = heartbeat.get('queue_depth', 0)
+        result = {'lag_seconds': lag, 'max_lag_seconds': READY_MAX_INGEST_LAG,
+                  'queue_depth': backlog, 'max_queue_depth': READY_MAX_INGEST_BACKLOG}
+        if lag > READY_MAX_INGEST_LAG:
+            result.update(status='fail', message='收件进程停滞')
+        elif backlog > READY_MAX_INGEST_BACKLOG:
+            result.update(status='fail', message='收件队列积压')
+        else:
+            result['status'] = 'ok'
+        return result
+
+
+# 全局实例
+readiness_checker = ReadinessChecker()
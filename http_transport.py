@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+共享HTTP传输层
+Resend 等外部接口统一通过这里发请求：
+- 一个进程共用一个 requests.Session，按主机维护 keep-alive 连接池，避免每次请求重新握手TLS
+- 每个主机限制并发数，突发流量时排队而不是无限制地建连接
+- 统一的连接/读取超时
+- 可重试错误（连接失败、429、5xx）按指数退避+随机抖动重试，遵守 Retry-After
+- 统计每个主机的请求数、重试数、新建连接数，用于观察连接复用率
+"""
+
+import os
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics import registry
+
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))  # 缓存的主机连接池数量
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '20'))  # 每个主机保持的最大连接数
+HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', '10'))  # 每个主机的最大并发请求数
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))  # 连接超时（秒）
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '20'))  # 读取超时（秒）
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))  # 可重试错误的最大重试次数
+HTTP_RETRY_BASE_DELAY = 0.5  # 首次重试的基础延迟（秒）
+HTTP_RETRY_MAX_DELAY = 8.0  # 单次重试的最大延迟（秒）
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class HttpTransportError(Exception):
+    """外部接口调用失败"""
+
+    def __init__(self, message, status_code=None, retryable=True):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+
+class HttpTransport:
+    """带连接池、并发限制和重试的HTTP客户端（线程安全，全局共享）"""
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, max_per_host=None,
+                 connect_timeout=None, read_timeout=None, max_retries=None):
+        self.max_per_host = max_per_host or HTTP_MAX_PER_HOST
+        self.timeout = (connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+        self.max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+
+        # 重试由本类自行处理（需要抖动和统计），适配器本身不重试
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections or HTTP_POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize or HTTP_POOL_MAXSIZE,
+            max_retries=0,
+            pool_block=False
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._host_stats = {}
+
+    # ========== 内部工具方法 ==========
+
+    def _host_state(self, host):
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+                self._host_stats[host] = {
+                    'requests': 0, 'retries': 0, 'failures': 0,
+                    'total_seconds': 0.0, 'waiting': 0
+                }
+            return self._host_semaphores[host], self._host_stats[host]
+
+    def _incr(self, stats, name, amount=1):
+        with self._lock:
+            stats[name] += amount
+
+    def compute_backoff(self, attempt, retry_after=None):
+        """第attempt次重试前的等待时间：full jitter 指数退避，服务端给了 Retry-After 时以其为准"""
+        if retry_after is not None:
+            return min(retry_after, HTTP_RETRY_MAX_DELAY)
+        cap = min(HTTP_RETRY_BASE_DELAY * (2 ** attempt), HTTP_RETRY_MAX_DELAY)
+        return random.uniform(0, cap)
+
+    @staticmethod
+    def _is_connect_failure(error):
+        """是否为建立连接阶段的失败（此时请求体尚未发出）"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+            reason = getattr(error.args[0], 'reason', error.args[0])
+            return isinstance(reason, NewConnectionError)
+        return False
+
+    @staticmethod
+    def _parse_retry_after(response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    # ========== 请求 ==========
+
+    def request(self, method, url, idempotent=None, timeout=None, **kwargs):
+        """
+        发送请求，返回 requests.Response（调用方自行检查状态码）
+
+        Args:
+            idempotent: 是否可以安全重试。默认GET/HEAD可重试；POST只有带幂等键时才应传True
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD', 'OPTIONS')
+
+        host = urlsplit(url).netloc
+        semaphore, stats = self._host_state(host)
+        attempt = 0
+
+        while True:
+            self._incr(stats, 'waiting')
+            semaphore.acquire()
+            self._incr(stats, 'waiting', -1)
+            started = time.monotonic()
+            response = None
+            error = None
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                error = e
+            except requests.exceptions.Timeout as e:
+                error = e
+            finally:
+                semaphore.release()
+                self._incr(stats, 'requests')
+                self._incr(stats, 'total_seconds', time.monotonic() - started)
+
+            # 连接阶段失败时请求一定没有发出，任何方法都可以重试
+            connect_failed = self._is_connect_failure(error)
+            retryable = (
+                (error is not None and (idempotent or connect_failed)) or
+                (response is not None and response.status_code in RETRYABLE_STATUS and
+                 (idempotent or response.status_code == 429))
+            )
+
+            if retryable and attempt < self.max_retries:
+                delay = self.compute_backoff(attempt, self._parse_retry_after(response))
+                attempt += 1
+                self._incr(stats, 'retries')
+                reason = error if error is not None else f"HTTP {response.status_code}"
+                print(f"🔁 {method} {host} 失败（{reason}），{delay:.2f}秒后第{attempt}次重试")
+                time.sleep(delay)
+                continue
+
+            if error is not None:
+                self._incr(stats, 'failures')
+                raise HttpTransportError(f"{method} {host} 请求失败: {error}", retryable=True) from error
+
+            if response.status_code >= 400:
+                self._incr(stats, 'failures')
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    # ========== 统计 ==========
+
+    def get_stats(self):
+        """
+        每个主机的请求统计和连接复用情况
+        connections_opened 来自 urllib3 连接池的新建连接计数，reuse_ratio = 1 - 新建连接数/请求数
+        """
+        pool_counts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+            pool_counts[host] = pool_counts.get(host, 0) + pool.num_connections
+
+        result = {}
+        with self._lock:
+            for host, stats in self._host_stats.items():
+                opened = pool_counts.get(host, 0)
+                requests_count = stats['requests']
+                result[host] = {
+                    'requests': requests_count,
+                    'retries': stats['retries'],
+                    'failures': stats['failures'],
+                    'waiting': stats['waiting'],
+                    'avg_ms': round(stats['total_seconds'] * 1000 / requests_count, 1) if requests_count else 0,
+                    'connections_opened': opened,
+                    'reuse_ratio': round(max(1 - opened / requests_count, 0), 3) if requests_count else 0,
+                }
+        return result
+
+
+    def metric_samples(self):
+        """连接池使用情况（/metrics 采集）"""
+        samples = []
+        for host, stats in self.get_stats().items():
+            labels = {'host': host}
+            samples.append(('qqmail_http_pool_connections_opened', '外部接口新建的连接数', labels, stats['connections_opened']))
+            samples.append(('qqmail_http_pool_waiting', '等待主机并发名额的请求数', labels, stats['waiting']))
+        return samples
+
+
+# 全局共享实例
+http_transport = HttpTransport()
+registry.register_callback(http_transport.metric_samples)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务调度
+维护类任务（超限邮箱清理、会员到期、无主文件清理等）不再依赖管理员手动调用接口或各自的后台线程，
+统一注册到这里按 cron 表达式执行，多个Web节点同时运行也不会重复执行或漏执行：
+- 主节点选举：每个进程的调度线程用一个专用连接尝试 GET_LOCK，拿到锁的进程是主节点，
+  只有主节点按计划把到期任务写入 job_runs；主节点退出或连接断开时锁自动释放，其他节点下一轮接管
+- 执行：每个进程的工作线程用 SELECT ... FOR UPDATE SKIP LOCKED 认领排队中的任务，同一条只会被一个节点执行
+- 同一任务上一次还在排队或执行时不再入队；停机期间错过的多次计划执行合并为一次
+- 每次执行的节点、耗时、结果或错误记录在 job_runs，任务的下次执行时间和最近一次结果在 scheduled_jobs
+
+用法：
+    job_scheduler.register('vip_expiry', '* * * * *', expire_vip_users, '取消已到期的会员')
+    job_scheduler.start()
+任务函数接收工作线程的 DatabaseManager（已连接），返回值（可JSON序列化）记录为执行结果，抛出异常记为失败。
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from database.db_manager import DatabaseManager
+from email_config import (
+    JOB_SCHEDULER_ENABLED, JOB_SCHEDULER_TICK, JOB_WORKERS, JOB_POLL_INTERVAL, JOB_RUN_STALE_SECONDS
+)
+from metrics import registry, JOB_RUNS, JOB_DURATION_SECONDS
+
+LEADER_LOCK_NAME = 'qqmail:job_scheduler_leader'
+JOB_RESULT_MAX_LENGTH = 2000  # 执行结果/错误信息最多保存的字符数
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+
+# (字段名, 最小值, 最大值)；星期 0 和 7 都表示周日
+CRON_FIELDS = (('分', 0, 59), ('时', 0, 23), ('日', 1, 31), ('月', 1, 12), ('周', 0, 7))
+
+
+class CronSchedule:
+    """
+    五段式 cron 表达式：分 时 日 月 周
+    每段支持 *、数字、范围 a-b、列表 a,b 和步长 */n、a-b/n；日和周都不是 * 时满足其一即可（与 crontab 一致）
+    """
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = CRON_ALIASES.get(self.expression, self.expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron 表达式需要5段（分 时 日 月 周）: {expression}")
+
+        parsed = [self._parse_field(text, name, low, high) for text, (name, low, high) in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        self.days_restricted = not fields[2].startswith('*')
+        self.weekdays_restricted = not fields[4].startswith('*')
+
+    @staticmethod
+    def _parse_field(text, name, low, high):
+        values = set()
+        for part in text.split(','):
+            step = 1
+            if '/' in part:
+                part, step_text = part.split('/', 1)
+                if not step_text.isdigit() or int(step_text) == 0:
+                    raise ValueError(f"cron 表达式第{name}段的步长无效: {text}")
+                step = int(step_text)
+            try:
+                if part == '*':
+                    start, end = low, high
+                elif '-' in part:
+                    start, end = (int(value) for value in part.split('-', 1))
+                else:
+                    start = int(part)
+                    # 5/15 表示从5开始每15
+                    end = high if step > 1 else start
+            except ValueError:
+                raise ValueError(f"cron 表达式第{name}段无效: {text}")
+            if start < low or end > high or start > end:
+                raise ValueError(f"cron 表达式第{name}段超出范围（{low}-{high}）: {text}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays  # Python 周一为0，cron 周日为0
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        if self.days_restricted:
+            return day_ok
+        if self.weekdays_restricted:
+            return weekday_ok
+        return True
+
+    def next_after(self, moment):
+        """moment 之后（不含）的下一个执行时间（精确到分钟）"""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 按月、日、时、分逐级跳过不匹配的时间，最多查找约5年
+        for _ in range(100000):
+            if candidate.month not in self.months:
+                year = candidate.year + (candidate.month == 12)
+                month = candidate.month % 12 + 1
+                candidate = candidate.replace(year=year, month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+            elif candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"cron 表达式没有可执行的时间: {self.expression}")
+
+
+class ScheduledJob:
+    """已注册的任务"""
+
+    def __init__(self, name, schedule, handler, description=''):
+        self.name = name
+        self.schedule = schedule  # CronSchedule；None 表示只能手动触发
+        self.handler = handler
+        self.description = description
+
+    @property
+    def cron(self):
+        return self.schedule.expression if self.schedule else None
+
+
+class JobScheduler:
+    """基于 MySQL 任务表的定时任务调度"""
+
+    def __init__(self, workers=None):
+        self.workers = workers or JOB_WORKERS
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.jobs = {}
+        self.is_leader = False
+        self.running = False
+        self._synced = False
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads = []
+        registry.register_callback(self._metric_samples)
+
+    def register(self, name, cron, handler, description=''):
+        """注册任务；cron 为 None 时只能手动触发。需要在 start() 之前调用"""
+        schedule = None
+        if cron:
+            schedule = CronSchedule(cron)
+            schedule.next_after(datetime.now())  # 表达式永远不会触发（如2月31日）时注册即报错
+        self.jobs[name] = ScheduledJob(name, schedule, handler, description)
+
+    def start(self):
+        """启动调度线程和工作线程"""
+        if self.running or not JOB_SCHEDULER_ENABLED:
+            return
+        self.running = True
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run_leader, name='JobSchedulerLeader', daemon=True)]
+        for index in range(self.workers):
+            self._threads.append(threading.Thread(target=self._run_worker, name=f'JobWorker-{index}', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        print(f"🗓️ 任务调度已启动（节点 {self.node_id}，{len(self.jobs)} 个任务，{self.workers} 个工作线程）")
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        self._wakeup.set()
+
+    def enqueue(self, db, name):
+        """
+        手动触发任务（不影响计划时间）
+        Returns:
+            (success, message, run_id)；任务已在排队或执行中时 run_id 为0
+        """
+        if name not in self.jobs:
+            return False, '任务不存在', None
+        run_id = db.enqueue_job_run(name, 'manual')
+        if run_id == 0:
+            return False, '该任务已在排队或执行中', 0
+        if run_id < 0:
+            return False, '加入任务队列失败（任务尚未同步到数据库或数据库出错）', None
+        self._wakeup.set()
+        return True, '任务已加入队列', run_id
+
+    def _metric_samples(self):
+        return [('qqmail_job_scheduler_leader', '本进程是否为任务调度主节点', {}, 1 if self.is_leader else 0)]
+
+    # ========== 主节点：按计划入队 ==========
+
+    def _run_leader(self):
+        db = DatabaseManager()
+
+        while self.running:
+            try:
+                if not db.connection or not db.connection.is_connected():
+                    db.connect()
+
+                # 连接断开重连后锁已释放，需要重新竞争
+                leader = db.holds_named_lock(LEADER_LOCK_NAME) or db.acquire_named_lock(LEADER_LOCK_NAME)
+                if leader and not self.is_leader:
+                    print(f"🗓️ 节点 {self.node_id} 成为任务调度主节点")
+                elif self.is_leader and not leader:
+                    print(f"⚠️ 节点 {self.node_id} 不再是任务调度主节点")
+                    self._synced = False
+                self.is_leader = leader
+
+                if leader:
+                    if not self._synced:
+                        self._sync_jobs(db)
+                        self._synced = True
+                    self._schedule_due_jobs(db)
+                # 结束只读事务，下一轮查询才能看到其他节点提交的变化
+                db.connection.commit()
+            except Exception as e:
+                print(f"❌ 任务调度出错: {e}")
+
+            self._stop.wait(JOB_SCHEDULER_TICK)
+
+        if self.is_leader:
+            db.release_named_lock(LEADER_LOCK_NAME)
+            self.is_leader = False
+        db.disconnect()
+
+    def _sync_jobs(self, db):
+        """把注册的任务写入 scheduled_jobs（cron 变化时重新计算下次执行时间）"""
+        now = datetime.now()
+        for job in self.jobs.values():
+            next_run_at = job.schedule.next_after(now) if job.schedule else None
+            db.sync_scheduled_job(job.name, job.cron, job.description, next_run_at)
+
+    def _schedule_due_jobs(self, db):
+        stale = db.fail_stale_job_runs(JOB_RUN_STALE_SECONDS)
+        if stale > 0:
+            print(f"⚠️ {stale} 个任务执行超时，已标记失败")
+
+        now = datetime.now()
+        enqueued = 0
+        for row in db.get_due_scheduled_jobs(now):
+            job = self.jobs.get(row['name'])
+            if job is None or job.schedule is None:
+                continue
+            run_id = db.enqueue_job_run(job.name, 'schedule', job.schedule.next_after(now))
+            if run_id > 0:
+                enqueued += 1
+            elif run_id == 0:
+                print(f"⚠️ 任务 {job.name} 上一次还未完成，本次计划执行跳过")
+        if enqueued:
+            self._wakeup.set()
+
+    # ========== 工作线程：认领并执行 ==========
+
+    def _run_worker(self):
+        db = DatabaseManager()
+
+        while self.running:
+            run = None
+            try:
+                if not db.connection or not db.connection.is_connected():
+                    db.connect()
+                run = db.claim_job_run(self.node_id, list(self.jobs))
+                if run:
+                    self.execute(db, run)
+            except Exception as e:
+                print(f"❌ 任务执行线程出错: {e}")
+
+            if run is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+
+        db.disconnect()
+
+    def execute(self, db, run):
+        """执行一条已认领的记录并写回结果，返回状态"""
+        job = self.jobs[run['job_name']]
+        started = time.perf_counter()
+        result = error = None
+        try:
+            result = job.handler(db)
+            status = 'succeeded'
+        except Exception as e:
+            status = 'failed'
+            error = f"{type(e).__name__}: {e}"[:JOB_RESULT_MAX_LENGTH]
+            print(f"❌ 任务 {job.name} 执行失败: {error}")
+            try:
+                db.connection.rollback()
+            except Exception:
+                pass
+        duration = time.perf_counter() - started
+
+        JOB_RUNS.inc(job=job.name, status=status)
+        JOB_DURATION_SECONDS.observe(duration, job=job.name)
+        if status == 'succeeded' and result:
+            print(f"✅ 任务 {job.name} 完成（{duration:.2f}秒）: {result}")
+
+        summary = None
+        if result is not None:
+            summary = json.dumps(result, ensure_ascii=False, default=str)[:JOB_RESULT_MAX_LENGTH]
+        db.finish_job_run(run['id'], job.name, status, int(duration * 1000), summary, error)
+        return status
+
+
+# 全局调度实例（任务由 maintenance_jobs.register_maintenance_jobs 注册，app.py 启动）
+job_scheduler = JobScheduler()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+新邮件事件推送
+收件处理把 (user_ids, email_id, 摘要) 事件发布出来，/api/stream/mails 通过SSE推送给在线用户，
+页面不再需要反复刷新执行隔离查询和COUNT。
+
+事件来源（每个Web进程只有一个后台线程，与连接数无关）：
+- 配置了 REDIS_URL：收件进程（component_connector）保存邮件后 XADD 到 Redis Stream，
+  每个Web进程用一个线程 XREAD 读取，多个节点都能收到
+- 未配置Redis：收件进程与Web进程不共享内存，由Web进程的一个线程按主键跟踪emails表的新增记录
+  （只在有连接时查询，断开期间的邮件在下个连接到来时补齐）
+
+事件ID单调递增（Redis为 "毫秒-序号"，数据库跟踪为邮件ID），浏览器断线重连时带上 Last-Event-ID 续传；
+缓冲区已覆盖不到的旧ID返回 reset 事件，由页面整体刷新。
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from email.utils import parseaddr
+
+from email_config import (
+    REDIS_URL, MAIL_EVENTS_STREAM, MAIL_EVENTS_BUFFER, MAIL_EVENTS_POLL_INTERVAL,
+    SSE_MAX_CONNECTIONS, SSE_MAX_PER_USER
+)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def parse_event_id(event_id):
+    """把事件ID转换为可比较的元组："123" -> (123,)，"1700000000000-0" -> (1700000000000, 0)"""
+    try:
+        return tuple(int(part) for part in str(event_id).split('-'))
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_address(value):
+    """"张三 <a@b.com>" -> "a@b.com\""""
+    return (parseaddr(value or '')[1] or value or '').strip().lower()
+
+
+def build_summary(sender_email, receiver_email, subject, sent_time=None):
+    """事件中携带的邮件摘要（不含正文）"""
+    if hasattr(sent_time, 'strftime'):
+        sent_time = sent_time.strftime('%Y-%m-%d %H:%M:%S')
+    return {
+        'sender': sender_email or '',
+        'receiver': receiver_email or '',
+        'subject': (subject or '')[:200],
+        'sent_time': sent_time or '',
+    }
+
+
+class MailEventBroker:
+    """
+    进程内事件缓冲和订阅者管理
+    最近 MAIL_EVENTS_BUFFER 条事件保存在环形缓冲区中，订阅者在条件变量上等待新事件
+    """
+
+    def __init__(self, buffer_size=None, max_connections=None, max_per_user=None):
+        self.buffer_size = buffer_size or MAIL_EVENTS_BUFFER
+        self.max_connections = max_connections or SSE_MAX_CONNECTIONS
+        self.max_per_user = max_per_user or SSE_MAX_PER_USER
+
+        self._events = deque()
+        self._floor = None  # 缓冲区从这个ID之后是完整的，更早的ID无法续传
+        self._cond = threading.Condition()
+        self._connections = {}
+        self._feeder = None
+        self._feeder_lock = threading.Lock()
+        self._publisher_client = None
+        self.stats = {'published': 0, 'rejected_connections': 0}
+
+    @property
+    def shared(self):
+        """是否通过Redis在进程/节点间共享事件"""
+        return bool(REDIS_URL) and redis is not None
+
+    # ========== 连接数限制 ==========
+
+    def acquire_connection(self, user_id):
+        """登记一个推送连接，超过全局或单用户上限时返回False"""
+        with self._cond:
+            total = sum(self._connections.values())
+            if total >= self.max_connections or self._connections.get(user_id, 0) >= self.max_per_user:
+                self.stats['rejected_connections'] += 1
+                return False
+            self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        self._ensure_feeder()
+        return True
+
+    def release_connection(self, user_id):
+        with self._cond:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+            else:
+                self._connections.pop(user_id, None)
+
+    def connection_count(self):
+        with self._cond:
+            return sum(self._connections.values())
+
+    # ========== 缓冲区 ==========
+
+    def set_floor(self, event_id):
+        """事件源开始跟踪的位置（之前的事件不在缓冲区中）"""
+        with self._cond:
+            if self._floor is None:
+                self._floor = parse_event_id(event_id)
+                self._cond.notify_all()
+
+    def push(self, event):
+        """把一条事件放入缓冲区并唤醒等待的订阅者"""
+        key = parse_event_id(event['id'])
+        with self._cond:
+            if self._events and key <= self._events[-1][0]:
+                return
+            self._events.append((key, event))
+            while len(self._events) > self.buffer_size:
+                self._floor = self._events.popleft()[0]
+            self.stats['published'] += 1
+            self._cond.notify_all()
+
+    def latest_id(self, timeout=2):
+        """
+        缓冲区中最新的事件ID（没有事件时为开始跟踪的位置），新连接从这里开始只接收之后的事件
+        事件源刚启动、还没确定跟踪位置时最多等待 timeout 秒
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._events or self._floor is not None, timeout)
+            if self._events:
+                return self._events[-1][1]['id']
+            return '-'.join(str(part) for part in self._floor) if self._floor is not None else None
+
+    def wait_for_events(self, last_id, timeout):
+        """
+        等待 last_id 之后的事件
+        Returns:
+            (events, reset)：reset 为True表示 last_id 太旧，中间的事件已无法续传
+        """
+        last_key = parse_event_id(last_id) if last_id else None
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if last_key is not None and self._floor is not None and last_key < self._floor:
+                    return [], True
+                events = [event for key, event in self._events if last_key is None or key > last_key]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events, False
+                self._cond.wait(remaining)
+
+    # ========== 事件源 ==========
+
+    def _ensure_feeder(self):
+        if self._feeder and self._feeder.is_alive():
+            return
+        with self._feeder_lock:
+            if not self._feeder or not self._feeder.is_alive():
+                target = self._redis_feed_loop if self.shared else self._database_feed_loop
+                self._feeder = threading.Thread(target=target, name='MailEventFeeder', daemon=True)
+                self._feeder.start()
+
+    def _redis_feed_loop(self):
+        """从Redis Stream读取事件（启动时先载入最近的事件，便于续传）"""
+        client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    recent = client.xrevrange(MAIL_EVENTS_STREAM, count=self.buffer_size)
+                    recent.reverse()
+                    if recent:
+                        self.set_floor(recent[0][0])
+                        for entry_id, fields in recent:
+                            self.push(self._decode(entry_id, fields))
+                        last_id = recent[-1][0]
+                    else:
+                        last_id = '0-0'
+                        self.set_floor(last_id)
+
+                response = client.xread({MAIL_EVENTS_STREAM: last_id}, count=100, block=5000)
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        self.push(self._decode(entry_id, fields))
+                        last_id = entry_id
+            except Exception as e:
+                print(f"❌ 读取Redis邮件事件出错: {e}")
+                time.sleep(5)
+
+    @staticmethod
+    def _decode(entry_id, fields):
+        data = json.loads(fields.get('data', '{}'))
+        data['id'] = entry_id
+        return data
+
+    def _database_feed_loop(self):
+        """按主键跟踪emails表新增的邮件（只在有连接时查询，使用独立的数据库连接）"""
+        from database.db_manager import DatabaseManager
+
+        db = DatabaseManager()
+        last_email_id = None
+        while True:
+            try:
+                if not self.connection_count():
+                    time.sleep(MAIL_EVENTS_POLL_INTERVAL)
+                    continue
+
+                if not db.connection or not db.connection.is_connected():
+                    db.connect()
+
+                if last_email_id is None:
+                    last_email_id = db.get_max_email_id()
+                    self.set_floor(last_email_id)
+
+                rows = db.get_emails_after_id(last_email_id)
+                # 结束只读事务：连接不是自动提交，不提交的话下一轮查询仍读到旧快照，看不到其他进程新写入的邮件
+                db.connection.commit()
+                for row in rows:
+                    user_ids = [int(uid) for uid in (row.get('user_ids') or '').split(',') if uid]
+                    self.push({
+                        'id': str(row['id']),
+                        'email_id': row['id'],
+                        'user_ids': user_ids,
+                        'summary': build_summary(row['sender_email'], row['receiver_email'],
+                                                 row['subject'], row['sent_time']),
+                    })
+                    last_email_id = row['id']
+
+                if not rows:
+                    time.sleep(MAIL_EVENTS_POLL_INTERVAL)
+            except Exception as e:
+                print(f"❌ 跟踪新邮件出错: {e}")
+                db.disconnect()
+                time.sleep(5)
+
+    # ========== 发布 ==========
+
+    def publish(self, email_id, user_ids, summary):
+        """
+        收件进程保存邮件后调用
+        只有配置了Redis时才需要发布；否则Web进程会从emails表跟踪到这封邮件
+        """
+        if not self.shared:
+            return False
+        try:
+            client = self._publisher()
+            payload = json.dumps({'email_id': email_id, 'user_ids': list(user_ids), 'summary': summary},
+                                 ensure_ascii=False, default=str)
+            client.xadd(MAIL_EVENTS_STREAM, {'data': payload}, maxlen=self.buffer_size * 10, approximate=True)
+            return True
+        except Exception as e:
+            print(f"⚠️ 发布新邮件事件失败: {e}")
+            return False
+
+    def _publisher(self):
+        if self._publisher_client is None:
+            self._publisher_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        return self._publisher_client
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'backend': 'redis' if self.shared else 'database',
+                'connections': sum(self._connections.values()),
+                'users': len(self._connections),
+                'buffered_events': len(self._events),
+                'published': self.stats['published'],
+                'rejected_connections': self.stats['rejected_connections'],
+            }
+
+
+# 全局实例
+mail_event_broker = MailEventBroker()
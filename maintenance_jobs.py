@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+维护类定时任务
+原来分散在管理员接口、各自的后台线程里（或者根本没有调度）的维护工作，统一注册到 job_scheduler：
+    mailbox_cleanup          每小时    清理超限满24小时的邮箱（capacity_exceeded_log 到期记录）
+    mailbox_capacity_sweep   手动触发  立即把所有超限邮箱清理到100MB以内（原 /api/admin/cleanup_all_mailboxes）
+    vip_expiry               每分钟    按到期时间索引批量取消已到期的会员
+    verification_code_purge  每10分钟  分批清理旧 verification_codes 表（验证码已改存 verification_store）
+    orphan_file_gc           每天      删除上传后未发出的暂存附件、邮件已删除的发件附件目录
+    job_history_prune        每天      删除 JOB_HISTORY_DAYS 天前的任务执行记录
+任务函数接收已连接的 DatabaseManager，返回执行结果摘要。
+"""
+
+import os
+import time
+import shutil
+
+from email_config import (
+    ATTACHMENT_SPOOL_DIR, VIP_EXPIRY_BATCH_SIZE, JOB_HISTORY_DAYS, ORPHAN_FILE_MIN_AGE
+)
+
+MAILBOX_LIMIT_MB = 100  # 单个用户邮箱容量上限（MB）
+SENT_ATTACHMENTS_DIR = 'sent_attachments'  # 发件附件目录，每封邮件一个以邮件ID命名的子目录
+LEGACY_PURGE_BATCH = 1000  # 清理旧验证码表时每条 DELETE 删除的行数
+JOB_HISTORY_PRUNE_BATCH = 5000  # 清理执行记录时每条 DELETE 删除的行数
+ORPHAN_ID_BATCH = 500  # 检查发件附件目录对应邮件是否存在时每次查询的ID数
+
+
+def cleanup_expired_mailboxes(db):
+    processed = db.cleanup_expired_mailboxes()
+    if processed < 0:
+        raise RuntimeError('清理超限邮箱失败')
+    return {'processed_users': processed}
+
+
+def sweep_mailbox_capacity(db):
+    """立即清理所有超出容量上限的邮箱（不等待24小时宽限期）"""
+    cleaned_users = []
+    for user in db.get_all_users() or []:
+        usage = db.get_user_mailbox_usage(user['id'])
+        if usage['total_size_mb'] > MAILBOX_LIMIT_MB:
+            deleted_count = db.cleanup_user_mailbox(user['id'], MAILBOX_LIMIT_MB)
+            if deleted_count > 0:
+                cleaned_users.append({
+                    'username': user['username'],
+                    'deleted_count': deleted_count,
+                    'old_size': usage['total_size_mb']
+                })
+    return {'cleaned_users': cleaned_users}
+
+
+def expire_vip_users(db, batch_size=None):
+    """分批取消全部已到期会员，返回取消人数"""
+    batch_size = batch_size or VIP_EXPIRY_BATCH_SIZE
+    expired = 0
+    while True:
+        count = db.expire_vip_users(batch_size)
+        if count < 0:
+            raise RuntimeError('取消到期会员失败')
+        expired += count
+        if count < batch_size:
+            break
+    return expired
+
+
+def purge_legacy_verification_codes(db):
+    """分批删除旧 verification_codes 表中已使用或已过期的行，返回删除行数"""
+    deleted = 0
+    while True:
+        count = db.purge_verification_codes(LEGACY_PURGE_BATCH)
+        if count < 0:
+            raise RuntimeError('清理旧验证码表失败')
+        deleted += count
+        if count < LEGACY_PURGE_BATCH:
+            break
+    return deleted
+
+
+def _older_than(path, min_age, now):
+    try:
+        return now - os.path.getmtime(path) >= min_age
+    except OSError:
+        return False
+
+
+def collect_orphan_files(db, min_age=None):
+    """
+    删除无主的附件文件
+    - 暂存目录中超过 min_age 的文件：上传后请求中断、入队失败时没能删除的暂存文件
+    - sent_attachments 下对应邮件已不存在的目录（邮件被删除时只删了 attachments 表中登记的文件）
+    """
+    min_age = ORPHAN_FILE_MIN_AGE if min_age is None else min_age
+    now = time.time()
+    spool_files = 0
+    if os.path.isdir(ATTACHMENT_SPOOL_DIR):
+        for entry in os.scandir(ATTACHMENT_SPOOL_DIR):
+            if entry.is_file() and not entry.name.startswith('.') and _older_than(entry.path, min_age, now):
+                os.remove(entry.path)
+                spool_files += 1
+
+    candidates = {}
+    if os.path.isdir(SENT_ATTACHMENTS_DIR):
+        for entry in os.scandir(SENT_ATTACHMENTS_DIR):
+            if entry.is_dir() and entry.name.isdigit() and _older_than(entry.path, min_age, now):
+                candidates[int(entry.name)] = entry.path
+
+    email_dirs = 0
+    email_ids = sorted(candidates)
+    for start in range(0, len(email_ids), ORPHAN_ID_BATCH):
+        chunk = email_ids[start:start + ORPHAN_ID_BATCH]
+        existing = db.get_existing_email_ids(chunk)
+        if existing is None:
+            raise RuntimeError('查询邮件是否存在失败')
+        for email_id in chunk:
+            if email_id not in existing:
+                shutil.rmtree(candidates[email_id], ignore_errors=True)
+                email_dirs += 1
+
+    return {'spool_files': spool_files, 'email_dirs': email_dirs}
+
+
+def prune_job_history(db):
+    deleted = 0
+    while True:
+        count = db.prune_job_runs(JOB_HISTORY_DAYS, JOB_HISTORY_PRUNE_BATCH)
+        if count < 0:
+            raise RuntimeError('清理任务执行记录失败')
+        deleted += count
+        if count < JOB_HISTORY_PRUNE_BATCH:
+            break
+    return deleted
+
+
+def register_maintenance_jobs(scheduler):
+    scheduler.register('mailbox_cleanup', '5 * * * *', cleanup_expired_mailboxes,
+                       '清理超限满24小时的邮箱')
+    scheduler.register('mailbox_capacity_sweep', None, sweep_mailbox_capacity,
+                       '立即把所有超限邮箱清理到容量上限以内（手动触发）')
+    scheduler.register('vip_expiry', '* * * * *', expire_vip_users,
+                       '取消已到期的会员')
+    scheduler.register('verification_code_purge', '*/10 * * * *', purge_legacy_verification_codes,
+                       '清理旧验证码表')
+    scheduler.register('orphan_file_gc', '30 4 * * *', collect_orphan_files,
+                       '删除无主的暂存附件和发件附件目录')
+    scheduler.register('job_history_prune', '45 4 * * *', prune_job_history,
+                       f'删除{JOB_HISTORY_DAYS}天前的任务执行记录')
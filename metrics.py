@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus 指标
+/metrics 以 Prometheus 文本格式输出Web请求、数据库查询、收件处理和外发投递的指标。
+
+- 记录指标只是加锁更新进程内的字典，不做IO，生产环境可以一直开启
+- 多进程：设置 METRICS_DIR 后，每个进程（Web、收件监控）定期把自己的指标快照写到该目录下的
+  <角色>-<pid>.json，/metrics 合并所有进程的快照（计数器和直方图相加，Gauge相加）；
+  超过 METRICS_STALE_SECONDS 未更新的快照视为进程已退出，不再计入
+- 未设置 METRICS_DIR 时只输出当前进程的指标
+"""
+
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+
+METRICS_DIR = os.getenv('METRICS_DIR', '')  # 多进程共享快照目录（所有进程需挂载同一目录）
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '10'))  # 快照写入间隔（秒）
+METRICS_STALE_SECONDS = 120  # 快照超过该时间未更新则忽略
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # 设置后 /metrics 需要 Authorization: Bearer <token>
+
+# 默认直方图分桶（秒），覆盖从毫秒级查询到数秒的外部接口调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的当前值"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """分桶计数 + 总和 + 次数（桶计数为非累计，输出时再累加）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            item['counts'][index] += 1
+            item['sum'] += value
+            item['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            return [[list(key), {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}]
+                    for key, value in self._values.items()]
+
+
+class MetricsRegistry:
+    """进程内指标注册表；回调用于在采集时读取队列长度等现有统计"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._exporter = None
+        self.role = 'web'
+
+    def _register(self, cls, name, documentation, labelnames=(), **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def register_callback(self, callback):
+        """
+        注册采集回调，返回 [(指标名, 说明, {标签}, 值), ...]，按Gauge输出
+        回调出错时忽略，不影响其余指标
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def snapshot(self):
+        """当前进程所有指标的可序列化快照"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            callbacks = list(self._callbacks)
+
+        result = {}
+        for metric in metrics:
+            entry = {'type': metric.kind, 'help': metric.documentation,
+                     'labels': list(metric.labelnames), 'samples': metric.samples()}
+            if metric.kind == 'histogram':
+                entry['buckets'] = list(metric.buckets)
+            result[metric.name] = entry
+
+        for callback in callbacks:
+            try:
+                for name, documentation, labels, value in callback():
+                    entry = result.setdefault(name, {'type': 'gauge', 'help': documentation,
+                                                     'labels': sorted(labels), 'samples': []})
+                    entry['samples'].append([[str(labels[label]) for label in entry['labels']], value])
+            except Exception as e:
+                print(f"⚠️ 采集指标回调出错: {e}")
+        return result
+
+    # ========== 多进程快照 ==========
+
+    def start_exporter(self, role):
+        """
+        定期把本进程的指标写入 METRICS_DIR（未设置时不启动）
+        role 用于区分进程类型，例如 web、ingest
+        """
+        self.role = role
+        if not METRICS_DIR or self._exporter:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        self._exporter = threading.Thread(target=self._export_loop, name='MetricsExporter', daemon=True)
+        self._exporter.start()
+        atexit.register(self._remove_snapshot)
+
+    def _snapshot_path(self):
+        return os.path.join(METRICS_DIR, f"{self.role}-{os.getpid()}.json")
+
+    def _export_loop(self):
+        while True:
+            try:
+                path = self._snapshot_path()
+                temp_path = f"{path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(temp_path, path)
+            except Exception as e:
+                print(f"⚠️ 写入指标快照失败: {e}")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    def _remove_snapshot(self):
+        try:
+            os.remove(self._snapshot_path())
+        except OSError:
+            pass
+
+    def collect(self):
+        """本进程的实时指标 + 其他进程的快照"""
+        snapshots = [self.snapshot()]
+        if METRICS_DIR and os.path.isdir(METRICS_DIR):
+            own_file = os.path.basename(self._snapshot_path())
+            now = time.time()
+            for filename in os.listdir(METRICS_DIR):
+                if not filename.endswith('.json') or filename == own_file:
+                    continue
+                path = os.path.join(METRICS_DIR, filename)
+                try:
+                    if now - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                        continue
+                    with open(path, 'r', encoding='utf-8') as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge_snapshots(snapshots)
+
+
+def merge_snapshots(snapshots):
+    """合并多个进程的快照：相同指标、相同标签的值相加"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot.items():
+            target = merged.setdefault(name, {**entry, 'samples': {}})
+            for labels, value in entry['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = value
+                elif entry['type'] == 'histogram':
+                    target['samples'][key] = {
+                        'counts': [a + b for a, b in zip(current['counts'], value['counts'])],
+                        'sum': current['sum'] + value['sum'],
+                        'count': current['count'] + value['count'],
+                    }
+                else:
+                    target['samples'][key] = current + value
+    return merged
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [(name, value) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text(merged):
+    """输出 Prometheus 文本格式（text/plain; version=0.0.4）"""
+    lines = []
+    for name in sorted(merged):
+        entry = merged[name]
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        labels = entry['labels']
+        for values, value in sorted(entry['samples'].items()):
+            if entry['type'] == 'histogram':
+                cumulative = 0
+                bounds = list(entry['buckets']) + [float('inf')]
+                for bound, count in zip(bounds, value['counts']):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels, values, ('le', _format_value(bound)))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels, values)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels, values)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels, values)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+# 全局注册表
+registry = MetricsRegistry()
+
+# ========== 指标定义 ==========
+
+# Web请求
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'qqmail_http_request_duration_seconds', 'Flask请求处理耗时（秒）', ['endpoint', 'method', 'status'])
+
+# 数据库（method 为发起查询的 DatabaseManager 方法名）
+DB_QUERY_SECONDS = registry.histogram(
+    'qqmail_db_query_duration_seconds', '数据库语句执行耗时（秒）', ['method', 'kind'])
+DB_QUERY_ERRORS = registry.counter(
+    'qqmail_db_query_errors_total', '数据库语句执行失败次数', ['method', 'kind'])
+DB_CONNECTIONS_OPEN = registry.gauge(
+    'qqmail_db_connections_open', '当前打开的数据库连接数')
+DB_CONNECTS = registry.counter(
+    'qqmail_db_connects_total', '建立数据库连接的次数', ['result'])
+
+# 收件处理
+INGEST_MESSAGES = registry.counter(
+    'qqmail_ingest_messages_total', '收件处理的邮件数（按结果）', ['result'])
+INGEST_PARSE_SECONDS = registry.histogram(
+    'qqmail_ingest_parse_duration_seconds', '单封邮件解析耗时（秒）')
+INGEST_PROCESS_SECONDS = registry.histogram(
+    'qqmail_ingest_process_duration_seconds', '单封邮件处理总耗时（秒）')
+
+# 外发投递
+OUTBOUND_SEND_SECONDS = registry.histogram(
+    'qqmail_outbound_send_duration_seconds', '调用邮件服务商接口的耗时（秒）', ['mode'])
+OUTBOUND_MESSAGES = registry.counter(
+    'qqmail_outbound_messages_total', '外发邮件数（按结果）', ['result'])
+OUTBOUND_SEND_ERRORS = registry.counter(
+    'qqmail_outbound_send_errors_total', '调用邮件服务商接口失败次数', ['error'])
+
+# 支付结算
+PAYMENT_SETTLEMENT_LAG_SECONDS = registry.histogram(
+    'qqmail_payment_settlement_lag_seconds', '收到支付通知到入账完成的耗时（秒）',
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+PAYMENT_SETTLEMENTS = registry.counter(
+    'qqmail_payment_settlements_total', '支付订单入账处理次数（按结果）', ['result'])
+
+# 密码哈希（op 为 hash / verify / rehash）
+PASSWORD_HASH_SECONDS = registry.histogram(
+    'qqmail_password_hash_duration_seconds', 'bcrypt哈希/校验耗时（秒）', ['op'])
+PASSWORD_HASH_REJECTED = registry.counter(
+    'qqmail_password_hash_rejected_total', '密码哈希线程池已满或等待超时而拒绝的次数', ['op'])
+
+# 后台任务（status 为 succeeded / failed）
+JOB_RUNS = registry.counter(
+    'qqmail_job_runs_total', '后台任务执行次数（按任务和结果）', ['job', 'status'])
+JOB_DURATION_SECONDS = registry.histogram(
+    'qqmail_job_duration_seconds', '后台任务执行耗时（秒）', ['job'],
+    buckets=(0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+外发邮件调度器
+所有外发邮件（验证码、发件箱投递）都提交到这里，由调度线程统一发出：
+- 合并：在一个很短的时间窗口内到达的无附件邮件合并成一次批量发送（最多 OUTBOUND_BATCH_MAX 封）
+- 全局令牌桶：限制每秒调用服务商接口的次数，保持在服务商配额以内，避免429风暴
+- 发件人令牌桶：限制单个用户发件地址的发送速率，超出的邮件顺延到后续批次，不阻塞其他发件人
+  （系统发件地址 SYSTEM_FROM_EMAIL 只受全局令牌桶限制）
+- 统计吞吐量和合并率（每次接口调用平均发出的邮件数）
+"""
+
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from email_config import (
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, OUTBOUND_SENDER_RATE, OUTBOUND_SENDER_BURST,
+    OUTBOUND_BATCH_WINDOW, OUTBOUND_BATCH_MAX, OUTBOUND_SEND_THREADS, SYSTEM_FROM_EMAIL
+)
+from metrics import registry, OUTBOUND_SEND_SECONDS, OUTBOUND_MESSAGES, OUTBOUND_SEND_ERRORS
+
+
+class TokenBucket:
+    """令牌桶：按 rate 个/秒补充，最多存 capacity 个"""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount=1):
+        """尝试取令牌，成功返回True"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def wait_time(self, amount=1):
+        """还需要等待多久才有足够令牌（秒）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        """阻塞直到取到令牌，返回等待的秒数"""
+        waited = 0.0
+        while not self.try_acquire(amount):
+            delay = max(self.wait_time(amount), 0.001)
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+
+class OutboundMessage:
+    """一封待发邮件"""
+
+    __slots__ = ('params', 'idempotency_key', 'future', 'submitted_at')
+
+    def __init__(self, params, idempotency_key=None):
+        self.params = params
+        self.idempotency_key = idempotency_key
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+
+    @property
+    def sender(self):
+        return self.params.get('from', '')
+
+    @property
+    def batchable(self):
+        """Resend批量接口不支持附件；带幂等键的邮件需要单独发送以保证幂等"""
+        return not self.params.get('attachments') and not self.idempotency_key
+
+
+class OutboundDispatcher:
+    """外发邮件调度器（调度线程在第一次提交时启动）"""
+
+    def __init__(self, transport, global_rate=None, global_burst=None, sender_rate=None, sender_burst=None,
+                 batch_window=None, batch_max=None, send_threads=None):
+        self.transport = transport
+        self.global_bucket = TokenBucket(global_rate or OUTBOUND_GLOBAL_RATE, global_burst or OUTBOUND_GLOBAL_BURST)
+        self.sender_rate = sender_rate or OUTBOUND_SENDER_RATE
+        self.sender_burst = sender_burst or OUTBOUND_SENDER_BURST
+        self.batch_window = OUTBOUND_BATCH_WINDOW if batch_window is None else batch_window
+        self.batch_max = batch_max or OUTBOUND_BATCH_MAX
+
+        self._queue = queue.Queue()
+        self._deferred = []  # 因发件人限速而顺延的邮件
+        self._sender_buckets = {}
+        self._executor = ThreadPoolExecutor(max_workers=send_threads or OUTBOUND_SEND_THREADS,
+                                            thread_name_prefix='OutboundSend')
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._sent_times = deque()  # 最近60秒每封邮件的发出时间，用于计算吞吐量
+        self.stats = {
+            'submitted': 0,
+            'sent': 0,
+            'failed': 0,
+            'api_calls': 0,
+            'batch_calls': 0,
+            'sender_deferred': 0,
+            'rate_limited_seconds': 0.0,
+        }
+        registry.register_callback(self._metric_samples)
+
+    # ========== 提交 ==========
+
+    def submit(self, params, idempotency_key=None):
+        """提交一封邮件，返回 Future（结果为服务商邮件ID）"""
+        self._ensure_started()
+        message = OutboundMessage(params, idempotency_key)
+        self._incr('submitted')
+        self._queue.put(message)
+        return message.future
+
+    def send(self, params, idempotency_key=None, timeout=60):
+        """提交并等待发送结果，失败时抛出服务商返回的异常"""
+        return self.submit(params, idempotency_key).result(timeout=timeout)
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='OutboundDispatcher', daemon=True)
+                self._thread.start()
+
+    # ========== 调度 ==========
+
+    def _sender_bucket(self, sender):
+        bucket = self._sender_buckets.get(sender)
+        if bucket is None:
+            bucket = self._sender_buckets[sender] = TokenBucket(self.sender_rate, self.sender_burst)
+        return bucket
+
+    def _collect(self):
+        """收集一批待发邮件：先取顺延的，再在时间窗口内尽量多取新提交的"""
+        pending = self._deferred
+        self._deferred = []
+
+        if not pending:
+            try:
+                pending.append(self._queue.get(timeout=1))
+            except queue.Empty:
+                return []
+
+        deadline = time.monotonic() + self.batch_window
+        while len(pending) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self):
+        while True:
+            try:
+                pending = self._collect()
+                if not pending:
+                    continue
+
+                # 按发件人限速，拿不到令牌的顺延到下一轮
+                ready = []
+                for message in pending:
+                    if message.sender == SYSTEM_FROM_EMAIL or self._sender_bucket(message.sender).try_acquire():
+                        ready.append(message)
+                    else:
+                        self._deferred.append(message)
+                        self._incr('sender_deferred')
+
+                if not ready:
+                    # 全部被发件人限速，等待最早可用的令牌
+                    time.sleep(min(self._sender_bucket(m.sender).wait_time() for m in self._deferred) or 0.01)
+                    continue
+
+                batch = [m for m in ready if m.batchable]
+                singles = [m for m in ready if not m.batchable]
+
+                for i in range(0, len(batch), self.batch_max):
+                    self._dispatch(batch[i:i + self.batch_max])
+                for message in singles:
+                    self._dispatch([message])
+            except Exception as e:
+                print(f"❌ 外发调度出错: {e}")
+
+    def _dispatch(self, messages):
+        """取全局令牌后交给发送线程池执行一次接口调用"""
+        waited = self.global_bucket.acquire()
+        if waited:
+            self._incr('rate_limited_seconds', waited)
+        self._executor.submit(self._call_provider, messages)
+
+    def _call_provider(self, messages):
+        mode = 'single' if len(messages) == 1 else 'batch'
+        started = time.monotonic()
+        try:
+            if len(messages) == 1:
+                message = messages[0]
+                message_ids = [self.transport.send(message.params, idempotency_key=message.idempotency_key)]
+            else:
+                result = self.transport.send_batch([m.params for m in messages])
+                data = result.get('data', []) if isinstance(result, dict) else (result or [])
+                message_ids = [str(item.get('id')) if isinstance(item, dict) else str(item) for item in data]
+                self._incr('batch_calls')
+        except Exception as e:
+            OUTBOUND_SEND_SECONDS.observe(time.monotonic() - started, mode=mode)
+            OUTBOUND_SEND_ERRORS.inc(error=type(e).__name__)
+            OUTBOUND_MESSAGES.inc(len(messages), result='failed')
+            self._incr('api_calls')
+            self._incr('failed', len(messages))
+            for message in messages:
+                message.future.set_exception(e)
+            return
+
+        OUTBOUND_SEND_SECONDS.observe(time.monotonic() - started, mode=mode)
+        OUTBOUND_MESSAGES.inc(len(messages), result='sent')
+        self._incr('api_calls')
+        self._record_sent(len(messages))
+        for index, message in enumerate(messages):
+            message.future.set_result(message_ids[index] if index < len(message_ids) else None)
+
+    # ========== 统计 ==========
+
+    def _incr(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _record_sent(self, count):
+        now = time.monotonic()
+        with self._stats_lock:
+            self.stats['sent'] += count
+            self._sent_times.extend([now] * count)
+            while self._sent_times and self._sent_times[0] < now - 60:
+                self._sent_times.popleft()
+
+    def get_stats(self):
+        """调度统计：吞吐量（最近60秒每分钟发出数）、合并率（每次接口调用平均邮件数）"""
+        now = time.monotonic()
+        with self._stats_lock:
+            while self._sent_times and self._sent_times[0] < now - 60:
+                self._sent_times.popleft()
+            stats = dict(self.stats)
+            stats['sent_last_minute'] = len(self._sent_times)
+        stats['queue_size'] = self._queue.qsize()
+        stats['deferred'] = len(self._deferred)
+        stats['coalescing_ratio'] = round(stats['sent'] / stats['api_calls'], 2) if stats['api_calls'] else 0
+        stats['rate_limited_seconds'] = round(stats['rate_limited_seconds'], 3)
+        return stats
+
+    def _metric_samples(self):
+        return [
+            ('qqmail_outbound_queue_depth', '等待调度的外发邮件数', {}, self._queue.qsize()),
+            ('qqmail_outbound_deferred', '因发件人限速顺延的外发邮件数', {}, len(self._deferred)),
+        ]
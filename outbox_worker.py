@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+发件箱后台投递
+写信、回复、转发请求只负责校验、扣费并写入 email_outbox 表（状态 queued），
+由这里的后台线程认领并调用邮件服务商投递：
+    queued -> sending -> sent
+                      -> queued（失败，按指数退避重试）
+                      -> failed（超过最大次数，退还费用）
+每个发送线程使用独立的数据库连接，认领通过条件更新完成，多进程部署也不会重复投递。
+"""
+
+import os
+import json
+import random
+import socket
+import threading
+import time
+
+from database.db_manager import DatabaseManager
+from email_config import (
+    OUTBOX_WORKERS, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE_DELAY, OUTBOX_RETRY_MAX_DELAY, OUTBOX_STALE_SECONDS
+)
+
+# 这些错误重试也不会成功，直接判定失败（服务商返回的4xx错误通过 retryable=False 标记）
+PERMANENT_ERRORS = (FileNotFoundError, ValueError)
+
+
+def load_outbox_attachments(attachments_json):
+    """
+    还原入队时保存的附件列表（只给出文件路径，发送时按块读取编码，不整体读入内存）
+    文件缺失时抛出 FileNotFoundError，按永久失败处理
+    """
+    if not attachments_json:
+        return None
+
+    attachments = []
+    for item in json.loads(attachments_json):
+        if not os.path.exists(item['path']):
+            raise FileNotFoundError(f"附件文件不存在: {item['path']}")
+        attachments.append({'filename': item['filename'], 'path': item['path']})
+    return attachments
+
+
+class OutboxWorker:
+    """发件箱投递线程池"""
+
+    def __init__(self, worker_count=None, sender=None):
+        self.worker_count = OUTBOX_WORKERS if worker_count is None else worker_count
+        self._sender = sender
+        self._wakeup = threading.Event()
+        self._threads = []
+        self.running = False
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def sender(self):
+        """延迟创建邮件发送器（导入 email_sender 会初始化投递方式）"""
+        if self._sender is None:
+            from email_sender import email_sender
+            self._sender = email_sender
+        return self._sender
+
+    def start(self):
+        """启动后台发送线程"""
+        if self.running or self.worker_count <= 0:
+            return
+        self.running = True
+
+        for i in range(self.worker_count):
+            thread = threading.Thread(target=self._run, name=f"OutboxWorker-{i+1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        print(f"📮 发件箱已启动 {self.worker_count} 个发送线程")
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+
+    def notify(self):
+        """有新邮件入队，唤醒空闲的发送线程"""
+        self._wakeup.set()
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def compute_retry_delay(self, attempts):
+        """指数退避并加入随机抖动，避免服务商故障恢复后集中重试"""
+        delay = min(OUTBOX_RETRY_BASE_DELAY * (2 ** max(attempts - 1, 0)), OUTBOX_RETRY_MAX_DELAY)
+        return int(delay * random.uniform(0.8, 1.2))
+
+    def _run(self):
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{threading.current_thread().name}"
+        db = DatabaseManager()
+        last_stale_check = 0
+
+        while self.running:
+            claimed = []
+            try:
+                if not db.connection or not db.connection.is_connected():
+                    db.connect()
+
+                if time.time() - last_stale_check > OUTBOX_STALE_SECONDS:
+                    db.requeue_stale_outbox_entries(OUTBOX_STALE_SECONDS)
+                    last_stale_check = time.time()
+
+                claimed = db.claim_outbox_entries(worker_id, OUTBOX_BATCH_SIZE)
+                for entry in claimed:
+                    self.deliver_entry(db, worker_id, entry)
+            except Exception as e:
+                print(f"❌ [{worker_id}] 发件箱处理出错: {e}")
+
+            if not claimed:
+                # 没有待发邮件，等待唤醒或轮询超时
+                self._wakeup.wait(OUTBOX_POLL_INTERVAL)
+                self._wakeup.clear()
+
+        db.disconnect()
+
+    def deliver_entry(self, db, worker_id, entry):
+        """投递一封已认领的邮件，并根据结果更新状态"""
+        try:
+            message_id = self.sender.deliver(
+                from_email=entry['from_email'],
+                to_email=entry['to_email'],
+                subject=entry['subject'],
+                content=entry['content'],
+                attachments=load_outbox_attachments(entry['attachments_json']),
+                idempotency_key=f"outbox-{entry['id']}"
+            )
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            permanent = isinstance(e, PERMANENT_ERRORS) or getattr(e, 'retryable', True) is False
+            if permanent or entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                db.fail_outbox_entry_and_refund(entry['id'], worker_id, error)
+                self._incr('failed')
+                print(f"❌ 邮件 {entry['email_id']} 投递失败（第{entry['attempts']}次），已退款: {error}")
+            else:
+                delay = self.compute_retry_delay(entry['attempts'])
+                db.mark_outbox_retry(entry['id'], worker_id, error, delay)
+                self._incr('retried')
+                print(f"⚠️ 邮件 {entry['email_id']} 投递失败（第{entry['attempts']}次），{delay}秒后重试: {error}")
+            return False
+
+        db.mark_outbox_sent(entry['id'], worker_id, message_id)
+        self._incr('sent')
+        print(f"✅ 邮件 {entry['email_id']} 已投递: {entry['from_email']} -> {entry['to_email']} ({message_id})")
+        return True
+
+
+# 全局发件箱实例（由 app.py 启动）
+outbox_worker = OutboxWorker()
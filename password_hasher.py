@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+密码哈希线程池
+bcrypt 每次计算都要几十到上百毫秒CPU，在请求线程里直接计算时，登录高峰或撞库会让所有请求线程都卡在bcrypt上，
+整个站点无响应。这里把哈希和校验交给固定数量的工作线程（bcrypt 计算时释放GIL，可以多核并行）：
+- 同时排队+执行的任务数不超过 PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_SIZE，超出时立即抛出 PasswordHasherBusy，
+  请求快速返回"系统繁忙"，而不是无限排队
+- 成本因子由 BCRYPT_ROUNDS 配置；旧的SHA256密码或成本因子与配置不同的bcrypt密码，校验通过后在后台重新哈希并写库，
+  不占用请求线程，也不使用请求线程的数据库连接
+- 哈希/校验耗时、拒绝次数和当前排队数输出到 /metrics
+"""
+
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+from email_config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_SIZE, PASSWORD_HASH_TIMEOUT
+from metrics import registry, PASSWORD_HASH_SECONDS, PASSWORD_HASH_REJECTED
+
+
+class PasswordHasherBusy(Exception):
+    """密码哈希线程池已满"""
+
+    def __init__(self, message='系统繁忙，请稍后再试'):
+        super().__init__(message)
+
+
+def bcrypt_rounds(hashed_password):
+    """从bcrypt哈希中读取成本因子（$2b$12$... -> 12），不是bcrypt哈希时返回 None"""
+    parts = hashed_password.split('$')
+    if len(parts) < 4 or not parts[1].startswith('2') or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+class PasswordHasher:
+    """有界的bcrypt线程池"""
+
+    def __init__(self, workers=None, queue_size=None, rounds=None, timeout=None):
+        self.workers = workers or PASSWORD_HASH_WORKERS
+        self.capacity = self.workers + (PASSWORD_HASH_QUEUE_SIZE if queue_size is None else queue_size)
+        self.rounds = rounds or BCRYPT_ROUNDS
+        self.timeout = timeout or PASSWORD_HASH_TIMEOUT
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='PasswordHasher')
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._pending = 0
+        registry.register_callback(self._metric_samples)
+
+    def _metric_samples(self):
+        return [('qqmail_password_hash_pending', '密码哈希线程池中排队和执行中的任务数', {}, self._pending)]
+
+    def _submit(self, op, func, *args):
+        """提交任务；线程池已满时抛出 PasswordHasherBusy"""
+        if not self._slots.acquire(blocking=False):
+            PASSWORD_HASH_REJECTED.inc(op=op)
+            raise PasswordHasherBusy()
+        with self._lock:
+            self._pending += 1
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started, op=op)
+
+        def release(_future):
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+        future = self._executor.submit(run)
+        future.add_done_callback(release)
+        return future
+
+    def _call(self, op, func, *args):
+        try:
+            return self._submit(op, func, *args).result(timeout=self.timeout)
+        except FutureTimeoutError:
+            PASSWORD_HASH_REJECTED.inc(op=op)
+            raise PasswordHasherBusy()
+
+    def _hashpw(self, plain_password):
+        return bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds)).decode('utf-8')
+
+    def hash(self, plain_password):
+        """生成bcrypt哈希"""
+        return self._call('hash', self._hashpw, plain_password)
+
+    def verify(self, plain_password, hashed_password):
+        """
+        校验密码
+        Returns:
+            (是否正确, 是否需要重新哈希)
+        """
+        rounds = bcrypt_rounds(hashed_password)
+        if rounds is not None:
+            valid = self._call('verify', bcrypt.checkpw,
+                               plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+            return valid, valid and rounds != self.rounds
+
+        # 兼容旧的SHA256密码（计算很快，不进线程池）
+        valid = hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+        return valid, valid
+
+    def rehash_in_background(self, user_id, plain_password):
+        """后台按当前成本因子重新哈希并写库（线程池已满时跳过，下次登录再升级）"""
+        try:
+            self._submit('rehash', self._rehash, user_id, plain_password)
+        except PasswordHasherBusy:
+            print(f"⚠️ 密码哈希线程池繁忙，用户ID {user_id} 的密码暂不升级")
+
+    def _rehash(self, user_id, plain_password):
+        from database.db_manager import DatabaseManager
+
+        db = DatabaseManager()
+        if not db.connect():
+            return
+        try:
+            db.update_user_password(user_id, self._hashpw(plain_password), plain_password)
+            print(f"🔐 用户ID {user_id} 的密码已升级为bcrypt（成本因子 {self.rounds}）")
+        except Exception as e:
+            print(f"密码升级失败: {str(e)}")
+        finally:
+            db.disconnect()
+
+
+# 全局实例
+password_hasher = PasswordHasher()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+滑动窗口限流
+验证码发送、密码登录、邮箱验证码登录在进入视图之前按用户/邮箱/IP计数，超限直接返回429，
+不再每次请求都去统计 verification_code_logs，也不会被用来反复触发bcrypt校验消耗CPU。
+
+- 滑动窗口用"上一窗口计数 × 剩余比例 + 当前窗口计数"估算，每个键只保存两个计数，内存固定
+- 后端可选：默认进程内字典（最多 RATE_LIMIT_MAX_KEYS 个键，超出时淘汰最久未访问的）；
+  设置 REDIS_URL 后使用Redis，多个Web进程/节点共享计数
+- 后端出错时放行（限流只是保护措施，不能因为Redis故障导致无法登录）
+
+用法：
+    @rate_limit('login:ip', LOGIN_IP_LIMIT, 300, key='ip')
+    @rate_limit('login:account', LOGIN_ACCOUNT_LIMIT, 300, key='username')
+    def login(): ...
+"""
+
+import math
+import time
+import ipaddress
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session, jsonify, g
+
+from email_config import REDIS_URL, RATE_LIMIT_ENABLED, RATE_LIMIT_MAX_KEYS, TRUSTED_PROXIES
+from metrics import registry
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+RATE_LIMIT_KEY_PREFIX = 'qqmail:ratelimit'
+
+RATE_LIMITED = registry.counter('qqmail_rate_limited_total', '被限流拒绝的请求数', ['scope'])
+
+
+class InProcessRateBackend:
+    """进程内计数（单进程部署使用）"""
+
+    name = 'memory'
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys or RATE_LIMIT_MAX_KEYS
+        self._buckets = OrderedDict()  # 键 -> [窗口序号, 当前窗口计数, 上一窗口计数]
+        self._lock = threading.Lock()
+
+    def hit(self, key, window, now):
+        """计数+1，返回 (当前窗口计数, 上一窗口计数)"""
+        index = int(now // window)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [index, 0, 0]
+            elif bucket[0] != index:
+                previous = bucket[1] if bucket[0] == index - 1 else 0
+                bucket = [index, 0, previous]
+            bucket[1] += 1
+            self._buckets[key] = bucket
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket[1], bucket[2]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisRateBackend:
+    """Redis计数（多进程/多节点部署使用），每个窗口一个键，保留两个窗口长度后自动过期"""
+
+    name = 'redis'
+
+    HIT_SCRIPT = """
+    local current = redis.call('INCR', KEYS[1])
+    if current == 1 then
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+    local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+    return {current, previous}
+    """
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._hit = self.client.register_script(self.HIT_SCRIPT)
+
+    def hit(self, key, window, now):
+        index = int(now // window)
+        current, previous = self._hit(keys=[f"{key}:{index}", f"{key}:{index - 1}"], args=[window * 2])
+        return int(current), int(previous)
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{RATE_LIMIT_KEY_PREFIX}:*"):
+            self.client.delete(key)
+
+
+class RateLimiter:
+    """滑动窗口限流器"""
+
+    def __init__(self, backend, enabled=True):
+        self.backend = backend
+        self.enabled = enabled
+
+    def hit(self, scope, identity, limit, window):
+        """
+        记录一次请求并判断是否超限
+        Returns:
+            (allowed, remaining, retry_after)，retry_after 为建议等待的秒数
+        """
+        now = time.time()
+        key = f"{RATE_LIMIT_KEY_PREFIX}:{scope}:{identity}"
+        try:
+            current, previous = self.backend.hit(key, window, now)
+        except Exception as e:
+            print(f"⚠️ 限流计数失败，本次放行: {e}")
+            return True, limit, 0
+
+        elapsed = now % window
+        estimate = previous * (window - elapsed) / window + current
+        if estimate <= limit:
+            return True, int(limit - estimate), 0
+
+        # 估算还要多久计数才能回落到限额以内
+        if current > limit or previous == 0:
+            retry_after = window - elapsed
+        else:
+            retry_after = min((estimate - limit) * window / previous, window - elapsed)
+        return False, 0, max(1, math.ceil(retry_after))
+
+
+def create_rate_limiter():
+    """根据配置选择计数后端"""
+    if REDIS_URL and redis is not None:
+        return RateLimiter(RedisRateBackend(REDIS_URL), enabled=RATE_LIMIT_ENABLED)
+    return RateLimiter(InProcessRateBackend(), enabled=RATE_LIMIT_ENABLED)
+
+
+# ========== Flask 装饰器 ==========
+
+TRUSTED_PROXY_NETWORKS = [ipaddress.ip_network(item.strip(), strict=False)
+                          for item in TRUSTED_PROXIES.split(',') if item.strip()]
+
+
+def is_trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXY_NETWORKS)
+
+
+def client_ip():
+    """
+    客户端IP
+    只有直接连接方是受信任的反向代理（TRUSTED_PROXIES）时才读取 nginx 传递的 X-Real-IP / X-Forwarded-For，
+    否则直接使用连接地址（请求头可以由客户端任意填写，不能用来计数）
+    """
+    remote_addr = request.remote_addr or 'unknown'
+    if not is_trusted_proxy(remote_addr):
+        return remote_addr
+
+    real_ip = request.headers.get('X-Real-IP', '').strip()
+    if real_ip:
+        return real_ip
+    # X-Forwarded-For 从右往左跳过受信任的代理，第一个不受信任的地址才是客户端
+    forwarded = [item.strip() for item in request.headers.get('X-Forwarded-For', '').split(',') if item.strip()]
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address):
+            return address
+    return forwarded[0] if forwarded else remote_addr
+
+
+def _request_field(name):
+    """从JSON或表单中读取字段（邮箱、用户名按小写计数）"""
+    if request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name)
+    else:
+        value = request.form.get(name)
+    return str(value).strip().lower() if value else None
+
+
+KEY_FUNCTIONS = {
+    'ip': client_ip,
+    'user': lambda: session.get('user_id'),
+    'email': lambda: _request_field('email'),
+    'username': lambda: _request_field('username'),
+}
+
+
+def format_wait(seconds):
+    if seconds >= 3600:
+        return f"{math.ceil(seconds / 3600)}小时"
+    if seconds >= 60:
+        return f"{math.ceil(seconds / 60)}分钟"
+    return f"{seconds}秒"
+
+
+def rate_limit(scope, limit, window, key='ip', methods=('POST',), message=None, on_limited=None):
+    """
+    视图限流装饰器（可叠加多个，分别按不同维度计数）
+    Args:
+        scope: 计数范围名称（不同规则使用不同名称）
+        limit: 窗口内最多请求次数
+        window: 窗口长度（秒）
+        key: 'ip' / 'user' / 'email' / 'username'，或返回计数标识的函数；标识为空时不计数
+        message: 超限提示，可包含 {wait}（等待时间）和 {limit}
+        on_limited: 超限时调用 on_limited(message, retry_after) 生成响应；默认返回JSON
+    剩余次数保存在 g.rate_limit_remaining[scope]，视图可用于提示
+    """
+    key_function = KEY_FUNCTIONS[key] if isinstance(key, str) else key
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if rate_limiter.enabled and request.method in methods:
+                identity = key_function()
+                if identity:
+                    allowed, remaining, retry_after = rate_limiter.hit(scope, identity, limit, window)
+                    if not hasattr(g, 'rate_limit_remaining'):
+                        g.rate_limit_remaining = {}
+                    g.rate_limit_remaining[scope] = remaining
+                    if not allowed:
+                        RATE_LIMITED.inc(scope=scope)
+                        text = (message or '请求过于频繁，请{wait}后再试').format(
+                            wait=format_wait(retry_after), limit=limit)
+                        if on_limited:
+                            return on_limited(text, retry_after)
+                        return jsonify({'success': False, 'message': text}), 429, {'Retry-After': str(retry_after)}
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+# 全局限流器
+rate_limiter = create_rate_limiter()
@@ -12,7 +12,14 @@ import threading
 import ssl
 from datetime import datetime
 from email_parser import EmailParser
-from email_config import QQ_EMAIL, QQ_AUTH_CODE, EMAIL_SAVE_DIR, CHECK_INTERVAL, TARGET_DOMAIN, DEBUG_MODE
+from email_config import QQ_EMAIL, QQ_AUTH_CODE, EMAIL_SAVE_DIR, CHECK_INTERVAL, TARGET_DOMAIN, DEBUG_MODE, DEAD_LETTER_SCAN_INTERVAL
+from email_config import (
+    INGEST_QUEUE_MAXSIZE, INGEST_MIN_WORKERS, INGEST_MAX_WORKERS,
+    INGEST_SCALE_INTERVAL, INGEST_WORKER_IDLE_TIMEOUT, INGEST_TARGET_DRAIN_SECONDS
+)
+from dead_letter_queue import DeadLetterStore, STATUS_EXHAUSTED
+from metrics import registry, INGEST_MESSAGES, INGEST_PARSE_SECONDS, INGEST_PROCESS_SECONDS
+from health import write_ingest_heartbeat
 
 class RealtimeEmailMonitor:
     """
@@ -43,19 +50,37 @@ class RealtimeEmailMonitor:
         self.max_retry_attempts = 5
         self.retry_delay = 8  # 重试间隔(秒)
         
-        # 异步处理队列配置
-        self.email_queue = queue.Queue()  # 邮件处理队列
-        self.processing_workers = 2  # 处理线程数量
+        # 异步处理队列配置（有界队列，满时对拉取循环形成反压）
+        self.email_queue = queue.Queue(maxsize=INGEST_QUEUE_MAXSIZE)  # 邮件处理队列
+        self.min_workers = INGEST_MIN_WORKERS  # 最少处理线程数
+        self.max_workers = INGEST_MAX_WORKERS  # 最多处理线程数
+        self.processing_workers = self.min_workers  # 初始处理线程数量
         self.worker_threads = []  # 工作线程列表
+        self.workers_running = False
+        self._worker_seq = 0
+        self._worker_lock = threading.Lock()  # 保护 worker_threads 的增减
+        self._stats_lock = threading.Lock()  # 保护 queue_stats，多个线程同时更新
         self.queue_stats = {
             'total_queued': 0,
             'total_processed': 0,
             'total_failed': 0,
+            'total_dead_lettered': 0,
+            'total_retried': 0,
             'current_queue_size': 0,
             'processing_threads_active': 0,
-            'max_worker_threads': 2
+            'max_worker_threads': 0,
+            'avg_process_seconds': 0.0,  # 单封邮件处理耗时（指数滑动平均）
+            'backpressure_skips': 0,  # 因队列积压跳过拉取的次数
+            'scale_ups': 0,
+            'scale_downs': 0
         }
         
+        # 死信队列（处理失败的邮件持久化并按指数退避重试）
+        self.dead_letters = DeadLetterStore()
+        recovered = self.dead_letters.reset_in_flight()
+        if recovered:
+            print(f"♻️ 恢复 {recovered} 封上次未完成重试的死信邮件")
+        
         # 解析器
         self.parser = EmailParser()
         
@@ -69,66 +94,228 @@ class RealtimeEmailMonitor:
         print(f"⏰ 检查间隔: {self.check_interval}秒")
         print(f"🕐 启动时间: {self.start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"📁 保存目录: {self.save_directory}")
-        print(f"� 异步处理线程: {self.processing_workers}个")
+        print(f"� 异步处理线程: {self.min_workers}-{self.max_workers}个（按队列深度自动伸缩）")
         print("�💡 只处理启动后收到的邮件")
         
+        # 指标：收件进程把快照写到 METRICS_DIR，由Web进程的 /metrics 合并输出
+        registry.register_callback(self._metric_samples)
+        registry.start_exporter('ingest')
+        
         # 启动异步处理线程
         self.start_processing_workers()
+        self.start_dead_letter_retry()
+    
+    # ========== 统计（线程安全） ==========
+    
+    def _incr_stat(self, name, amount=1):
+        """原子地累加统计计数"""
+        with self._stats_lock:
+            self.queue_stats[name] += amount
+    
+    def _record_process_time(self, seconds):
+        """记录单封邮件处理耗时（指数滑动平均，权重0.2）"""
+        with self._stats_lock:
+            previous = self.queue_stats['avg_process_seconds']
+            self.queue_stats['avg_process_seconds'] = seconds if previous == 0 else previous * 0.8 + seconds * 0.2
+    
+    def get_queue_stats(self):
+        """获取队列统计快照（线程安全，供外部查询）"""
+        with self._worker_lock:
+            worker_count = len(self.worker_threads)
+        with self._stats_lock:
+            stats = dict(self.queue_stats)
+        stats['current_queue_size'] = self.email_queue.qsize()
+        stats['queue_capacity'] = self.email_queue.maxsize
+        stats['worker_threads'] = worker_count
+        stats['min_workers'] = self.min_workers
+        stats['max_workers'] = self.max_workers
+        return stats
+    
+    def _metric_samples(self):
+        """队列深度和线程数（/metrics 采集）"""
+        stats = self.get_queue_stats()
+        return [
+            ('qqmail_ingest_queue_depth', '等待处理的邮件数', {}, stats['current_queue_size']),
+            ('qqmail_ingest_worker_threads', '收件处理线程数', {}, stats['worker_threads']),
+            ('qqmail_ingest_active_workers', '正在处理邮件的线程数', {}, stats['processing_threads_active']),
+        ]
+    
+    # ========== 自适应工作线程池 ==========
     
     def start_processing_workers(self):
-        """启动异步处理工作线程"""
-        for i in range(self.processing_workers):
+        """启动异步处理工作线程（最少线程数）和线程池伸缩线程"""
+        if self.workers_running:
+            return
+        self.workers_running = True
+        
+        for _ in range(self.processing_workers):
+            self._spawn_worker()
+        
+        scaler = threading.Thread(target=self.worker_scaling_loop, name="EmailWorkerScaler", daemon=True)
+        scaler.start()
+        print(f"🔧 已启动 {len(self.worker_threads)} 个邮件处理线程（上限 {self.max_workers}）")
+    
+    def _spawn_worker(self):
+        """新增一个工作线程（调用方需保证未超过上限）"""
+        with self._worker_lock:
+            self._worker_seq += 1
             worker = threading.Thread(
                 target=self.email_processing_worker,
-                name=f"EmailWorker-{i+1}",
+                name=f"EmailWorker-{self._worker_seq}",
                 daemon=True
             )
-            worker.start()
             self.worker_threads.append(worker)
+            worker_count = len(self.worker_threads)
+        worker.start()
+        
+        with self._stats_lock:
+            self.queue_stats['max_worker_threads'] = max(self.queue_stats['max_worker_threads'], worker_count)
+        return worker
+    
+    def _try_retire_worker(self):
+        """空闲线程尝试退出；不低于最少线程数"""
+        with self._worker_lock:
+            if len(self.worker_threads) <= self.min_workers:
+                return False
+            self.worker_threads.remove(threading.current_thread())
+        self._incr_stat('scale_downs')
+        return True
+    
+    def desired_worker_count(self, queue_size, worker_count, avg_seconds):
+        """
+        根据队列深度和单封处理耗时计算期望线程数
+        目标：当前积压能在 INGEST_TARGET_DRAIN_SECONDS 内处理完
+        """
+        if queue_size == 0:
+            return worker_count  # 空闲线程由超时自行退出
+        
+        if avg_seconds > 0:
+            needed = int(queue_size * avg_seconds / INGEST_TARGET_DRAIN_SECONDS) + 1
+        else:
+            needed = worker_count + 1 if queue_size > worker_count else worker_count
+        
+        return max(self.min_workers, min(self.max_workers, needed))
+    
+    def worker_scaling_loop(self):
+        """定期根据积压情况扩容工作线程"""
+        while self.workers_running:
+            try:
+                stats = self.get_queue_stats()
+                desired = self.desired_worker_count(
+                    stats['current_queue_size'], stats['worker_threads'], stats['avg_process_seconds']
+                )
+                to_add = desired - stats['worker_threads']
+                for _ in range(to_add):
+                    self._spawn_worker()
+                    self._incr_stat('scale_ups')
+                if to_add > 0:
+                    print(f"📈 队列积压 {stats['current_queue_size']} 封，处理线程扩容至 {desired} 个")
+            except Exception as e:
+                print(f"❌ 线程池伸缩出错: {e}")
             
-        self.queue_stats['max_worker_threads'] = len(self.worker_threads)
-        print(f"🔧 已启动 {len(self.worker_threads)} 个邮件处理线程")
+            time.sleep(INGEST_SCALE_INTERVAL)
     
     def email_processing_worker(self):
-        """邮件处理工作线程"""
+        """邮件处理工作线程（空闲超时后自动退出，直到最少线程数）"""
         worker_name = threading.current_thread().name
         
         while True:
             try:
                 # 从队列获取邮件（阻塞等待）
-                email_data = self.email_queue.get(timeout=30)
-                
-                if email_data is None:  # 停止信号
-                    break
-                
-                # 更新统计
-                self.queue_stats['processing_threads_active'] += 1
-                self.queue_stats['current_queue_size'] = self.email_queue.qsize()
-                
+                email_data = self.email_queue.get(timeout=INGEST_WORKER_IDLE_TIMEOUT)
+            except queue.Empty:
+                # 队列空闲，多余的线程退出
+                if self._try_retire_worker():
+                    if DEBUG_MODE:
+                        print(f"📉 [{worker_name}] 空闲退出")
+                    return
+                continue
+            
+            if email_data is None:  # 停止信号
+                self.email_queue.task_done()
+                break
+            
+            # 更新统计
+            self._incr_stat('processing_threads_active')
+            started = time.monotonic()
+            
+            try:
                 if DEBUG_MODE:
                     print(f"🔧 [{worker_name}] 开始处理邮件 ID:{email_data['id']}")
                 
                 # 处理邮件（复用现有的成功逻辑）
-                result = self.process_target_email(email_data)
+                try:
+                    result = self.process_target_email(email_data)
+                except Exception as e:
+                    result = {'success': False, 'error': str(e), 'error_class': type(e).__name__}
                 
                 # 更新统计
                 if result['success']:
-                    self.queue_stats['total_processed'] += 1
+                    INGEST_MESSAGES.inc(result='processed')
+                    self._incr_stat('total_processed')
                     print(f"✅ [{worker_name}] 邮件 {email_data['id']} 处理完成")
+                    if email_data.get('dead_letter_id'):
+                        self.dead_letters.remove(email_data['dead_letter_id'])
+                        print(f"♻️ [{worker_name}] 死信 {email_data['dead_letter_id']} 重试成功，已移出死信队列")
                 else:
-                    self.queue_stats['total_failed'] += 1
+                    INGEST_MESSAGES.inc(result='failed')
+                    self._incr_stat('total_failed')
                     print(f"❌ [{worker_name}] 邮件 {email_data['id']} 处理失败: {result.get('error', 'Unknown')}")
-                
+                    self.handle_failed_email(email_data, result)
+            except Exception as e:
+                print(f"❌ [{worker_name}] 处理线程出错: {e}")
+            finally:
+                INGEST_PROCESS_SECONDS.observe(time.monotonic() - started)
+                self._record_process_time(time.monotonic() - started)
+                self._incr_stat('processing_threads_active', -1)
                 # 标记任务完成
                 self.email_queue.task_done()
-                self.queue_stats['processing_threads_active'] -= 1
-                
-            except queue.Empty:
-                # 队列空闲，继续等待
-                continue
+    
+    def handle_failed_email(self, email_data, result):
+        """处理失败的邮件写入死信队列（已在死信中的则记录失败并安排下次重试）"""
+        error = result.get('error', 'Unknown')
+        error_class = result.get('error_class', 'ProcessingError')
+        
+        try:
+            dead_letter_id = email_data.get('dead_letter_id')
+            if dead_letter_id:
+                entry = self.dead_letters.record_failure(dead_letter_id, error, error_class)
+            else:
+                entry = self.dead_letters.add(email_data, error, error_class)
+                INGEST_MESSAGES.inc(result='dead_lettered')
+                self._incr_stat('total_dead_lettered')
+            
+            if entry and entry['status'] == STATUS_EXHAUSTED:
+                print(f"🚨 死信 {entry['id']} 已重试 {entry['attempts']} 次仍失败，等待管理员处理")
+            elif entry:
+                print(f"📮 邮件 {email_data['id']} 已进入死信队列（第{entry['attempts']}次失败），下次重试: {entry['next_retry_at']}")
+        except Exception as e:
+            print(f"❌ 写入死信队列失败: {e}")
+    
+    def start_dead_letter_retry(self):
+        """启动死信重试调度线程"""
+        retry_thread = threading.Thread(
+            target=self.dead_letter_retry_loop,
+            name="DeadLetterRetry",
+            daemon=True
+        )
+        retry_thread.start()
+    
+    def dead_letter_retry_loop(self):
+        """定期把到期的死信重新投递到处理队列，由工作线程重试"""
+        while True:
+            try:
+                for entry in self.dead_letters.get_due_entries():
+                    if not self.dead_letters.mark_retrying(entry['id']):
+                        continue
+                    email_data = self.dead_letters.load_email_data(entry)
+                    self.email_queue.put(email_data)  # 队列满时阻塞等待
+                    self._incr_stat('total_retried')
+                    print(f"🔁 死信 {entry['id']} 重新投递（已失败{entry['attempts']}次）")
             except Exception as e:
-                print(f"❌ [{worker_name}] 处理线程出错: {e}")
-                self.queue_stats['processing_threads_active'] -= 1
+                print(f"❌ 死信重试调度出错: {e}")
+            
+            time.sleep(DEAD_LETTER_SCAN_INTERVAL)
     
     def connect_to_imap(self):
         """连接到QQ邮箱IMAP - 带重试机制"""
@@ -349,7 +536,9 @@ class RealtimeEmailMonitor:
             print(f"💾 邮件已保存: {filename}")
             
             # 使用解析器解析邮件
+            parse_started = time.monotonic()
             email_parsed = self.parser.load_eml_file(filepath)
+            INGEST_PARSE_SECONDS.observe(time.monotonic() - parse_started)
             
             if email_parsed:
                 print("✅ 邮件解析成功")
@@ -396,14 +585,22 @@ class RealtimeEmailMonitor:
                 }
             else:
                 print("❌ 邮件解析失败")
-                return {'success': False, 'error': 'Parse failed'}
+                return {'success': False, 'error': 'Parse failed', 'error_class': 'ParseError'}
                 
         except Exception as e:
             print(f"❌ 处理邮件失败: {e}")
-            return {'success': False, 'error': str(e)}
+            return {'success': False, 'error': str(e), 'error_class': type(e).__name__}
     
     def monitor_once(self):
         """执行一次监控 - 带重试机制和异步处理"""
+        # 反压：队列积压超过高水位时先不拉取，让工作线程追上
+        high_watermark = int(self.email_queue.maxsize * 0.8)
+        if self.email_queue.maxsize and self.email_queue.qsize() >= high_watermark:
+            write_ingest_heartbeat(self.email_queue.qsize())
+            self._incr_stat('backpressure_skips')
+            print(f"⏸️ 处理队列积压 {self.email_queue.qsize()}/{self.email_queue.maxsize}，本轮暂停拉取")
+            return 0
+        
         mail = self.connect_to_imap()
         if not mail:
             print("🚨 无法连接到邮箱，跳过本次检查")
@@ -411,19 +608,23 @@ class RealtimeEmailMonitor:
         
         try:
             target_emails = self.get_new_target_emails(mail)
+            # 成功完成一轮拉取才更新心跳，IMAP持续失败时 /readyz 会发现收件停滞
+            write_ingest_heartbeat(self.email_queue.qsize())
             
             if target_emails:
                 print(f"🚀 发现 {len(target_emails)} 封目标邮件，加入处理队列...")
                 
                 # 将邮件加入异步处理队列（快速）
+                # 队列满时 put 会阻塞，拉取循环随之放慢
                 for email_data in target_emails:
                     self.email_queue.put(email_data)
-                    self.queue_stats['total_queued'] += 1
+                    INGEST_MESSAGES.inc(result='queued')
+                    self._incr_stat('total_queued')
                 
                 # 显示队列状态
-                queue_size = self.email_queue.qsize()
-                active_workers = self.queue_stats['processing_threads_active']
-                print(f"📊 队列状态: {queue_size} 待处理, {active_workers} 线程工作中")
+                stats = self.get_queue_stats()
+                print(f"📊 队列状态: {stats['current_queue_size']} 待处理, "
+                      f"{stats['processing_threads_active']}/{stats['worker_threads']} 线程工作中")
                 
                 return len(target_emails)  # 返回加入队列的数量
             
@@ -448,11 +649,11 @@ class RealtimeEmailMonitor:
     def start_monitoring(self):
         """启动持续监控"""
         # 启动异步工作线程（如果还未启动）
-        if not getattr(self, 'workers_running', False):
+        if not self.workers_running:
             self.start_processing_workers()
         
         print(f"🔄 启动持续监控 (每{self.check_interval}秒检查一次)")
-        print(f"🚀 异步队列处理: 开启 ({self.queue_stats['max_worker_threads']} 工作线程)")
+        print(f"🚀 异步队列处理: 开启 ({len(self.worker_threads)} 工作线程，最多 {self.max_workers} 个)")
         print("按 Ctrl+C 停止监控")
         print("="*60)
         
@@ -471,7 +672,7 @@ class RealtimeEmailMonitor:
                 if queued_count:
                     total_queued += queued_count
                     queue_size = self.email_queue.qsize()
-                    processed = self.queue_stats['total_processed']
+                    processed = self.get_queue_stats()['total_processed']
                     print(f"📊 本次入队: {queued_count} 封 | 队列待处理: {queue_size} 封 | 已处理: {processed} 封")
                 
                 # 等待下次检查
@@ -486,7 +687,10 @@ class RealtimeEmailMonitor:
             duration = datetime.now() - self.start_time
             print(f"\n📊 监控结束统计:")
             print(f"   运行时间: {duration}")
-            print(f"   处理邮件: {total_processed} 封")
+            stats = self.get_queue_stats()
+            print(f"   入队邮件: {total_queued} 封")
+            print(f"   处理邮件: {stats['total_processed']} 封 (失败 {stats['total_failed']} 封)")
+            print(f"   线程峰值: {stats['max_worker_threads']} 个")
             print(f"   已处理ID: {len(self.processed_emails)} 个")
 
 def main():
@@ -519,11 +723,13 @@ def main():
         finally:
             # 显示最终统计
             if hasattr(monitor, 'queue_stats'):
-                stats = monitor.queue_stats
+                stats = monitor.get_queue_stats()
                 print(f"\n📊 最终统计:")
                 print(f"   总入队邮件: {stats['total_queued']}")
                 print(f"   总处理成功: {stats['total_processed']}")
                 print(f"   总处理失败: {stats['total_failed']}")
+                print(f"   进入死信队列: {stats['total_dead_lettered']}")
+                print(f"   线程峰值: {stats['max_worker_threads']} (扩容 {stats['scale_ups']} 次, 缩容 {stats['scale_downs']} 次)")
             print("👋 监控系统已关闭")
     else:
         print("❌ 连接失败，请检查配置")
@@ -535,7 +741,7 @@ def main():
             self.workers_running = False
             
             # 发送停止信号到队列
-            for _ in range(self.queue_stats['max_worker_threads']):
+            for _ in range(len(self.worker_threads)):
                 self.email_queue.put(None)
             
             # 等待线程结束
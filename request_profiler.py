@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+按需请求采样分析
+管理员请求带 X-Profile: 1 头或 ?__profile=1 参数时，在请求处理期间由一个采样线程每隔
+PROFILE_INTERVAL_MS 毫秒读取处理线程的调用栈，请求结束后保存为折叠栈格式（collapsed stacks，
+每行 "根;...;叶 次数"，可直接用 flamegraph.pl / speedscope 打开），并附带路由、耗时等元数据。
+
+- 开关关闭时不创建线程、不设置跟踪函数，对正常请求没有额外开销
+- 采样而不是 cProfile 跟踪：分析本身对被测请求的影响很小，结果接近真实耗时分布
+- 结果保存在 PROFILE_DIR，最多保留 PROFILE_KEEP 份
+"""
+
+import os
+import sys
+import json
+import uuid
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from email_config import PROFILE_DIR, PROFILE_INTERVAL_MS, PROFILE_KEEP
+
+PROFILE_ID_CHARS = set('0123456789abcdef-')
+
+
+class SamplingProfiler:
+    """对指定线程做定时调用栈采样"""
+
+    def __init__(self, thread_id, interval_ms=None):
+        self.thread_id = thread_id
+        self.interval = (interval_ms or PROFILE_INTERVAL_MS) / 1000.0
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='RequestProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[self._collapse(frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def _collapse(frame):
+        """调用栈转换为 "根;...;叶" 形式，每一层为 "函数 (文件:定义行)" """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+    def top_functions(self, limit=15):
+        """按采样次数统计的自身耗时最多的函数（栈顶）"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return [{'function': name, 'samples': count} for name, count in leaves.most_common(limit)]
+
+
+class ProfileStore:
+    """分析结果存储：每份结果为 <id>.collapsed（折叠栈）+ <id>.json（元数据）"""
+
+    def __init__(self, directory=None, keep=None):
+        self.directory = directory or PROFILE_DIR
+        self.keep = keep or PROFILE_KEEP
+        self._lock = threading.Lock()
+
+    def save(self, profiler, metadata):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        metadata = dict(metadata)
+        metadata.update({
+            'id': profile_id,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_ms': round(profiler.elapsed * 1000, 1),
+            'samples': profiler.samples,
+            'interval_ms': profiler.interval * 1000,
+            'top_functions': profiler.top_functions(),
+        })
+        with self._lock:
+            with open(self._path(profile_id, 'collapsed'), 'w', encoding='utf-8') as f:
+                f.write(profiler.collapsed())
+            with open(self._path(profile_id, 'json'), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            self._prune()
+        return profile_id
+
+    def _path(self, profile_id, extension):
+        return os.path.join(self.directory, f"{profile_id}.{extension}")
+
+    def _prune(self):
+        entries = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith('.json'))
+        for profile_id in entries[:-self.keep]:
+            for extension in ('json', 'collapsed'):
+                try:
+                    os.remove(self._path(profile_id, extension))
+                except OSError:
+                    pass
+
+    def list_profiles(self, limit=50):
+        """最近的分析结果元数据（新的在前）"""
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+            if len(result) >= limit:
+                break
+        return result
+
+    def get_collapsed_path(self, profile_id):
+        """折叠栈文件路径；ID格式不合法或文件不存在时返回None"""
+        if not profile_id or not set(profile_id) <= PROFILE_ID_CHARS:
+            return None
+        path = self._path(profile_id, 'collapsed')
+        return path if os.path.exists(path) else None
+
+
+def profiling_requested(request):
+    """请求是否要求采样分析（调用方负责检查管理员权限）"""
+    return request.headers.get('X-Profile') == '1' or request.args.get('__profile') == '1'
+
+
+# 全局实例
+profile_store = ProfileStore()
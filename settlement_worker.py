@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+支付结算后台线程
+易支付异步通知只负责验签并把订单从 created 标记为 paid（一条按订单号的条件更新），立即返回 success，
+避免数据库慢时回调超时、易支付反复重试放大负载。这里的后台线程负责入账：
+    paid -> credited（余额入账或开通会员，和充值记录同一事务）
+         -> paid（数据库出错，按指数退避重试，已付款的订单一直重试到入账为止）
+         -> failed（实付金额与订单金额不符）
+入账用 paid -> credited 的比较并设置完成，多个进程同时运行结算线程也只会入账一次。
+"""
+
+import random
+import threading
+
+from config import Config
+from database.db_manager import DatabaseManager
+from email_config import (
+    SETTLEMENT_ENABLED, SETTLEMENT_BATCH_SIZE, SETTLEMENT_POLL_INTERVAL,
+    SETTLEMENT_RETRY_BASE_DELAY, SETTLEMENT_RETRY_MAX_DELAY
+)
+from metrics import registry, PAYMENT_SETTLEMENT_LAG_SECONDS, PAYMENT_SETTLEMENTS
+
+
+class SettlementWorker:
+    """支付订单入账线程"""
+
+    def __init__(self, vip_days=None):
+        self.vip_days = vip_days or Config.VIP_DURATION_DAYS
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.running = False
+        self.backlog = {'pending': 0, 'oldest_seconds': 0}
+        registry.register_callback(self._metric_samples)
+
+    def start(self):
+        """启动结算线程"""
+        if self.running or not SETTLEMENT_ENABLED:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name='SettlementWorker', daemon=True)
+        self._thread.start()
+        print("💳 支付结算线程已启动")
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+
+    def notify(self):
+        """有订单被标记为已支付，唤醒结算线程"""
+        self._wakeup.set()
+
+    def compute_retry_delay(self, attempts):
+        """指数退避并加入随机抖动"""
+        delay = min(SETTLEMENT_RETRY_BASE_DELAY * (2 ** attempts), SETTLEMENT_RETRY_MAX_DELAY)
+        return int(delay * random.uniform(0.8, 1.2))
+
+    def _metric_samples(self):
+        return [
+            ('qqmail_payment_settlement_pending', '已支付待入账的订单数', {}, self.backlog['pending']),
+            ('qqmail_payment_settlement_oldest_seconds', '最早一笔待入账订单已等待的秒数', {},
+             self.backlog['oldest_seconds']),
+        ]
+
+    def _run(self):
+        db = DatabaseManager()
+
+        while self.running:
+            orders = []
+            try:
+                if not db.connection or not db.connection.is_connected():
+                    db.connect()
+
+                backlog = db.get_settlement_backlog()
+                if backlog:
+                    self.backlog = {'pending': backlog['pending'], 'oldest_seconds': backlog['oldest_seconds']}
+
+                orders = db.get_due_payment_orders(SETTLEMENT_BATCH_SIZE)
+                # 结束只读事务：连接不是自动提交，不提交的话下一轮查询仍读到旧快照，看不到新标记为已支付的订单
+                db.connection.commit()
+                for order in orders:
+                    self.settle_order(db, order)
+            except Exception as e:
+                print(f"❌ 支付结算出错: {e}")
+
+            if len(orders) < SETTLEMENT_BATCH_SIZE:
+                self._wakeup.wait(SETTLEMENT_POLL_INTERVAL)
+                self._wakeup.clear()
+
+        db.disconnect()
+
+    def settle_order(self, db, order):
+        """入账一笔已支付订单，返回 settle_payment_order 的结果"""
+        order_no = order['order_no']
+        result = db.settle_payment_order(order, self.vip_days)
+        PAYMENT_SETTLEMENTS.inc(result=result)
+
+        if result == 'credited':
+            PAYMENT_SETTLEMENT_LAG_SECONDS.observe(max(order.get('waited_seconds') or 0, 0))
+            if order['charge_type'] == 'balance':
+                print(f"✅ 订单 {order_no} 已入账：用户 {order['user_id']} 余额 +¥{order['amount']:.2f}")
+            else:
+                print(f"✅ 订单 {order_no} 已入账：用户 {order['user_id']} 开通会员（{self.vip_days}天）")
+        elif result == 'duplicate':
+            print(f"⚠️ 订单 {order_no} 已入账，跳过")
+        elif result == 'amount_mismatch':
+            print(f"❌ 订单 {order_no} 实付金额 ¥{order['paid_amount']} 与订单金额 ¥{order['amount']} 不符，已标记失败")
+        else:
+            delay = self.compute_retry_delay(order['settle_attempts'])
+            db.mark_payment_order_retry(order_no, '入账事务失败', delay)
+            print(f"⚠️ 订单 {order_no} 入账失败（第{order['settle_attempts'] + 1}次），{delay}秒后重试")
+        return result
+
+
+# 全局结算实例（由 app.py 启动）
+settlement_worker = SettlementWorker()
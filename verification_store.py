@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+验证码存储（带过期时间）
+邮箱绑定、邮箱登录的6位验证码只需要保存几分钟，不再写入 MySQL 的 verification_codes 表：
+- 后端可选：默认进程内字典（单进程部署）；设置 REDIS_URL 后使用Redis（多个Web进程/节点共享），键自带过期时间
+- 同一用途、同一邮箱（、同一用户）只保留最新的一个验证码，重新发送即覆盖旧码
+- 校验成功时原子地取出并删除，同一个验证码只能使用一次；输错 VERIFICATION_MAX_ATTEMPTS 次后作废
+- 旧的 verification_codes 表由定时任务 verification_code_purge 分批清理（见 maintenance_jobs.py）
+
+用法：
+    code = verification_store.issue('login', email)
+    if verification_store.verify('login', email, code): ...
+"""
+
+import hmac
+import time
+import secrets
+import threading
+
+from email_config import REDIS_URL, VERIFICATION_CODE_TTL, VERIFICATION_MAX_ATTEMPTS
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+VERIFICATION_KEY_PREFIX = 'qqmail:vcode'
+
+
+class InProcessCodeBackend:
+    """进程内验证码存储（单进程部署使用）"""
+
+    name = 'memory'
+    SWEEP_EVERY = 256  # 每写入多少次顺带清理一次过期的码
+
+    def __init__(self):
+        self._codes = {}  # 键 -> [验证码, 过期时间, 已输错次数]
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def put(self, key, code, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._codes[key] = [code, now + ttl, 0]
+            self._writes += 1
+            if self._writes % self.SWEEP_EVERY == 0:
+                expired = [k for k, entry in self._codes.items() if entry[1] <= now]
+                for k in expired:
+                    del self._codes[k]
+
+    def check(self, key, code, max_attempts):
+        with self._lock:
+            entry = self._codes.get(key)
+            if entry is None:
+                return False
+            if entry[1] <= time.monotonic():
+                del self._codes[key]
+                return False
+            if hmac.compare_digest(entry[0], code):
+                del self._codes[key]
+                return True
+            entry[2] += 1
+            if entry[2] >= max_attempts:
+                del self._codes[key]
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._codes.clear()
+
+
+class RedisCodeBackend:
+    """Redis验证码存储（多进程/多节点部署使用），每个码一个哈希键，EXPIRE 到期自动删除"""
+
+    name = 'redis'
+
+    # 比对成功即删除；比对失败累计次数，达到上限删除
+    CHECK_SCRIPT = """
+    local stored = redis.call('HGET', KEYS[1], 'code')
+    if not stored then
+        return 0
+    end
+    if stored == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+        return 1
+    end
+    local attempts = redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+    if attempts >= tonumber(ARGV[2]) then
+        redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._check = self.client.register_script(self.CHECK_SCRIPT)
+
+    def put(self, key, code, ttl):
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={'code': code, 'attempts': 0})
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+    def check(self, key, code, max_attempts):
+        return int(self._check(keys=[key], args=[code, max_attempts])) == 1
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{VERIFICATION_KEY_PREFIX}:*"):
+            self.client.delete(key)
+
+
+class VerificationStore:
+    """验证码的生成与校验"""
+
+    def __init__(self, backend, ttl=None, max_attempts=None):
+        self.backend = backend
+        self.ttl = ttl or VERIFICATION_CODE_TTL
+        self.max_attempts = max_attempts or VERIFICATION_MAX_ATTEMPTS
+
+    @staticmethod
+    def make_key(code_type, email, user_id=None):
+        return f"{VERIFICATION_KEY_PREFIX}:{code_type}:{email.strip().lower()}:{user_id or ''}"
+
+    def issue(self, code_type, email, user_id=None):
+        """生成6位验证码并保存（覆盖该用途该邮箱之前的验证码），返回验证码"""
+        code = f"{secrets.randbelow(1000000):06d}"
+        self.backend.put(self.make_key(code_type, email, user_id), code, self.ttl)
+        return code
+
+    def verify(self, code_type, email, code, user_id=None):
+        """校验验证码，正确则立即作废并返回 True"""
+        code = (code or '').strip()
+        if len(code) != 6 or not code.isdigit():
+            return False
+        try:
+            return self.backend.check(self.make_key(code_type, email, user_id), code, self.max_attempts)
+        except Exception as e:
+            print(f"❌ 验证码校验失败: {e}")
+            return False
+
+    @property
+    def ttl_minutes(self):
+        return max(1, self.ttl // 60)
+
+
+def create_verification_store():
+    """根据配置选择存储后端"""
+    if REDIS_URL and redis is not None:
+        return VerificationStore(RedisCodeBackend(REDIS_URL))
+    return VerificationStore(InProcessCodeBackend())
+
+
+# 全局验证码存储
+verification_store = create_verification_store()
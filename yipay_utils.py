@@ -7,7 +7,6 @@
 import hashlib
 import time
 import random
-import requests
 from urllib.parse import urlencode, quote_plus
 from yipay_config import YIPAY_PID, YIPAY_KEY, YIPAY_GATEWAY, SITE_NAME, RETURN_URL, NOTIFY_URL
 
@@ -42,15 +41,8 @@ class YiPayUtil:
         # 加上密钥
         sign_str = param_str + key
         
-        # MD5加密，转小写
-        md5_hash = hashlib.md5(sign_str.encode('utf-8')).hexdigest().lower()
-        
-        print(f"🔐 签名调试信息:")
-        print(f"   参数字符串: {param_str}")
-        print(f"   签名字符串: {sign_str}")
-        print(f"   MD5签名: {md5_hash}")
-        
-        return md5_hash
+        # MD5加密，转小写（签名字符串包含商户密钥，不能写入日志）
+        return hashlib.md5(sign_str.encode('utf-8')).hexdigest().lower()
     
     @staticmethod
     def verify_sign(params, key):